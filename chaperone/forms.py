@@ -13,15 +13,14 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
-import fcntl
 import logging
 import os
-import yaml
 
 from django import forms
 from django.conf import settings
 
 from chaperone.utils import getters
+from chaperone.utils import yaml
 
 LOG = logging.getLogger(__name__)
 
@@ -131,11 +130,7 @@ class VCenterForm(forms.Form):
         if not os.path.exists(filename):
             return
 
-        with open(filename, 'r') as fp:
-            fcntl.flock(fp, fcntl.LOCK_SH)
-            file_contents = fp.read()
-            fcntl.flock(fp, fcntl.LOCK_UN)
-        vcenter_data = yaml.load(file_contents)
+        vcenter_data = yaml.load(filename)
 
         _initialize_values(self.fields, vcenter_data, getters.COMP_VC,
                            getters.COMP_VC_USERNAME, getters.COMP_VC_PASSWORD,
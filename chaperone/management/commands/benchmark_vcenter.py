@@ -0,0 +1,219 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from pyVmomi import vim, vmodl
+
+from chaperone.utils import getters
+
+
+class _Content(object):
+    def __init__(self, root_folder, view_manager, property_collector):
+        self.rootFolder = root_folder
+        self.viewManager = view_manager
+        self.propertyCollector = property_collector
+
+
+class FakeVCenter(object):
+    """SOAP stub that answers from a generated in-memory inventory, counting
+    every method call and property read as one round trip.
+    """
+
+    def __init__(self, datacenters, clusters, hosts, datastores, networks):
+        self.calls = 0
+        self._props = {}
+        self._children = {}
+        self._views = {}
+        self._pages = {}
+        self._next_id = 0
+
+        self.root = self._add(vim.Folder, None, name='Datacenters')
+        for d in range(datacenters):
+            dc = self._add(vim.Datacenter, self.root, name='dc%d' % d)
+            dc_datastores = vim.ManagedObject.Array([
+                self._add(vim.Datastore, dc, name='dc%d-datastore%d' % (d, n))
+                for n in range(datastores)])
+            dc_networks = vim.ManagedObject.Array([
+                self._add(vim.Network, dc, name='dc%d-network%d' % (d, n))
+                for n in range(networks)])
+            for c in range(clusters):
+                cl = self._add(vim.ClusterComputeResource, dc,
+                               name='dc%d-cluster%d' % (d, c))
+                cl_hosts = vim.ManagedObject.Array()
+                for h in range(hosts):
+                    cl_hosts.append(self._add(
+                        vim.HostSystem, cl, name='dc%d-c%d-host%d' % (d, c, h),
+                        datastore=dc_datastores, network=dc_networks))
+                self._props[cl]['host'] = cl_hosts
+
+        self.content = _Content(
+            self.root, vim.view.ViewManager('ViewManager', self),
+            vmodl.query.PropertyCollector('propertyCollector', self))
+
+    def _add(self, obj_type, parent, **props):
+        self._next_id += 1
+        obj = obj_type('%s-%d' % (obj_type.__name__, self._next_id), self)
+        props['parent'] = parent
+        self._props[obj] = props
+        self._children[obj] = []
+        if parent is not None:
+            self._children[parent].append(obj)
+        return obj
+
+    def _descendants(self, obj):
+        for child in self._children[obj]:
+            yield child
+            for descendant in self._descendants(child):
+                yield descendant
+
+    def InvokeAccessor(self, obj, info):
+        self.calls += 1
+        if obj in self._views:
+            return self._views[obj]
+        return self._props[obj][info.name]
+
+    def InvokeMethod(self, obj, info, args):
+        self.calls += 1
+        return getattr(self, '_%s' % info.name)(obj, *args)
+
+    def _CreateContainerView(self, manager, container, types, recursive):
+        view = vim.view.ContainerView('view-%d' % len(self._views), self)
+        self._views[view] = vim.ManagedObject.Array([
+            obj for obj in self._descendants(container)
+            if isinstance(obj, tuple(types))])
+        return view
+
+    def _Destroy(self, view):
+        del self._views[view]
+
+    def _RetrievePropertiesEx(self, collector, spec_set, options):
+        contents = []
+        for spec in spec_set:
+            objs = []
+            for obj_spec in spec.objectSet:
+                if not obj_spec.skip:
+                    objs.append(obj_spec.obj)
+                for select in obj_spec.selectSet:
+                    objs.extend(self._views[obj_spec.obj])
+            for obj in objs:
+                prop_set = []
+                for prop_spec in spec.propSet:
+                    if not isinstance(obj, prop_spec.type):
+                        continue
+                    for path in prop_spec.pathSet:
+                        prop_set.append(vmodl.DynamicProperty(
+                            name=path, val=self._props[obj][path]))
+                if prop_set:
+                    contents.append(
+                        vmodl.query.PropertyCollector.ObjectContent(
+                            obj=obj, propSet=prop_set))
+        return self._page(contents, options.maxObjects)
+
+    def _ContinueRetrievePropertiesEx(self, collector, token):
+        contents, size = self._pages.pop(token)
+        return self._page(contents, size)
+
+    def _page(self, contents, size):
+        if not contents:
+            return None
+        token = None
+        if size and len(contents) > size:
+            self._next_id += 1
+            token = 'token-%d' % self._next_id
+            self._pages[token] = (contents[size:], size)
+            contents = contents[:size]
+        return vmodl.query.PropertyCollector.RetrieveResult(objects=contents,
+                                                            token=token)
+
+
+def _walk_datastores(content, datacenter, cluster):
+    # Find the cluster datastores the way the getters used to, reading the
+    # properties of one managed object at a time.
+    datastores_by_name = {}
+    dcview = content.viewManager.CreateContainerView(content.rootFolder,
+                                                     [vim.Datacenter], True)
+    datacenters = dcview.view
+    dcview.Destroy()
+    for dc in datacenters:
+        if datacenter and dc.name != datacenter:
+            continue
+        clusterview = content.viewManager.CreateContainerView(
+            dc, [vim.ClusterComputeResource], True)
+        clusters = clusterview.view
+        clusterview.Destroy()
+        for cl in clusters:
+            if cluster and cl.name != cluster:
+                continue
+            hostsview = content.viewManager.CreateContainerView(
+                cl, [vim.HostSystem], True)
+            hosts = hostsview.view
+            hostsview.Destroy()
+            for host in hosts:
+                host.name
+                for datastore in host.datastore:
+                    datastores_by_name[datastore.name] = datastore
+    return datastores_by_name
+
+
+def _collect_datastores(content, datacenter, cluster):
+    return getters._get_host_resources(content, datacenter, cluster,
+                                       'datastore', vim.Datastore)
+
+
+class Command(BaseCommand):
+    help = ('Counts the vCenter round trips needed to list the datastores of '
+            'a cluster against a generated fake vCenter, walking objects one '
+            'at a time and with property collector queries.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--datacenters', type='int', default=2,
+                    help='Number of datacenters in the fake vCenter.'),
+        make_option('--clusters', type='int', default=4,
+                    help='Number of clusters per datacenter.'),
+        make_option('--hosts', type='int', default=64,
+                    help='Number of hosts per cluster.'),
+        make_option('--datastores', type='int', default=30,
+                    help='Number of datastores per datacenter.'),
+        make_option('--networks', type='int', default=10,
+                    help='Number of networks per datacenter.'),
+        make_option('--page-size', type='int',
+                    default=getters.RETRIEVE_PAGE_SIZE,
+                    help='Maximum number of objects per retrieved page.'),
+    )
+
+    def handle(self, *args, **options):
+        getters.RETRIEVE_PAGE_SIZE = options['page_size']
+        vcenter = FakeVCenter(options['datacenters'], options['clusters'],
+                              options['hosts'], options['datastores'],
+                              options['networks'])
+        datacenter, cluster = 'dc0', 'dc0-cluster0'
+
+        self.stdout.write('%-10s %12s %10s %10s' % (
+            'method', 'round trips', 'objects', 'time (s)'))
+        results = []
+        for name, fn in (('walk', _walk_datastores),
+                         ('collector', _collect_datastores)):
+            vcenter.calls = 0
+            start = time.time()
+            datastores = fn(vcenter.content, datacenter, cluster)
+            elapsed = time.time() - start
+            results.append(sorted(datastores))
+            self.stdout.write('%-10s %12d %10d %10.4f' % (
+                name, vcenter.calls, len(datastores), elapsed))
+        if results[0] != results[1]:
+            self.stderr.write('Results differ: %s' % results)
@@ -0,0 +1,80 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+from __future__ import absolute_import
+
+import time
+import yaml
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+
+def _answers(size):
+    # Return a generated answer file with the given number of keys.
+    answers = {}
+    for n in range(size):
+        answers['attribute_%d' % n] = 'value for attribute %d' % n
+    return answers
+
+
+def _time(fn, repeat):
+    # Return the best time out of several runs of fn.
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+class Command(BaseCommand):
+    help = ('Compares parse and dump times of the pure Python and libyaml '
+            'PyYAML implementations on generated answer files.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', default='1000,10000,100000',
+                    help='Comma separated numbers of answer file keys.'),
+        make_option('--repeat', type='int', default=3,
+                    help='Number of runs per measurement; the best is kept.'),
+    )
+
+    def handle(self, *args, **options):
+        sizes = [int(s) for s in options['sizes'].split(',') if s.strip()]
+        repeat = options['repeat']
+
+        implementations = [('python', yaml.SafeLoader, yaml.SafeDumper)]
+        if getattr(yaml, '__with_libyaml__', False):
+            implementations.append(('libyaml', yaml.CSafeLoader,
+                                    yaml.CSafeDumper))
+        else:
+            self.stdout.write('libyaml is not available, only measuring the '
+                              'pure Python implementation.')
+
+        self.stdout.write('%-8s %8s %10s %10s %10s' % (
+            'impl', 'keys', 'bytes', 'parse (s)', 'dump (s)'))
+        for size in sizes:
+            answers = _answers(size)
+            text = yaml.dump(answers, Dumper=yaml.SafeDumper,
+                             default_flow_style=False)
+            for name, loader, dumper in implementations:
+                parse = _time(lambda: yaml.load(text, Loader=loader), repeat)
+                dump = _time(lambda: yaml.dump(answers, Dumper=dumper,
+                                               default_flow_style=False),
+                             repeat)
+                self.stdout.write('%-8s %8d %10d %10.4f %10.4f' % (
+                    name, size, len(text), parse, dump))
@@ -14,6 +14,9 @@
    limitations under the License.
 */ 
 chaperone.utils = {
+  /* EventSource pushing the output of the log being viewed. */
+  logStream: null,
+
   ajaxError: function(jqxhr, status, error) {
     /* Return error message. */
     var message = '';
@@ -117,8 +120,13 @@ chaperone.utils = {
     });
   },
 
-  loadVCenterOptions: function(knob, field, values) {
-    var $field = $(field);
+  loadVCenterOptions: function(knob, fields, values) {
+    /* Load options of the fields, keyed by field id, in one request. */
+    var fieldIds = [];
+    for (var fieldId in fields) {
+      fieldIds.push(fieldId);
+    }
+    values.fid = fieldIds;
     /* Need CSRF token for Django POST requests. */
     var csrf = 'csrfmiddlewaretoken';
     values[csrf] = $('#vcenter-form input[name="' + csrf + '"]').val();
@@ -129,26 +137,47 @@ chaperone.utils = {
       $knob.button('loading');
     }
     $.ajax({
-      url: '/options',
+      url: '/options/batch',
       type: 'POST',
       data: values,
+      /* Send fid=a&fid=b, as Django expects lists. */
+      traditional: true,
       success: function(data) {
-        if (data.errors && data.errors.length) {
-          $('#vcenter-errors').html(data.errors.join('<br/>'));
+        var errors = [];
+        for (var fieldId in data.errors) {
+          errors = errors.concat(data.errors[fieldId]);
+        }
+        if (errors.length) {
+          $('#vcenter-errors').html(errors.join('<br/>'));
           return;
         }
 
-        /* Add options to input field. */
-        $field.append('<option value="">-- select --</option>');
-        for (var i = 0; i < data.options.length; i++) {
-          var option = data.options[i];
-          $field.append('<option value="' + option + '">' + option +
-                        '</option>');
+        /* Show how fresh the vCenter inventory snapshot is. */
+        var snapshot = data.inventory && data.inventory[values.vcenter];
+        var title = null;
+        if (snapshot && snapshot.current) {
+          title = 'Inventory version ' + snapshot.version + ', updated ' +
+                  Math.round(snapshot.age) + 's ago';
         }
 
-        /* Show hidden inputs. */
-        $field.parents('div.modal-section').find('div.no-display')
-          .toggleClass('no-display display');
+        for (var i = 0; i < fieldIds.length; i++) {
+          /* Add options to input field. */
+          var $field = $(fields[fieldIds[i]]);
+          var options = data.options[fieldIds[i]];
+          $field.append('<option value="">-- select --</option>');
+          for (var j = 0; j < options.length; j++) {
+            var option = options[j];
+            $field.append('<option value="' + option + '">' + option +
+                          '</option>');
+          }
+          if (title) {
+            $field.attr('title', title);
+          }
+
+          /* Show hidden inputs. */
+          $field.parents('div.modal-section').find('div.no-display')
+            .toggleClass('no-display display');
+        }
         if (!$('#vcenter-form').find('div.no-display').length) {
           $('div.modal-footer button[type="submit"]').show();
         }
@@ -231,6 +260,7 @@ chaperone.utils = {
 
     if ($div.parents('.prepare-menu').length) {
       /* Show form to set the group's answers. */
+      chaperone.utils.stopLogStream();
       var containerName = $div.attr('data-container');
       var groupName = $div.attr('data-group');
       chaperone.utils.loadGroup(containerName, groupName);
@@ -247,6 +277,7 @@ chaperone.utils = {
       var groupName = $div.attr('data-group');
 
       /* Fill in the page contents based on the action given. */
+      chaperone.utils.stopLogStream();
       $('#loading').show();
       /* Add parent div first, so other functions know what page this is. */
       $('#contents').html('<div id="contents-' + itemId +'"></div>');
@@ -255,6 +286,8 @@ chaperone.utils = {
         data: { mname: menuName, gname: groupName },
         success: function(response) {
           $('#contents-' + itemId).html(response);
+          /* Update log viewer as output is written. */
+          chaperone.utils.followLog(itemId, menuName, groupName);
         },
         error: function(jqxhr, status, error) {
           chaperone.utils.ajaxError(jqxhr, status, error);
@@ -265,10 +298,6 @@ chaperone.utils = {
         }
       });
 
-      /* Update log viewer periodically. */
-      setTimeout(function() {
-        chaperone.utils.updateLogView(itemId, menuName, groupName);
-      }, 2000);
     }
   },
 
@@ -330,28 +359,135 @@ chaperone.utils = {
     });
   },
 
-  updateLogView: function(itemId, menuName, groupName) {
+  showLogOutput: function(itemId, data, cursor) {
+    /* Show new output and scroll to the bottom. */
+    var $output = $('#execute-output-' + itemId);
+    if (!$output.length) {
+      return;
+    }
+    if (data.reset) {
+      $output.text(data.data);
+    } else if (data.data) {
+      $output.append(document.createTextNode(data.data));
+    }
+    if (data.reset || data.data) {
+      $output.scrollTop($output[0].scrollHeight);
+    }
+    $output.attr('data-cursor', cursor);
+  },
+
+  followLog: function(itemId, menuName, groupName) {
+    /* Have output pushed as it's written where the browser supports it,
+       otherwise poll for it. */
+    chaperone.utils.stopLogStream();
+    if (!window.EventSource) {
+      chaperone.utils.updateLogView(itemId, menuName, groupName);
+      return;
+    }
+
+    var source = new EventSource('/execute/stream?' + $.param({
+      mname: menuName,
+      gname: groupName,
+      cursor: $('#execute-output-' + itemId).attr('data-cursor') || ''
+    }));
+    chaperone.utils.logStream = source;
+    source.onmessage = function(event) {
+      if (!$('#contents-' + itemId).length) {
+        chaperone.utils.stopLogStream();
+        return;
+      }
+      chaperone.utils.showLogOutput(itemId, JSON.parse(event.data),
+                                    event.lastEventId);
+    };
+    source.onerror = function(event) {
+      /* The browser reconnects by itself, unless the request failed. */
+      if (source.readyState != EventSource.CLOSED) {
+        return;
+      }
+      if (chaperone.utils.logStream === source) {
+        chaperone.utils.logStream = null;
+        if ($('#contents-' + itemId).length) {
+          chaperone.utils.updateLogView(itemId, menuName, groupName);
+        }
+      }
+    };
+  },
+
+  loadRunPage: function(mgid, runId, offset) {
+    /* Show a page of a past run's output, after those already shown. */
+    var $history = $('#execute-history-' + mgid);
+    var $more = $('button.run-more[data-mgid="' + mgid + '"]');
     $.ajax({
-      url: '/execute/tail',
-      data: { mname: menuName, gname: groupName },
-      success: function(response) {
-        /* Show recent output and scroll to the bottom. */
-        var $output = $('#execute-output-' + itemId);
-        if (response && $output.length && response != $output.text()) {
-          $output.text(response).scrollTop($output[0].scrollHeight);
+      url: '/execute/history',
+      data: {
+        mname: $('#execute-form input[name="mname"]').val(),
+        gname: $('#execute-form input[name="gname"]').val(),
+        run: runId,
+        offset: offset
+      },
+      success: function(data) {
+        if (data.errors && data.errors.length) {
+          $history.text(data.errors.join('\n')).show();
+          $more.hide();
+          return;
         }
+        if (!offset) {
+          $history.empty();
+        }
+        $history.append(document.createTextNode(data.data)).show();
+        $more.attr('data-run', runId).attr('data-offset', data.offset)
+          .toggle(!data.eof);
+      },
+      error: function(jqxhr, status, error) {
+        chaperone.utils.ajaxError(jqxhr, status, error);
+      }
+    });
+  },
 
-        /* Schedule another update, if we're still on the page. */
+  stopLogStream: function() {
+    if (chaperone.utils.logStream) {
+      chaperone.utils.logStream.close();
+      chaperone.utils.logStream = null;
+    }
+  },
+
+  updateLogView: function(itemId, menuName, groupName) {
+    /* Only one update pending per page; replace any already scheduled. */
+    var $contents = $('#contents-' + itemId);
+    clearTimeout($contents.data('tailTimer'));
+    if ($contents.data('tailRequest')) {
+      $contents.data('tailRequest').abort();
+    }
+
+    var request = $.ajax({
+      url: '/execute/tail',
+      data: {
+        mname: menuName,
+        gname: groupName,
+        cursor: $('#execute-output-' + itemId).attr('data-cursor')
+      },
+      success: function(data) {
+        chaperone.utils.showLogOutput(itemId, data, data.cursor);
+
+        /* Schedule another update, if we're still on the page. Check less
+           often when no job is running, in case one is started elsewhere. */
         if ($('#contents-' + itemId).length) {
-          setTimeout(function() {
+          var delay = data.more ? 0 : (data.active ? 2000 : 10000);
+          $contents.data('tailTimer', setTimeout(function() {
             chaperone.utils.updateLogView(itemId, menuName, groupName);
-          }, 2000);
+          }, delay));
         }
       },
       error: function(jqxhr, status, error) {
-        chaperone.utils.ajaxError(jqxhr, status, error);
+        if (status != 'abort') {
+          chaperone.utils.ajaxError(jqxhr, status, error);
+        }
+      },
+      complete: function() {
+        $contents.removeData('tailRequest');
       }
     });
+    $contents.data('tailRequest', request);
   },
 };
 
@@ -374,18 +510,22 @@ chaperone.addInitFunction(function() {
       $('#vcenter-errors').text('Host, user, and password required.');
       return;
     }
-    var values = { fid: fieldId, vcenter: vcenter, username: username,
-                   password: password, datacenter: '' };
+    var values = { vcenter: vcenter, username: username,
+                   password: password, datacenter: '', cluster: '' };
 
     /* Clear out input field's choices. */
     $field.empty();
+    var fields = {};
+    fields[fieldId] = $field[0];
     var targetId = $field.attr('data-target');
     if (targetId) {
-      /* Clear out target input field's choices. */
+      /* Clear out target input field's choices, and load them along, with
+       * all choices until narrowed down by the field's value. */
       var $target = $('#id_' + targetId);
       $target.empty();
+      fields[targetId] = $target[0];
     }
-    chaperone.utils.loadVCenterOptions(this, $field[0], values);
+    chaperone.utils.loadVCenterOptions(this, fields, values);
   });
 
   /* Populate vCenter target input field's choices. */
@@ -407,13 +547,15 @@ chaperone.addInitFunction(function() {
     }
     var datacenter = $('#id_' + ftype + '_vc_datacenter').val();
     var targetId = $select.attr('data-target');
-    var values = { fid: targetId, vcenter: vcenter, username: username,
+    var values = { vcenter: vcenter, username: username,
                    password: password, datacenter: datacenter, cluster: '' };
 
     /* Clear out target input field's choices. */
     var $target = $('#id_' + targetId);
     $target.empty();
-    chaperone.utils.loadVCenterOptions(this, $target[0], values);
+    var fields = {};
+    fields[targetId] = $target[0];
+    chaperone.utils.loadVCenterOptions(this, fields, values);
   });
 
   /* Reset vCenter target input fields. */
@@ -612,11 +754,27 @@ chaperone.addInitFunction(function() {
 
     var message = 'Starting ' + $button.text().toLowerCase() + '...\n';
     var mgid = $button.attr('data-mgid');
+    var menuName = $('#execute-form input[name="mname"]').val();
+    var groupName = $('#execute-form input[name="gname"]').val();
     $('#execute-output-' + mgid).text(message);
     $.ajax({
       url: '/execute/run',
       type: 'POST',
       data: values,
+      success: function(data) {
+        if (data.errors && data.errors.length) {
+          $('#execute-output-' + mgid).text(data.errors.join('\n'));
+          return;
+        }
+        /* Follow the new run's output without waiting for the next check,
+           unless it's being pushed. */
+        if (chaperone.utils.logStream) {
+          return;
+        }
+        setTimeout(function() {
+          chaperone.utils.updateLogView(mgid, menuName, groupName);
+        }, 1000);
+      },
       error: function(jqxhr, status, error) {
         chaperone.utils.ajaxError(jqxhr, status, error);
       },
@@ -629,6 +787,25 @@ chaperone.addInitFunction(function() {
     return false;
   });
 
+  /* Show a past run's output. */
+  $(document).on('change', 'div.run-history select.run-select', function(event) {
+    var mgid = $(this).attr('data-mgid');
+    var runId = $(this).val();
+    if (!runId) {
+      $('#execute-history-' + mgid).hide();
+      $('button.run-more[data-mgid="' + mgid + '"]').hide();
+      return;
+    }
+    chaperone.utils.loadRunPage(mgid, runId, 0);
+  });
+
+  $(document).on('click', 'div.run-history button.run-more', function(event) {
+    var $button = $(this);
+    chaperone.utils.loadRunPage($button.attr('data-mgid'),
+                                $button.attr('data-run'),
+                                parseInt($button.attr('data-offset'), 10));
+  });
+
   /* Change active leftnav button. */
   $('#leftnav div.leftnav-btn').click(function(event) {
     chaperone.utils.openLeftnavMenu(this.id);
@@ -0,0 +1,469 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import copy
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from chaperone import views
+from chaperone.utils import esxi, getters, host_facts, inventory, options
+from chaperone.utils import parallel, schema, sessions, yaml
+
+
+class YamlLoadTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, 'test.yml')
+
+    def tearDown(self):
+        yaml.invalidate()
+        shutil.rmtree(self.dir)
+
+    def write(self, content, fname=None):
+        with open(fname or self.fname, 'w') as fp:
+            fp.write(content)
+
+    def test_python_string_tags(self):
+        # As dumped by the default Python 2 dumper.
+        self.write("host: !!python/unicode 'vc.example.com'\n"
+                   "user: !!python/str 'admin'\n")
+        self.assertEqual(yaml.load(self.fname),
+                         {'host': u'vc.example.com', 'user': 'admin'})
+
+    def test_malformed_file(self):
+        self.write('a: [\n')
+        self.assertEqual(yaml.load(self.fname), {})
+
+    def test_cached_until_changed(self):
+        self.write('a: 1\n')
+        generation = yaml.generation(self.fname)
+        shared = yaml.load(self.fname, shared=True)
+        self.assertIs(yaml.load(self.fname, shared=True), shared)
+        self.assertIsNot(yaml.load(self.fname), shared)
+        self.assertEqual(yaml.generation(self.fname), generation)
+        self.write('a: 22\n')
+        self.assertEqual(yaml.load(self.fname), {'a': 22})
+        self.assertNotEqual(yaml.generation(self.fname), generation)
+
+    def test_include_changes_reload(self):
+        include = os.path.join(self.dir, 'include.yml')
+        self.write('b: 1\n', include)
+        self.write('a: !include %s\n' % include)
+        self.assertEqual(yaml.load(self.fname), {'a': {'b': 1}})
+        self.write('b: 22\n', include)
+        self.assertEqual(yaml.load(self.fname), {'a': {'b': 22}})
+
+
+SCHEMA_MENUS = [
+    {'Prepare': [
+        {'vCenter': [
+            {'Management': [
+                {'Login': [
+                    {'id': 'mgmt_vc', 'options': 'mgmt_vc'},
+                    {'id': 'mgmt_dc', 'options': 'mgmt_vc_datacenter'}]}]}]},
+        {'Hosts': [
+            {'ESXi': [
+                {'Hosts': [
+                    {'id': 'esxi', 'input': 'multiform', 'min_items': 2,
+                     'items': [{'id': 'esxi_ip'}]}]}]}]}]},
+    {'Deploy': [
+        {'Management': [{'id': 'deploy', 'commands': ['true']}]}]},
+]
+
+
+class SchemaTest(TestCase):
+    def setUp(self):
+        self.schema = schema.Schema(SCHEMA_MENUS)
+
+    def test_containers_and_groups(self):
+        self.assertEqual(self.schema.containers,
+                         [('vCenter', ['Management']), ('Hosts', ['ESXi'])])
+        self.assertEqual(self.schema.find_container('ESXi'), 'Hosts')
+        self.assertIsNone(self.schema.sections('Hosts', 'Nope'))
+        sections = self.schema.sections('vCenter', 'Management')
+        sections[0]['Login'].pop()
+        self.assertEqual(
+            len(self.schema.sections('vCenter', 'Management')[0]['Login']), 2)
+
+    def test_attributes(self):
+        self.assertEqual(self.schema.group_of('mgmt_dc'),
+                         ('vCenter', 'Management'))
+        self.assertEqual(sorted(self.schema.group_attribute_ids('Hosts',
+                                                                'ESXi')),
+                         ['esxi', 'esxi_ip_0', 'esxi_ip_1'])
+        self.assertIsNone(self.schema.attribute('nope'))
+
+    def test_options_and_actions(self):
+        self.assertEqual(self.schema.option_attribute_ids('mgmt_vc_datacenter'),
+                         ['mgmt_dc'])
+        self.assertEqual(self.schema.option_fields('vCenter', 'Management'),
+                         set(['mgmt_vc', 'mgmt_vc_datacenter']))
+        self.assertEqual(self.schema.actions('Deploy', 'Management'),
+                         [{'id': 'deploy', 'commands': ['true']}])
+
+    def test_digest_follows_group_definition(self):
+        menus = copy.deepcopy(SCHEMA_MENUS)
+        menus[0]['Prepare'][1]['Hosts'][0]['ESXi'][0]['Hosts'][0][
+            'min_items'] = 3
+        changed = schema.Schema(menus)
+        self.assertEqual(changed.group_digest('vCenter', 'Management'),
+                         self.schema.group_digest('vCenter', 'Management'))
+        self.assertNotEqual(changed.group_digest('Hosts', 'ESXi'),
+                            self.schema.group_digest('Hosts', 'ESXi'))
+
+
+class YamlDumpTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, 'test.yml')
+
+    def tearDown(self):
+        yaml.invalidate()
+        shutil.rmtree(self.dir)
+
+    def test_replaces_file_keeping_mode(self):
+        yaml.dump(self.fname, {'a': 1})
+        os.chmod(self.fname, 0600)
+        inode = os.stat(self.fname).st_ino
+        self.assertEqual(yaml.load(self.fname), {'a': 1})
+        yaml.dump(self.fname, {'a': 2})
+        self.assertEqual(yaml.load(self.fname), {'a': 2})
+        self.assertNotEqual(os.stat(self.fname).st_ino, inode)
+        self.assertEqual(os.stat(self.fname).st_mode & 0777, 0600)
+        self.assertEqual(os.listdir(self.dir), ['test.yml'])
+
+    def test_failed_dump_leaves_file(self):
+        yaml.dump(self.fname, {'a': 1})
+        self.assertRaises(Exception, yaml.dump, self.fname, {'a': object()})
+        self.assertEqual(yaml.load(self.fname), {'a': 1})
+        self.assertEqual(os.listdir(self.dir), ['test.yml'])
+
+
+def _store_options(prefix):
+    for i in range(20):
+        options.store({'%s%d' % (prefix, i): []})
+
+
+class OptionsCacheTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.vcenter = os.path.join(self.dir, 'vcenter.yml')
+        self.override = override_settings(
+            VCENTER_SETTINGS=self.vcenter,
+            OPTIONS_CACHE=os.path.join(self.dir, 'options_cache.yml'))
+        self.override.enable()
+        yaml.dump(self.vcenter, {'comp_vc': 'vc1.example.com'})
+
+    def tearDown(self):
+        self.override.disable()
+        yaml.invalidate()
+        shutil.rmtree(self.dir)
+
+    def test_options_from_other_vcenter_ignored(self):
+        options.store({'comp_vc_datacenters': ['dc1']})
+        self.assertEqual(options.get_cached(['comp_vc_datacenters']),
+                         {'comp_vc_datacenters': ['dc1']})
+        yaml.dump(self.vcenter, {'comp_vc': 'vc2.example.com'})
+        self.assertEqual(options.get_cached(['comp_vc_datacenters']), {})
+        self.assertEqual(options.peek(['comp_vc_datacenters']), {})
+
+    def test_options_obtained_before_save_not_stored(self):
+        source = options.get_source()
+        yaml.dump(self.vcenter, {'comp_vc': 'vc2.example.com'})
+        options.store({'comp_vc_datacenters': ['dc1']}, source=source)
+        self.assertEqual(options.get_cached(['comp_vc_datacenters']), {})
+
+    def test_options_obtained_before_invalidate_not_stored(self):
+        options.store({'comp_vc_datacenters': ['dc1']})
+        started = time.time()
+        options.invalidate(['comp_vc_datacenters'])
+        options.store({'comp_vc_datacenters': ['dc1']}, started=started)
+        self.assertEqual(options.peek(['comp_vc_datacenters']), {})
+        options.store({'comp_vc_datacenters': ['dc2']}, started=time.time())
+        self.assertEqual(options.peek(['comp_vc_datacenters']),
+                         {'comp_vc_datacenters': ['dc2']})
+
+    def test_processes_keep_each_others_options(self):
+        processes = [multiprocessing.Process(target=_store_options,
+                                             args=(prefix,))
+                     for prefix in ('a', 'b')]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(len(yaml.load(settings.OPTIONS_CACHE)), 40)
+
+
+class GettersAnswersTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.override = override_settings(
+            ANSWER_FILE_DIR=self.dir, ANSWER_FILE_DEFAULT='answers.yml')
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        yaml.invalidate()
+        shutil.rmtree(self.dir)
+
+    def test_answers_read_from_answer_file_dir(self):
+        yaml.dump(os.path.join(self.dir, 'answers.yml'),
+                  {'esxi_host2_ip': '10.0.0.2', 'esxi_host1_ip': '10.0.0.1',
+                   'esxi_host3_ip': ''})
+        self.assertEqual(getters._get_esxi_hosts(), ['10.0.0.1', '10.0.0.2'])
+
+
+class InventorySnapshotsTest(TestCase):
+    def setUp(self):
+        self.start = inventory.Inventory.start
+        # Keep the snapshots from calling on vCenter.
+        inventory.Inventory.start = lambda snapshot: None
+        self.override = override_settings(VCENTER_INVENTORY_MAX=2,
+                                          VCENTER_INVENTORY_LOAD_TIMEOUT=0)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        inventory.Inventory.start = self.start
+        inventory._SNAPSHOTS.clear()
+
+    def test_least_recently_used_snapshot_dropped(self):
+        for host in ('vc1', 'vc2', 'vc1', 'vc3'):
+            inventory.get_inventory(host, 'user', u'p\xe4ss', port=443)
+            time.sleep(0.01)
+        self.assertEqual(sorted(s.host for s in inventory._SNAPSHOTS.values()),
+                         ['vc1', 'vc3'])
+
+
+class EsxiParseTest(TestCase):
+    def test_parse_devices(self):
+        output = ('Device,DisplayName,Size,IsSSD\n'
+                  'naa.1,Local disk,40960,true\n'
+                  'mpx.vmhba32,USB,,false\n'
+                  ',Nameless,10,false\n')
+        self.assertEqual(esxi.parse_devices(output), [
+            {'device': 'naa.1', 'display_name': 'Local disk', 'size': 40960,
+             'is_ssd': True},
+            {'device': 'mpx.vmhba32', 'display_name': 'USB', 'size': 0,
+             'is_ssd': False}])
+
+    def test_parse_nics(self):
+        output = ('Name,MACAddress,Driver,LinkStatus,Speed\n'
+                  'vmnic0,00:50:56:00:00:01,e1000,Up,1000\n'
+                  'vmnic1,00:50:56:00:00:02,e1000,Down,N/A\n')
+        self.assertEqual([(n['name'], n['link'], n['speed'])
+                          for n in esxi.parse_nics(output)],
+                         [('vmnic0', 'Up', 1000), ('vmnic1', 'Down', 0)])
+
+    def test_parse_version(self):
+        output = ('Build,Patch,Product,Update,Version\n'
+                  'Releasebuild-3620759,0,VMware ESXi,2,6.0.0\n')
+        self.assertEqual(esxi.parse_version(output), {
+            'product': 'VMware ESXi', 'version': '6.0.0', 'update': '2',
+            'build': 'Releasebuild-3620759'})
+        self.assertEqual(esxi.parse_version(''), {})
+
+
+def _store_host_facts(prefix):
+    for i in range(20):
+        host_facts.store({'%s%d' % (prefix, i): {'devices': []}})
+
+
+class HostFactsTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'host_facts.yml')
+        self.override = override_settings(HOST_FACTS_CACHE=self.filename)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        yaml.invalidate()
+        shutil.rmtree(self.dir)
+
+    def test_processes_keep_each_others_facts(self):
+        processes = [multiprocessing.Process(target=_store_host_facts,
+                                             args=(prefix,))
+                     for prefix in ('a', 'b')]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(len(yaml.load(self.filename)), 40)
+
+    def test_failed_hosts_not_probed_again_until_error_ttl(self):
+        probed = []
+        def collect_facts(hosts, username, password):
+            probed.append(sorted(hosts))
+            return {}, dict((host, IOError('unreachable')) for host in hosts)
+        collect_facts_orig = esxi.collect_facts
+        esxi.collect_facts = collect_facts
+        refreshed = []
+        refresh_orig = host_facts.refresh
+        host_facts.refresh = lambda hosts, *args: refreshed.extend(hosts)
+        try:
+            self.assertEqual(host_facts.get_facts(['h1'], 'root', 'pw'), {})
+            self.assertEqual(host_facts.get_facts(['h1'], 'root', 'pw'), {})
+            self.assertEqual(probed, [['h1']])
+            self.assertEqual(refreshed, [])
+            with override_settings(HOST_FACTS_ERROR_TTL=0):
+                time.sleep(0.01)
+                self.assertEqual(host_facts.get_facts(['h1'], 'root', 'pw'),
+                                 {})
+            self.assertEqual(probed, [['h1']])
+            self.assertEqual(refreshed, ['h1'])
+        finally:
+            esxi.collect_facts = collect_facts_orig
+            host_facts.refresh = refresh_orig
+
+    def test_failure_keeps_facts(self):
+        host_facts.store({'h1': {'devices': []}})
+        host_facts.store({}, {'h1': IOError('unreachable')})
+        self.assertEqual(host_facts.get_facts(['h1'], 'root', 'pw'),
+                         {'h1': {'devices': []}})
+
+
+def _sleeper(seconds):
+    return lambda: (time.sleep(seconds), seconds)[1]
+
+
+class RunAllTest(TestCase):
+    def test_results_and_errors(self):
+        def fail():
+            raise ValueError('failed')
+        results, errors = parallel.run_all({'a': lambda: 1, 'b': fail})
+        self.assertEqual(results, {'a': 1})
+        self.assertEqual(errors.keys(), ['b'])
+        self.assertIsInstance(errors['b'], ValueError)
+
+    def test_call_timeout_counts_from_start(self):
+        # c waits for a thread behind a and b, longer than call_timeout.
+        results, errors = parallel.run_all(
+            {'a': _sleeper(0.3), 'b': _sleeper(0.3), 'c': _sleeper(0.3),
+             'd': _sleeper(2)}, workers=3, call_timeout=0.5)
+        self.assertEqual(sorted(results), ['a', 'b', 'c'])
+        self.assertIsInstance(errors['d'], multiprocessing.TimeoutError)
+
+    def test_timeout(self):
+        start = time.time()
+        results, errors = parallel.run_all(
+            {'a': _sleeper(0.1), 'b': _sleeper(2)}, timeout=0.3)
+        self.assertEqual(results, {'a': 0.1})
+        self.assertIsInstance(errors['b'], multiprocessing.TimeoutError)
+        self.assertLess(time.time() - start, 1)
+
+
+class _ServiceInstance(object):
+    def CurrentTime(self):
+        return 0
+
+
+class SessionPoolTest(TestCase):
+    def setUp(self):
+        self.logins = []
+        self.logouts = []
+        self.connect = sessions.connect
+        # Stand in for pyVim.connect, without a vCenter.
+        fake = type('connect', (object,), {})()
+        fake.SmartConnect = lambda **kwargs: (
+            self.logins.append(kwargs['host']) or _ServiceInstance())
+        fake.SmartConnectNoSSL = fake.SmartConnect
+        fake.Disconnect = self.logouts.append
+        sessions.connect = fake
+        self.pool = sessions.SessionPool(max_sessions=2, idle_timeout=600,
+                                         keepalive=120, wait=0.1)
+
+    def tearDown(self):
+        sessions.connect = self.connect
+
+    def test_sessions_reused(self):
+        session = self.pool.acquire('vc1', 'user', 'password')
+        self.pool.release(session)
+        self.assertIs(self.pool.acquire('vc1', 'user', 'password'), session)
+        self.assertEqual(self.logins, ['vc1'])
+
+    def test_other_password_not_shared(self):
+        self.pool.release(self.pool.acquire('vc1', 'user', 'password'))
+        self.pool.acquire('vc1', 'user', u'p\xe4ssword')
+        self.assertEqual(self.logins, ['vc1', 'vc1'])
+
+    def test_idle_session_closed_for_another(self):
+        self.pool.release(self.pool.acquire('vc1', 'user', 'password'))
+        self.pool.acquire('vc2', 'user', 'password')
+        self.pool.acquire('vc3', 'user', 'password')
+        self.assertEqual(len(self.logouts), 1)
+        self.assertRaises(sessions.PoolExhausted, self.pool.acquire,
+                          'vc4', 'user', 'password')
+
+
+class OptionsBatchTest(TestCase):
+    def setUp(self):
+        getters.get_test_names = lambda: {'b': None, 'a': None}
+        getters.get_test_login = lambda: None
+        getters.get_test_broken = lambda: 1 / 0
+
+    def tearDown(self):
+        for name in ('names', 'login', 'broken'):
+            delattr(getters, 'get_test_%s' % name)
+
+    def test_options_and_errors_by_field(self):
+        request = RequestFactory().get('/options/batch', {'fid': [
+            'test_names', 'test_login', 'test_broken', 'test_nope']})
+        data = json.loads(views.list_options_batch(request).content)
+        self.assertEqual(data['options'], {'test_names': ['a', 'b']})
+        self.assertEqual(sorted(data['errors']),
+                         ['test_broken', 'test_login', 'test_nope'])
+        self.assertEqual(data['errors']['test_nope'], ['Unknown field.'])
+
+    def test_fields_share_a_session(self):
+        logins = []
+        connect = sessions.connect
+        fake = type('connect', (object,), {})()
+        fake.SmartConnect = lambda **kwargs: (
+            logins.append(kwargs['host']) or _ServiceInstance())
+        fake.SmartConnectNoSSL = fake.SmartConnect
+        fake.Disconnect = lambda service_instance: None
+        sessions.connect = fake
+        pool = sessions._POOL
+        sessions._POOL = sessions.SessionPool(
+            max_sessions=4, idle_timeout=600, keepalive=120, wait=0.1)
+        def get_options():
+            with getters.vcenter_connection('vc1', 'user', 'password',
+                                            port=443) as service_instance:
+                time.sleep(0.05)
+                return {'a': None}
+        for name in ('x', 'y', 'z'):
+            setattr(getters, 'get_test_%s' % name, get_options)
+        try:
+            request = RequestFactory().get('/options/batch', {'fid': [
+                'test_x', 'test_y', 'test_z']})
+            data = json.loads(views.list_options_batch(request).content)
+            self.assertEqual(sorted(data['options']),
+                             ['test_x', 'test_y', 'test_z'])
+            self.assertEqual(logins, ['vc1'])
+        finally:
+            for name in ('x', 'y', 'z'):
+                delattr(getters, 'get_test_%s' % name)
+            sessions._POOL = pool
+            sessions.connect = connect
@@ -29,6 +29,10 @@ urlpatterns = patterns('',
     url(r'^login$', views.login, name='login'),
     url(r'^logout$', views.logout, name='logout'),
     url(r'^options$', login_required(views.list_options), name='options'),
+    url(r'^options/batch$', login_required(views.list_options_batch),
+        name='options_batch'),
+    url(r'^options/invalidate$', login_required_ajax(views.invalidate_options),
+        name='invalidate_options'),
     url(r'^savevc$', login_required_ajax(views.save_vcenter), name='savevc'),
     url(r'^vcenter$', login_required(views.vcenter_settings), name='vcenter'),
     url(r'^prepare/', include('prepare.urls', namespace='prepare')),
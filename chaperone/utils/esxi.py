@@ -0,0 +1,162 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#
+# Facts about ESXi hosts, collected with esxcli over SSH from many hosts at a
+# time.
+import csv
+import logging
+import StringIO
+
+from django.conf import settings
+
+from chaperone.utils import parallel
+from chaperone.utils import ssh
+
+LOG = logging.getLogger(__name__)
+
+# Defaults for settings of the same names.
+ESXI_MAX_PARALLEL = 8
+# Seconds to wait for a host to answer.
+ESXI_COMMAND_TIMEOUT = 60
+
+DEVICE_LIST_CMD = 'esxcli --formatter=csv storage core device list'
+NIC_LIST_CMD = 'esxcli --formatter=csv network nic list'
+VERSION_CMD = 'esxcli --formatter=csv system version get'
+
+
+class CommandError(Exception):
+    """An ESXi command failed."""
+    pass
+
+
+def _setting(name):
+    return getattr(settings, name, globals()[name])
+
+
+def run_commands(host, username, password, commands):
+    """Runs the commands one after another on the host, over a pooled SSH
+    connection, returns their outputs.
+    """
+    timeout = _setting('ESXI_COMMAND_TIMEOUT')
+    pool = ssh.get_pool()
+    outputs = []
+    for command in commands:
+        status, output, error = pool.exec_command(host, username, password,
+                                                  command, timeout=timeout)
+        if status != 0:
+            raise CommandError('%s failed on %s: %s' % (command, host,
+                                                        error.strip()))
+        outputs.append(output)
+    return outputs
+
+
+def run_command(host, username, password, command):
+    """Runs the command on the host over SSH, returns its output."""
+    return run_commands(host, username, password, [command])[0]
+
+
+def _rows(output):
+    # Return the rows of esxcli CSV output as dicts keyed by column.
+    return list(csv.DictReader(StringIO.StringIO(output)))
+
+
+def parse_devices(output):
+    """Returns the storage devices in the CSV output of esxcli storage core
+    device list, as dicts with the device name, size in MB, and whether it's
+    an SSD.
+    """
+    devices = []
+    for row in _rows(output):
+        if not row.get('Device'):
+            continue
+        try:
+            size = int(row.get('Size') or 0)
+        except ValueError:
+            size = 0
+        devices.append({
+            'device': row['Device'],
+            'display_name': row.get('DisplayName', ''),
+            'size': size,
+            'is_ssd': (row.get('IsSSD') or '').lower() == 'true',
+        })
+    return devices
+
+
+def parse_nics(output):
+    """Returns the physical NICs in the CSV output of esxcli network nic
+    list, as dicts with the NIC name, MAC address, driver, link status and
+    speed in Mbps.
+    """
+    nics = []
+    for row in _rows(output):
+        if not row.get('Name'):
+            continue
+        try:
+            speed = int(row.get('Speed') or 0)
+        except ValueError:
+            speed = 0
+        nics.append({
+            'name': row['Name'],
+            'mac': row.get('MACAddress', ''),
+            'driver': row.get('Driver', ''),
+            'link': row.get('LinkStatus') or row.get('Link', ''),
+            'speed': speed,
+        })
+    return nics
+
+
+def parse_version(output):
+    """Returns the product, version, update and build in the CSV output of
+    esxcli system version get.
+    """
+    for row in _rows(output):
+        return {
+            'product': row.get('Product', ''),
+            'version': row.get('Version', ''),
+            'update': row.get('Update', ''),
+            'build': row.get('Build', ''),
+        }
+    return {}
+
+
+def get_facts(host, username, password):
+    """Returns facts about the host: its storage 'devices', see
+    parse_devices(), physical 'nics', see parse_nics(), and ESXi 'version',
+    see parse_version().
+    """
+    devices, nics, version = run_commands(
+        host, username, password, [DEVICE_LIST_CMD, NIC_LIST_CMD,
+                                   VERSION_CMD])
+    return {
+        'devices': parse_devices(devices),
+        'nics': parse_nics(nics),
+        'version': parse_version(version),
+    }
+
+
+def collect_facts(hosts, username, password):
+    """Gets facts about all the given hosts at the same time, see
+    get_facts().
+
+    Returns (facts, errors), dicts keyed by host: the facts of each host that
+    answered, and the exception for each host that didn't.
+    """
+    calls = dict((host, lambda host=host: get_facts(host, username,
+                                                     password))
+                 for host in set(hosts) if host)
+    # Each host's connection and commands time out on their own, so hosts
+    # waiting for a free worker aren't given up on.
+    return parallel.run_all(calls, workers=_setting('ESXI_MAX_PARALLEL'))
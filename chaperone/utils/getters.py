@@ -17,22 +17,27 @@
 # get_foos() returns a dict of the foo objects keyed by name. Used to populate
 # options for fields with attribute "options: foos".
 from __future__ import division
-import fcntl
+import hashlib
 import inspect
 import logging
 import os
 import sys
-import yaml
-import paramiko
+import threading
 import re
 from requests import exceptions as requests_exceptions
 
 from django.conf import settings
 
+from chaperone.utils import host_facts
+from chaperone.utils import inventory
+from chaperone.utils import sessions
+from chaperone.utils import yaml
+from prepare.answers import get_answer_store
 from pyVmomi import vim, vmodl
 from pyVim import connect
 from pyVim.connect import SmartConnect, SmartConnectNoSSL
 
+import contextlib
 import json, time
 
 LOG = logging.getLogger(__name__)
@@ -55,12 +60,41 @@ MGMT_VC_PASSWORD = 'mgmt_vc_password'
 MGMT_VC_USERNAME = 'mgmt_vc_username'
 MGMT_VC = 'mgmt_vc'
 
-answerfilepath='/var/lib/chaperone/answerfile.yml'
-answer_file_dictionary = yaml.load(answerfilepath)
+# Maximum number of objects per property collector page.
+RETRIEVE_PAGE_SIZE = 1000
 
-adminfilepath='/var/lib/chaperone-admin/answerfile.yml'
-admin_answer_file_dictionary = yaml.load(adminfilepath)
+# Kinds of answer file vCenter objects listed by query_inventory().
+INVENTORY_TYPES = {
+    'cluster': [vim.ClusterComputeResource],
+    'datacenter': [vim.Datacenter],
+    'datastore': [vim.Datastore],
+    'host': [vim.HostSystem],
+    'network': [vim.dvs.DistributedVirtualPortgroup, vim.Network],
+    'resource_pool': [vim.ResourcePool],
+}
+# Seconds a query_inventory() traversal is reused.
+INVENTORY_QUERY_TTL = 10
 
+# { (vcenter, username, password digest): (time, names by kind) }
+_INVENTORY_QUERY = {}
+_INVENTORY_QUERY_LOCK = threading.Lock()
+
+# Admin answer file, unless set in ADMIN_ANSWER_FILE.
+ADMIN_ANSWER_FILE = '/var/lib/chaperone-admin/answerfile.yml'
+
+
+def _answers():
+    # Return the saved answers, from the configured answer store for the
+    # answer file in ANSWER_FILE_DIR.
+    return get_answer_store().load()
+
+
+def _admin_answers():
+    # Return the saved admin answers. The file is parsed on first use and
+    # again only when it changes; the content is shared by all getters, so
+    # it must not be modified.
+    return yaml.load(getattr(settings, 'ADMIN_ANSWER_FILE', ADMIN_ANSWER_FILE),
+                     shared=True)
 
 
 def _get_vcenter_data():
@@ -69,31 +103,60 @@ def _get_vcenter_data():
         LOG.info('No file %s' % filename)
         return {}
 
-    with open(filename, 'r') as fp:
-        fcntl.flock(fp, fcntl.LOCK_SH)
-        file_contents = fp.read()
-        fcntl.flock(fp, fcntl.LOCK_UN)
-    return yaml.load(file_contents)
+    return yaml.load(filename)
 
 
-def vcenter_connection(vcenter, username, password):
-    """Returns a vCenter service instance, connected with the given login
-    information.
+@contextlib.contextmanager
+def vcenter_connection(vcenter, username, password, port=None, verify=True):
+    """Borrows a pooled vCenter service instance, connected with the given
+    login information, for the duration of the block. The service instance is
+    None if it can't connect.
     """
     if not all([vcenter, username, password]):
         LOG.error('vCenter host, username, and password required')
-        return None
+        yield None
+        return
+    if port is None:
+        port = settings.VCENTER_PORT
+
+    pool = sessions.get_pool()
+    session = None
     try:
-        service_instance = connect.SmartConnect(host=vcenter, user=username,
-                                                pwd=password,
-                                                port=settings.VCENTER_PORT)
+        session = pool.acquire(vcenter, username, password, port=port,
+                               verify=verify)
     except vim.fault.InvalidLogin as e:
         LOG.error('Could not connect to %s: %s' % (vcenter, e.msg))
-        return None
     except requests_exceptions.ConnectionError as e:
         LOG.error('Could not connect to %s: %s' % (vcenter, e.message))
-        return None
-    return service_instance
+    except sessions.PoolExhausted as e:
+        LOG.error('Could not connect to %s: %s' % (vcenter, e))
+    if session is None:
+        yield None
+        return
+
+    try:
+        yield session.service_instance
+    except:
+        # Don't reuse a session that may be broken.
+        pool.discard(session)
+        raise
+    pool.release(session)
+
+
+def _get_login(vcenter_field=None, username_field=None, password_field=None,
+               datacenter_field=None, cluster_field=None, vcenter=None,
+               username=None, password=None, datacenter=None, cluster=None):
+    # Return vCenter login information and location, using the saved vCenter
+    # settings for the values not given.
+    values = [vcenter, username, password, datacenter, cluster]
+    if None in values:
+        vcenter_data = _get_vcenter_data()
+        fields = [vcenter_field, username_field, password_field,
+                  datacenter_field, cluster_field]
+        for i, field in enumerate(fields):
+            if values[i] is None and field:
+                values[i] = vcenter_data.get(field)
+    return values
 
 
 def get_comp_vc():
@@ -132,39 +195,90 @@ def get_mgmt_vc_password():
     return { vcenter_data.get(MGMT_VC_PASSWORD, ''): None }
 
 
+def _collect(content, filter_spec):
+    # Run a property collector query and return (object, properties) pairs.
+    # Results come back a page at a time, so the number of calls depends on
+    # the size of the inventory in pages, not in objects.
+    collector = content.propertyCollector
+    options = vmodl.query.PropertyCollector.RetrieveOptions(
+        maxObjects=RETRIEVE_PAGE_SIZE)
+    result = collector.RetrievePropertiesEx([filter_spec], options)
+    objects = []
+    while result:
+        for obj_content in result.objects:
+            props = dict((prop.name, prop.val)
+                         for prop in obj_content.propSet or [])
+            objects.append((obj_content.obj, props))
+        if not result.token:
+            break
+        result = collector.ContinueRetrievePropertiesEx(result.token)
+    return objects
+
+
+def _filter_spec(obj_specs, obj_types, path_set):
+    # Return a filter spec collecting only the properties in path_set.
+    prop_specs = [vmodl.query.PropertyCollector.PropertySpec(
+                      type=obj_type, pathSet=path_set, all=False)
+                  for obj_type in obj_types]
+    return vmodl.query.PropertyCollector.FilterSpec(objectSet=obj_specs,
+                                                    propSet=prop_specs)
+
+
+def _retrieve_view(content, root, obj_types, path_set):
+    # Return (object, properties) for every object of the given types under
+    # root, in one paged query over a container view.
+    view = content.viewManager.CreateContainerView(root, obj_types, True)
+    try:
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseView', path='view', skip=False,
+            type=vim.view.ContainerView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+            obj=view, skip=True, selectSet=[traversal_spec])
+        return _collect(content, _filter_spec([obj_spec], obj_types,
+                                              path_set))
+    finally:
+        view.Destroy()
+
+
+def _retrieve_objects(content, objs, obj_type, path_set):
+    # Return (object, properties) for each of the given objects, in one
+    # paged query.
+    if not objs:
+        return []
+    obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=False)
+                 for obj in objs]
+    return _collect(content, _filter_spec(obj_specs, [obj_type], path_set))
+
+
 def _get_datacenters(content=None, vcenter_field=None, username_field=None,
                      password_field=None, datacenter_field=None, vcenter=None,
                      username=None, password=None, datacenter=None):
     if not content:
         LOG.debug('_get_datacenters: %s, %s, %s, %s' % (vcenter, username,
                                                         password, datacenter))
-        if not all([vcenter, username, password, datacenter]):
-            vcenter_data = _get_vcenter_data()
-        if vcenter is None:
-            vcenter = vcenter_data.get(vcenter_field)
-        if username is None:
-            username = vcenter_data.get(username_field)
-        if password is None:
-            password = vcenter_data.get(password_field)
-        if datacenter is None:
-            datacenter = vcenter_data.get(datacenter_field)
-
-        service_instance = vcenter_connection(vcenter, username, password)
-        if not service_instance:
-            return None
-        content = service_instance.RetrieveContent()
-        connect.Disconnect
-
-    dcview = content.viewManager.CreateContainerView(content.rootFolder,
-                                                     [vim.Datacenter], True)
-    datacenters = dcview.view
-    dcview.Destroy()
+        vcenter, username, password, datacenter, _ = _get_login(
+            vcenter_field=vcenter_field, username_field=username_field,
+            password_field=password_field, datacenter_field=datacenter_field,
+            vcenter=vcenter, username=username, password=password,
+            datacenter=datacenter)
+
+        snapshot = inventory.get_inventory(vcenter, username, password)
+        if snapshot:
+            return snapshot.datacenters(datacenter)
+        with vcenter_connection(vcenter, username,
+                                password) as service_instance:
+            if not service_instance:
+                return None
+            return _get_datacenters(
+                content=service_instance.RetrieveContent(),
+                datacenter=datacenter)
 
     datacenters_by_name = {}
-    for dc in datacenters:
-        if datacenter and dc.name != datacenter:
+    for dc, props in _retrieve_view(content, content.rootFolder,
+                                    [vim.Datacenter], ['name']):
+        if datacenter and props['name'] != datacenter:
             continue
-        datacenters_by_name[dc.name] = dc
+        datacenters_by_name[props['name']] = dc
     return datacenters_by_name
 
 
@@ -203,40 +317,58 @@ def _get_clusters(content=None, vcenter_field=None, username_field=None,
     if not content:
         LOG.debug('_get_clusters: %s, %s, %s, %s' % (vcenter, username,
                                                      password, datacenter))
-        if not all([vcenter, username, password, datacenter]):
-            vcenter_data = _get_vcenter_data()
-        if vcenter is None:
-            vcenter = vcenter_data.get(vcenter_field)
-        if username is None:
-            username = vcenter_data.get(username_field)
-        if password is None:
-            password = vcenter_data.get(password_field)
-        if datacenter is None:
-            datacenter = vcenter_data.get(datacenter_field)
-        if cluster is None:
-            cluster = vcenter_data.get(cluster_field)
-
-        service_instance = vcenter_connection(vcenter, username, password)
-        if not service_instance:
-            return None
-        content = service_instance.RetrieveContent()
-        connect.Disconnect
+        vcenter, username, password, datacenter, cluster = _get_login(
+            vcenter_field=vcenter_field, username_field=username_field,
+            password_field=password_field, datacenter_field=datacenter_field,
+            cluster_field=cluster_field, vcenter=vcenter, username=username,
+            password=password, datacenter=datacenter, cluster=cluster)
+
+        snapshot = inventory.get_inventory(vcenter, username, password)
+        if snapshot:
+            return snapshot.clusters(datacenter, cluster)
+        with vcenter_connection(vcenter, username,
+                                password) as service_instance:
+            if not service_instance:
+                return None
+            return _get_clusters(content=service_instance.RetrieveContent(),
+                                 datacenter=datacenter, cluster=cluster)
 
-    datacenters = _get_datacenters(content=content, datacenter=datacenter)
     clusters_by_name = {}
-    for dc_name, dc in datacenters.items():
-        if datacenter and dc_name != datacenter:
-            continue
-        clusterview = content.viewManager.CreateContainerView(
-            dc, [vim.ClusterComputeResource], True)
-        clusters = clusterview.view
-        clusterview.Destroy()
+    for cl, props in _cluster_properties(content, datacenter, cluster,
+                                         ['name']):
+        clusters_by_name[props['name']] = cl
+    return clusters_by_name
 
-        for cl in clusters:
-            if cluster and cl.name != cluster:
+
+def _cluster_properties(content, datacenter, cluster, path_set):
+    # Return (cluster, properties) for the clusters in the datacenter, or in
+    # all datacenters, optionally limited to the given cluster.
+    if datacenter:
+        roots = _get_datacenters(content=content,
+                                 datacenter=datacenter).values()
+    else:
+        roots = [content.rootFolder]
+    path_set = sorted(set(path_set) | set(['name']))
+
+    clusters = []
+    for root in roots:
+        for cl, props in _retrieve_view(content, root,
+                                        [vim.ClusterComputeResource],
+                                        path_set):
+            if cluster and props['name'] != cluster:
                 continue
-            clusters_by_name[cl.name] = cl
-    return clusters_by_name
+            clusters.append((cl, props))
+    return clusters
+
+
+def _host_properties(content, datacenter, cluster, path_set):
+    # Return (host, properties) for the hosts in the given cluster, or in all
+    # clusters of the datacenter.
+    hosts = set()
+    for _, props in _cluster_properties(content, datacenter, cluster,
+                                        ['host']):
+        hosts.update(props.get('host') or [])
+    return _retrieve_objects(content, list(hosts), vim.HostSystem, path_set)
 
 
 def get_comp_vc_cluster(vcenter=None, username=None, password=None,
@@ -267,44 +399,52 @@ def get_mgmt_vc_cluster(vcenter=None, username=None, password=None,
         password=password, datacenter=datacenter, cluster=cluster)
 
 
-def _get_hosts(vcenter_field=None, username_field=None, password_field=None,
-               datacenter_field=None, cluster_field=None, vcenter=None,
-               username=None, password=None, datacenter=None, cluster=None):
-    if not all([vcenter, username, password, datacenter, cluster]):
-        vcenter_data = _get_vcenter_data()
-    if vcenter is None:
-        vcenter = vcenter_data.get(vcenter_field)
-    if username is None:
-        username = vcenter_data.get(username_field)
-    if password is None:
-        password = vcenter_data.get(password_field)
-    if datacenter is None:
-        datacenter = vcenter_data.get(datacenter_field)
-    if cluster is None:
-        cluster = vcenter_data.get(cluster_field)
-
-    service_instance = vcenter_connection(vcenter, username, password)
-    if not service_instance:
-        return None
-    content = service_instance.RetrieveContent()
-    connect.Disconnect
+def _get_hosts(content=None, vcenter_field=None, username_field=None,
+               password_field=None, datacenter_field=None, cluster_field=None,
+               vcenter=None, username=None, password=None, datacenter=None,
+               cluster=None):
+    if not content:
+        vcenter, username, password, datacenter, cluster = _get_login(
+            vcenter_field=vcenter_field, username_field=username_field,
+            password_field=password_field, datacenter_field=datacenter_field,
+            cluster_field=cluster_field, vcenter=vcenter, username=username,
+            password=password, datacenter=datacenter, cluster=cluster)
+
+        snapshot = inventory.get_inventory(vcenter, username, password)
+        if snapshot:
+            return snapshot.hosts(datacenter, cluster)
+        with vcenter_connection(vcenter, username,
+                                password) as service_instance:
+            if not service_instance:
+                return None
+            return _get_hosts(content=service_instance.RetrieveContent(),
+                              datacenter=datacenter, cluster=cluster)
 
-    clusters = _get_clusters(content=content, datacenter=datacenter,
-                             cluster=cluster)
     hosts_by_name = {}
-    for cl_name, cl in clusters.items():
-        if cluster and cl_name != cluster:
-            continue
-        hostsview = content.viewManager.CreateContainerView(
-            cl, [vim.HostSystem], True)
-        hosts = hostsview.view
-        hostsview.Destroy()
-
-        for host in hosts:
-            hosts_by_name[host.name] = host
+    for host, props in _host_properties(content, datacenter, cluster,
+                                        ['name']):
+        hosts_by_name[props['name']] = host
     return hosts_by_name
 
 
+def _get_host_resources(content, datacenter, cluster, prop, obj_type):
+    # Return a dict of the objects, keyed by name, in the given host property
+    # (e.g. 'datastore') of the cluster's hosts, or None if there are no
+    # hosts.
+    hosts = _host_properties(content, datacenter, cluster, [prop])
+    if not hosts:
+        return None
+    objs = set()
+    for _, props in hosts:
+        objs.update(props.get(prop) or [])
+
+    objs_by_name = {}
+    for obj, props in _retrieve_objects(content, list(objs), obj_type,
+                                        ['name']):
+        objs_by_name[props['name']] = obj
+    return objs_by_name
+
+
 def get_comp_vc_hosts(vcenter=None, username=None, password=None,
                       datacenter=None, cluster=None):
     """Returns a dict of hosts in the saved compute vCenter cluster."""
@@ -329,19 +469,21 @@ def _get_datastores(vcenter_field=None, username_field=None,
                     password_field=None, datacenter_field=None,
                     cluster_field=None, vcenter=None, username=None,
                     password=None, datacenter=None, cluster=None):
-    hosts = _get_hosts(
+    vcenter, username, password, datacenter, cluster = _get_login(
         vcenter_field=vcenter_field, username_field=username_field,
         password_field=password_field, datacenter_field=datacenter_field,
         cluster_field=cluster_field, vcenter=vcenter, username=username,
         password=password, datacenter=datacenter, cluster=cluster)
-    if not hosts:
-        return None
-    datastores_by_name = {}
 
-    for host in hosts.values():
-        for datastore in host.datastore:
-            datastores_by_name[datastore.name] = datastore
-    return datastores_by_name
+    snapshot = inventory.get_inventory(vcenter, username, password)
+    if snapshot:
+        return snapshot.host_resources('datastore', datacenter, cluster)
+    with vcenter_connection(vcenter, username, password) as service_instance:
+        if not service_instance:
+            return None
+        return _get_host_resources(service_instance.RetrieveContent(),
+                                   datacenter, cluster, 'datastore',
+                                   vim.Datastore)
 
 
 def get_comp_vc_datastores(vcenter=None, username=None, password=None,
@@ -369,19 +511,21 @@ def get_mgmt_vc_datastores(vcenter=None, username=None, password=None,
 def _get_networks(vcenter_field=None, username_field=None, password_field=None,
                   datacenter_field=None, cluster_field=None, vcenter=None,
                   username=None, password=None, datacenter=None, cluster=None):
-    hosts = _get_hosts(
+    vcenter, username, password, datacenter, cluster = _get_login(
         vcenter_field=vcenter_field, username_field=username_field,
         password_field=password_field, datacenter_field=datacenter_field,
         cluster_field=cluster_field, vcenter=vcenter, username=username,
         password=password, datacenter=datacenter, cluster=cluster)
-    if not hosts:
-        return None
-    networks_by_name = {}
 
-    for host in hosts.values():
-        for network in host.network:
-            networks_by_name[network.name] = network
-    return networks_by_name
+    snapshot = inventory.get_inventory(vcenter, username, password)
+    if snapshot:
+        return snapshot.host_resources('network', datacenter, cluster)
+    with vcenter_connection(vcenter, username, password) as service_instance:
+        if not service_instance:
+            return None
+        return _get_host_resources(service_instance.RetrieveContent(),
+                                   datacenter, cluster, 'network',
+                                   vim.Network)
 
 
 def get_comp_vc_networks(vcenter=None, username=None, password=None,
@@ -465,217 +609,191 @@ def get_mgmt_vc_cluster_value():
     vcenter_data = _get_vcenter_data()
     return vcenter_data.get(MGMT_VC_CLUSTER, '')
 
+def _get_esxi_hosts():
+    # Return the IP addresses of the ESXi hosts in the answer file, i.e.,
+    # esxi_host<n>_ip, in order.
+    hosts = []
+    for key, value in _answers().items():
+        m = re.match(r'^esxi_host(\d+)_ip$', key)
+        if m and value:
+            hosts.append((int(m.group(1)), value))
+    return [value for _, value in sorted(hosts)]
+
+def _disk_options(devices):
+    # Return disk options keyed like '<size>GB(<device>)', with sizes in MB.
+    # Local naa disks are listed if there are any, else mpx ones over 1GB.
+    naa = {}
+    mpx = {}
+    for device in devices:
+        name = device['device']
+        size = device['size']
+        if name.startswith('naa.'):
+            naa[str(round(size / 1024)) + 'GB(' + name + ')'] = str(size)
+        elif name.startswith('mpx.') and size > 1024:
+            mpx[str(size / 1024) + 'GB(' + name + ')'] = str(size)
+    return naa or mpx
+
+def collect_disk_sizes(hosts=None):
+    """Returns disk options of the given ESXi hosts, by default all hosts in
+    the answer file, keyed by host. Disks are read from the host facts cache;
+    hosts not in it yet are probed at the same time.
+    """
+    if hosts is None:
+        hosts = _get_esxi_hosts()
+    answers = _answers()
+    username = answers["esxi_host1_username"]
+    password = answers["esxi_host1_password"]
+    facts = host_facts.get_facts(hosts, username, password)
+    return dict((host, _disk_options(facts.get(host, {}).get('devices', [])))
+                for host in hosts)
+
 def get_disk1_size():
-    return get_disk_size(answer_file_dictionary["esxi_host1_ip"])
-    
+    return get_disk_size(_answers()["esxi_host1_ip"])
+
 def get_disk2_size():
-    return get_disk_size(answer_file_dictionary["esxi_host2_ip"])
-    
+    return get_disk_size(_answers()["esxi_host2_ip"])
+
 def get_disk3_size():
-    return get_disk_size(answer_file_dictionary["esxi_host3_ip"])
-    
+    return get_disk_size(_answers()["esxi_host3_ip"])
+
 def get_disk4_size():
-    
-    return get_disk_size(answer_file_dictionary["esxi_host4_ip"])
+    return get_disk_size(_answers()["esxi_host4_ip"])
 
-    
 def get_disk_size(hostip):
-    """Returns disk size .""" 
-       
-    username= answer_file_dictionary["esxi_host1_username"]
-    password= answer_file_dictionary["esxi_host1_password"]
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.load_system_host_keys()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostip, 22, username, password)
-        LOG.debug('SSH connection to the host %s is succesfull' % hostip)
-    except Exception as e:
-        changed = False
-        LOG.debug('SSH conection to the remote host failed.') 
-    devices = {}
-    test_cmd = "esxcli storage core device list | grep -E 'Devfs Path:'"
-    tstdin, tstdout, tstderr = ssh.exec_command(test_cmd)
-    toutput  = tstdout.read()
-    
-    LOG.debug('Physical {}-{}'.format(toutput, type(toutput)))
-    if 'mpx' in toutput:
-        cmd = "esxcli storage core device list | grep -E 'Size:|Is SSD:|mpx'"
-        LOG.debug('Executing %s for host %s' %(cmd,hostip))
-        
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        if len(stderr.read()) != 0:
-            changed = False
-        else:
-            output  = stdout.read()
-            output = output.replace("\n","")
-            LOG.debug("the command output is {0}".format(output))
-            list = output.split("(")
-            list.pop(0)
-            LOG.debug("the list is {0}".format(list))
-            for i in list:
-                m = re.match("(mpx\.\w+(\:\w+)+)\)\s+Size:\s(\d+)", i)
-                if m and int(m.group(3)) > 1024:
-                    in_gb = int(m.group(3))/1024
-                    club = str(in_gb)+'GB('+m.group(1)+')'
-                    devices[club] = m.group(3)
-
-    if 'naa' in toutput:
-        cmd = "esxcli storage core device list | grep -E 'Size:|Is SSD:|naa'"
-        LOG.debug('Executing %s for host %s' %(cmd,hostip))
-        devices = {}
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        if len(stderr.read()) != 0:
-            changed = False
-        else:
-            output  = stdout.read()
-            output = output.replace("\n","")
-            list = output.split("(")            
-            for i in list:
-                m = re.match("(naa\.\w+)\)\s+Size:\s(\d+)",i)                
-                if m:
-                    in_gb = int(m.group(2))/1024
-                    club = str(round(in_gb))+'GB('+m.group(1)+')'
-                    devices[club] = m.group(2)
-    
+    """Returns disk size ."""
+    # Probe all the answer file hosts together the first time, since their
+    # disks are usually asked for one after another.
+    hosts = _get_esxi_hosts()
+    if hostip not in hosts:
+        hosts.append(hostip)
+    devices = collect_disk_sizes(hosts)[hostip]
     LOG.debug('The device id with their sizes are')
     LOG.debug(devices)
     return devices
 
 def get_mgmt_az():
     az = {}
-    az[answer_file_dictionary["mgmt_az_name"]] = ""
+    az[_answers()["mgmt_az_name"]] = ""
     return az
 
 def get_compute_az():
     az = {}
-    for count in range(1, int(admin_answer_file_dictionary["compute_az"])+1):
-        az[answer_file_dictionary["compute_az_{}_name".format(count)]] = ""
+    answers = _answers()
+    for count in range(1, int(_admin_answers()["compute_az"])+1):
+        az[answers["compute_az_{}_name".format(count)]] = ""
     return az
 def get_compute_hosts():
     hosts = {}
-    for count in range(1, int(admin_answer_file_dictionary["no_compute_cluster_name"])+1):
-        for host_number in range(1, int(admin_answer_file_dictionary["no_hosts_per_compute_cluster"])+1):
-            hosts[answer_file_dictionary["esxi_compute{}_host{}_ip".format(count,host_number)]] = ""
+    answers = _answers()
+    admin_answers = _admin_answers()
+    for count in range(1, int(admin_answers["no_compute_cluster_name"])+1):
+        for host_number in range(1, int(admin_answers["no_hosts_per_compute_cluster"])+1):
+            hosts[answers["esxi_compute{}_host{}_ip".format(count,host_number)]] = ""
     return hosts
 def get_edge_hosts():
     host= {}
-    host[answer_file_dictionary["nsx_edge_ips"]] = ""
+    host[_answers()["nsx_edge_ips"]] = ""
     return host
 
+def _query_answer_file_inventory():
+    # Return names of all objects of the INVENTORY_TYPES kinds in the answer
+    # file vCenter, keyed by kind, from one traversal, or None if it can't
+    # connect.
+    obj_types = []
+    for types in INVENTORY_TYPES.values():
+        obj_types.extend(t for t in types if t not in obj_types)
+    with answer_file_vcenter_connection() as content:
+        if not content:
+            return None
+        objects = _retrieve_view(content, content.rootFolder, obj_types,
+                                 ['name'])
+    names = dict((kind, []) for kind in INVENTORY_TYPES)
+    for obj, props in objects:
+        for kind, types in INVENTORY_TYPES.items():
+            if isinstance(obj, tuple(types)):
+                names[kind].append(props['name'])
+    LOG.debug("Got {} objects from the answer file vCenter".format(
+        len(objects)))
+    return names
+
+def query_inventory(kinds=None):
+    """Returns names of the objects of the given kinds, by default all
+    INVENTORY_TYPES, in the answer file vCenter, keyed by kind. All kinds are
+    obtained in one traversal, which concurrent and later calls reuse for
+    INVENTORY_QUERY_TTL seconds. Returns None if it can't connect.
+    """
+    if kinds is None:
+        kinds = INVENTORY_TYPES.keys()
+    vcenter, username, password = _get_answer_file_login()
+    snapshot = inventory.get_inventory(vcenter, username, password,
+                                       port=443, verify=False)
+    if snapshot:
+        return dict((kind, snapshot.names(INVENTORY_TYPES[kind]))
+                    for kind in kinds)
+
+    key = (vcenter, username, hashlib.sha1(password or '').hexdigest())
+    # Held while querying, so that concurrent callers wait for the query
+    # under way instead of starting their own.
+    with _INVENTORY_QUERY_LOCK:
+        cached = _INVENTORY_QUERY.get(key)
+        if cached is None or time.time() - cached[0] > INVENTORY_QUERY_TTL:
+            names = _query_answer_file_inventory()
+            if names is None:
+                return None
+            cached = (time.time(), names)
+            _INVENTORY_QUERY.clear()
+            _INVENTORY_QUERY[key] = cached
+    return dict((kind, list(cached[1][kind])) for kind in kinds)
+
+def _get_object_names(kind):
+    # Return a dict keyed by the names of all objects of the kind in the
+    # answer file vCenter.
+    names = query_inventory([kind])
+    if names is None:
+        return {}
+    return dict((name, "") for name in names[kind])
+
 def get_datastore_objs():
-    content = get_vcenter_connection()
-    obj = {}
-    ds_obj = {}
-    container = content.viewManager.CreateContainerView(content.rootFolder,
-                                                         [vim.Datastore], True)
-    LOG.debug("Connected to container  !")
-
-    for managed_object_ref in container.view:
-        obj.update({managed_object_ref: managed_object_ref.name})
-    LOG.debug("Got DS obj {} !".format(obj))
-
-    datastores = obj.values()
-    for value in datastores:
-        ds_obj[value] = ""
-    return ds_obj
+    return _get_object_names('datastore')
 
 def get_datacenter_objs():
-    content = get_vcenter_connection()
-    obj = {}
-    dc_obj = {}
-    container = content.viewManager.CreateContainerView(content.rootFolder,
-                                                         [vim.Datacenter], True)
-    LOG.debug("Connected to container  !")
-
-    for managed_object_ref in container.view:
-        obj.update({managed_object_ref: managed_object_ref.name})
-    LOG.debug("Got DC obj {} !".format(obj))
-
-    datacenters = obj.values()
-    for value in datacenters:
-        dc_obj[value] = ""
-    return dc_obj
+    return _get_object_names('datacenter')
 
 def get_network_objs():
-    content = get_vcenter_connection()
-    obj = {}
-    nw_obj = {}
-    container = content.viewManager.CreateContainerView(content.rootFolder,
-                                                         [vim.dvs.DistributedVirtualPortgroup, vim.Network], True)
-    LOG.debug("Connected to container  !")
-
-    for managed_object_ref in container.view:
-        obj.update({managed_object_ref: managed_object_ref.name})
-    LOG.debug("Got Network obj {} !".format(obj))
-
-    network = obj.values()
-    for value in network:
-        nw_obj[value] = ""
-    return nw_obj
-
-def get_cluster_objs():    
-    content = get_vcenter_connection()
-    obj = {}
-    cl_obj = {}
-    container = content.viewManager.CreateContainerView(content.rootFolder,[vim.ClusterComputeResource], True)
-    LOG.debug("Connected to container  !")
-
-    for managed_object_ref in container.view:
-        obj.update({managed_object_ref: managed_object_ref.name})
-    LOG.debug("Got Cluster obj {} !".format(obj))
-
-    clusters = obj.values()
-    for value in clusters:
-        cl_obj[value] = ""
-    return cl_obj
-
-def get_resource_pool_objs():    
-    content = get_vcenter_connection()
-    obj = {'vim.ResourcePool:dummy': ''}
-    pool_obj = {}
-    container = content.viewManager.CreateContainerView(content.rootFolder,[vim.ResourcePool], True)
-    LOG.debug("Connected to container  !")
-
-    for managed_object_ref in container.view:
-        obj.update({managed_object_ref: managed_object_ref.name})
-    LOG.debug("Got Resource Pool obj {} !".format(obj))
-
-    pools = obj.values()
-    for value in pools:
-        pool_obj[value] = ""
-    return pool_obj
+    return _get_object_names('network')
 
+def get_cluster_objs():
+    return _get_object_names('cluster')
 
-def get_host_objs():    
-    content = get_vcenter_connection()
-    obj = {}
-    host_obj = {}
-    container = content.viewManager.CreateContainerView(content.rootFolder,[vim.HostSystem], True)
-    LOG.debug("Connected to container  !")
+def get_resource_pool_objs():
+    pool_obj = _get_object_names('resource_pool')
+    if pool_obj:
+        # Leave a blank choice for no resource pool.
+        pool_obj[""] = ""
+    return pool_obj
 
-    for managed_object_ref in container.view:
-        obj.update({managed_object_ref: managed_object_ref.name})
-    LOG.debug("Got ESXi obj {} !".format(obj))
+def get_host_objs():
+    return _get_object_names('host')
 
-    hosts = obj.values()
-    for value in hosts:
-        host_obj[value] = ""
-    return host_obj
+def _get_answer_file_login():
+    # Return host, username and password of the vCenter in the answer file.
+    answers = _answers()
+    return (answers["vcenter_host_ip"],
+            answers["vcenter_user"],
+            answers["vcenter_pwd"])
 
-def get_vcenter_connection():
-    """Returns vCenter connection obj .""" 
-    vcenter_ip = answer_file_dictionary["vcenter_host_ip"]
-    vcenter_username= answer_file_dictionary["vcenter_user"]
-    vcenter_password= answer_file_dictionary["vcenter_pwd"]
+@contextlib.contextmanager
+def answer_file_vcenter_connection():
+    """Borrows a pooled connection to the vCenter set in the answer file, and
+    yields its content, or None if it can't connect.
+    """
+    vcenter_ip, vcenter_username, vcenter_password = _get_answer_file_login()
 
-    try:
-        LOG.debug("Trying to connect to VCENTER SERVER . . .")
-        si = SmartConnectNoSSL(host=vcenter_ip, user=vcenter_username, pwd=vcenter_password, port=443)
-        LOG.debug("Connected to VCENTER SERVER !")
-    except IOError, e:
-        #pass
-	#atexit.register(Disconnect, si)
-	LOG.debug("Connection failed {0}")
-        module.fail_json(chagned=False, msg="Failed to connect vCenter")
-    return si.RetrieveContent()
+    LOG.debug("Trying to connect to VCENTER SERVER . . .")
+    with vcenter_connection(vcenter_ip, vcenter_username, vcenter_password,
+                            port=443, verify=False) as si:
+        if not si:
+            yield None
+        else:
+            LOG.debug("Connected to VCENTER SERVER !")
+            yield si.RetrieveContent()
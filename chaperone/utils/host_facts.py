@@ -0,0 +1,179 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#
+# Persistent cache of facts about ESXi hosts, see esxi.get_facts(). Hardware
+# and builds rarely change, so each host's facts are read from the cache.
+# Hosts are only probed when they aren't cached yet, and probed again in the
+# background once their facts are past the time to live. Hosts that can't be
+# probed are noted too, and only probed again in the background once a shorter
+# time to live has passed since, so views don't wait on them each time.
+# Processes sharing the
+# cache file take turns updating it, so none loses the others' facts.
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from chaperone.utils import esxi
+from chaperone.utils import yaml
+
+LOG = logging.getLogger(__name__)
+
+# Seconds that host facts are considered current, unless set in
+# HOST_FACTS_TTL.
+DEFAULT_TTL = 86400
+# Seconds until hosts that couldn't be probed are probed again, unless set in
+# HOST_FACTS_ERROR_TTL.
+DEFAULT_ERROR_TTL = 300
+
+# Hosts being probed again in the background.
+_REFRESHING = set()
+# Guards _REFRESHING.
+_LOCK = threading.Lock()
+
+
+def _get_filename():
+    return getattr(settings, 'HOST_FACTS_CACHE',
+                   os.path.join(settings.ANSWER_FILE_DIR, 'host_facts.yml'))
+
+
+def _get_ttl():
+    return getattr(settings, 'HOST_FACTS_TTL', DEFAULT_TTL)
+
+
+def _get_error_ttl():
+    return getattr(settings, 'HOST_FACTS_ERROR_TTL', DEFAULT_ERROR_TTL)
+
+
+def _digest(facts):
+    return hashlib.md5(json.dumps(facts, sort_keys=True)).hexdigest()
+
+
+def store(facts_by_host, errors_by_host=None):
+    """Saves the given facts, keyed by host, in the cache, and notes the
+    hosts that couldn't be probed, with their errors. Facts already cached for
+    those hosts are kept.
+    """
+    if not facts_by_host and not errors_by_host:
+        return
+    filename = _get_filename()
+    now = time.time()
+    with yaml.locked(filename):
+        cache = yaml.load(filename)
+        for host, facts in facts_by_host.items():
+            digest = _digest(facts)
+            entry = cache.get(host)
+            if entry and entry.get('hash') == digest:
+                entry['collected'] = now
+                entry.pop('error', None)
+                entry.pop('failed', None)
+                continue
+            if entry and 'facts' in entry:
+                LOG.info('Facts of host %s changed' % host)
+            cache[host] = { 'facts': facts, 'collected': now, 'hash': digest }
+        for host, error in (errors_by_host or {}).items():
+            entry = cache.setdefault(host, {})
+            entry['error'] = str(error)
+            entry['failed'] = now
+        yaml.dump(filename, cache)
+
+
+def collect(hosts, username, password):
+    """Probes the hosts at the same time and saves their facts. Returns the
+    facts of the hosts that answered, keyed by host.
+    """
+    facts, errors = esxi.collect_facts(hosts, username, password)
+    for host, error in errors.items():
+        LOG.error('Unable to get facts of host %s: %s' % (host, error))
+    store(facts, errors)
+    return facts
+
+
+def get_facts(hosts, username, password):
+    """Returns facts of the given hosts, keyed by host. Hosts not in the
+    cache are probed first; hosts whose facts are past their time to live are
+    included, and probed again in the background. Hosts that can't be probed
+    are left out, and only probed again in the background once the error time
+    to live has passed.
+    """
+    cache = yaml.load(_get_filename())
+    now = time.time()
+    facts = {}
+    missing = []
+    stale = []
+    for host in hosts:
+        entry = cache.get(host)
+        if not entry:
+            missing.append(host)
+            continue
+        if 'facts' in entry:
+            facts[host] = entry['facts']
+        # Hosts that failed lately aren't tried again until the error time to
+        # live has passed.
+        if now - entry.get('failed', 0) <= _get_error_ttl():
+            continue
+        if ('facts' not in entry or
+                now - entry.get('collected', 0) > _get_ttl()):
+            stale.append(host)
+    if missing:
+        facts.update(collect(missing, username, password))
+    if stale:
+        refresh(stale, username, password)
+    return facts
+
+
+def _refresh(hosts, username, password):
+    try:
+        collect(hosts, username, password)
+        LOG.debug('Facts of hosts %s refreshed' % ', '.join(hosts))
+    finally:
+        with _LOCK:
+            _REFRESHING.difference_update(hosts)
+
+
+def refresh(hosts, username, password):
+    """Probes the hosts again in the background, skipping those already
+    being probed.
+    """
+    with _LOCK:
+        hosts = [host for host in hosts if host not in _REFRESHING]
+        if not hosts:
+            return
+        _REFRESHING.update(hosts)
+    thread = threading.Thread(target=_refresh,
+                              args=(hosts, username, password),
+                              name='host-facts')
+    thread.daemon = True
+    thread.start()
+
+
+def invalidate(hosts=None):
+    """Drops cached facts of the given hosts, or of all hosts."""
+    filename = _get_filename()
+    with yaml.locked(filename):
+        if hosts is None:
+            cache = {}
+        else:
+            cache = yaml.load(filename)
+            for host in hosts:
+                cache.pop(host, None)
+        yaml.dump(filename, cache)
+    LOG.info('Cached facts of %s invalidated' % (
+        ', '.join(hosts) if hosts is not None else 'all hosts'))
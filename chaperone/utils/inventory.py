@@ -0,0 +1,365 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#
+# In-memory snapshots of vCenter inventories, so that the getters can answer
+# without calling on vCenter. A snapshot is loaded once, then kept current by
+# a background thread waiting on property collector updates, on a session
+# borrowed from the vCenter session pool for as long as the snapshot is kept.
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from chaperone.utils import sessions
+from pyVmomi import vim, vmodl
+
+LOG = logging.getLogger(__name__)
+
+# Defaults for settings of the same names.
+VCENTER_INVENTORY = True
+# Seconds to wait for a snapshot to load before calling on vCenter directly.
+VCENTER_INVENTORY_LOAD_TIMEOUT = 30
+# Seconds each wait for updates may block.
+VCENTER_INVENTORY_WAIT = 60
+# Seconds before reconnecting after the snapshot lost its session.
+VCENTER_INVENTORY_RETRY = 30
+# Seconds a snapshot is kept current after it was last used.
+VCENTER_INVENTORY_IDLE_TIMEOUT = 3600
+# Most snapshots kept at a time; the least recently used is dropped for a new
+# one.
+VCENTER_INVENTORY_MAX = 4
+
+# Properties kept for each type of object. Folders and parents are only kept
+# to find the datacenter an object is in.
+_PROPERTIES = [
+    (vim.Folder, ['name', 'parent']),
+    (vim.Datacenter, ['name', 'parent']),
+    (vim.ClusterComputeResource, ['name', 'parent', 'host']),
+    (vim.HostSystem, ['name', 'parent', 'datastore', 'network']),
+    (vim.Datastore, ['name', 'parent']),
+    (vim.Network, ['name', 'parent']),
+    (vim.ResourcePool, ['name', 'parent']),
+]
+
+
+def _setting(name):
+    return getattr(settings, name, globals()[name])
+
+
+def _kind(obj):
+    # Return the type in _PROPERTIES the object is kept as.
+    for obj_type, _ in _PROPERTIES:
+        if isinstance(obj, obj_type):
+            return obj_type
+    return None
+
+
+class _Index(object):
+    # Properties of the inventory objects, indexed by type.
+
+    def __init__(self):
+        # { object: { property: value } }
+        self.objects = {}
+        # { type: set([object, ...]) }
+        self.by_kind = dict((obj_type, set()) for obj_type, _ in _PROPERTIES)
+
+    def apply(self, update_set):
+        # Apply the object updates in a property collector update set.
+        for filter_update in update_set.filterSet or []:
+            for update in filter_update.objectSet or []:
+                obj = update.obj
+                kind = _kind(obj)
+                if kind is None:
+                    continue
+                if update.kind == 'leave':
+                    self.objects.pop(obj, None)
+                    self.by_kind[kind].discard(obj)
+                    continue
+                props = self.objects.setdefault(obj, {})
+                self.by_kind[kind].add(obj)
+                for change in update.changeSet or []:
+                    if change.op in ('remove', 'indirectRemove'):
+                        props.pop(change.name, None)
+                    else:
+                        props[change.name] = change.val
+
+
+class Inventory(object):
+    """Snapshot of a vCenter inventory, kept current in the background.
+    version counts the updates applied since the snapshot was loaded.
+    """
+
+    def __init__(self, host, user, password, port, verify):
+        self.host = host
+        self.user = user
+        self.port = port
+        self.verify = verify
+        self._password = password
+        self._index = _Index()
+        self._lock = threading.RLock()
+        self._loaded = threading.Event()
+        self.version = 0
+        # Time the snapshot was last known to match vCenter.
+        self.synced = None
+        # Time the snapshot last changed.
+        self.updated = None
+        self.last_used = time.time()
+        self.current = False
+        self.stopped = False
+        self.error = None
+
+    def start(self):
+        thread = threading.Thread(target=self._run,
+                                  name='inventory-%s' % self.host)
+        thread.daemon = True
+        thread.start()
+
+    def wait_loaded(self, timeout):
+        """Waits for the first load, returns whether the snapshot is
+        current.
+        """
+        self._loaded.wait(timeout)
+        return self.current
+
+    def age(self):
+        """Returns seconds since the snapshot was known to match vCenter."""
+        if self.synced is None:
+            return None
+        return time.time() - self.synced
+
+    def _run(self):
+        pool = sessions.get_pool()
+        while not self.stopped:
+            session = None
+            failed = False
+            try:
+                LOG.debug('Loading inventory of %s' % self.host)
+                session = pool.acquire(self.host, self.user, self._password,
+                                       port=self.port, verify=self.verify)
+                self._watch(session.service_instance.RetrieveContent())
+            except vim.fault.InvalidLogin as e:
+                LOG.error('Could not load inventory of %s: %s' % (self.host,
+                                                                  e.msg))
+                self.error = e.msg
+                self.stopped = True
+            except Exception as e:
+                LOG.error('Inventory of %s failed: %s' % (self.host, e))
+                self.error = str(e)
+                failed = True
+            finally:
+                self.current = False
+                # Don't keep anyone waiting for a snapshot that failed to
+                # load; they call on vCenter directly instead.
+                self._loaded.set()
+                if session is not None:
+                    if failed:
+                        pool.discard(session)
+                    else:
+                        pool.release(session)
+            if not self.stopped:
+                time.sleep(_setting('VCENTER_INVENTORY_RETRY'))
+
+    def _watch(self, content):
+        view = content.viewManager.CreateContainerView(
+            content.rootFolder, [obj_type for obj_type, _ in _PROPERTIES],
+            True)
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseView', path='view', skip=False,
+            type=vim.view.ContainerView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+            obj=view, skip=True, selectSet=[traversal_spec])
+        prop_specs = [vmodl.query.PropertyCollector.PropertySpec(
+                          type=obj_type, pathSet=path_set, all=False)
+                      for obj_type, path_set in _PROPERTIES]
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[obj_spec], propSet=prop_specs)
+        collector = content.propertyCollector
+        pc_filter = collector.CreateFilter(filter_spec, False)
+
+        options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=_setting('VCENTER_INVENTORY_WAIT'))
+        # Load into a new index, so that a reload replaces the old snapshot
+        # only when complete.
+        index = _Index()
+        version = ''
+        while not self.stopped:
+            if (time.time() - self.last_used >
+                    _setting('VCENTER_INVENTORY_IDLE_TIMEOUT')):
+                LOG.debug('Inventory of %s no longer used' % self.host)
+                self.stopped = True
+                break
+
+            update_set = collector.WaitForUpdatesEx(version, options)
+            with self._lock:
+                if update_set is not None:
+                    version = update_set.version
+                    index.apply(update_set)
+                    if self.current:
+                        self.version += 1
+                        self.updated = time.time()
+                if not self.current and not (update_set and
+                                             update_set.truncated):
+                    self._index = index
+                    self.version += 1
+                    self.updated = time.time()
+                    self.current = True
+                    self.error = None
+                    LOG.info('Loaded inventory of %s, %d objects' % (
+                        self.host, len(index.objects)))
+                self.synced = time.time()
+            self._loaded.set()
+
+        # The session goes back to the pool, without the filter and view.
+        pc_filter.Destroy()
+        view.Destroy()
+
+    def _name(self, obj):
+        return self._index.objects.get(obj, {}).get('name')
+
+    def _datacenter_name(self, obj):
+        # Return the name of the datacenter the object is in.
+        seen = set()
+        while obj is not None and obj not in seen:
+            if isinstance(obj, vim.Datacenter):
+                return self._name(obj)
+            seen.add(obj)
+            obj = self._index.objects.get(obj, {}).get('parent')
+        return None
+
+    def _clusters(self, datacenter, cluster):
+        clusters = []
+        for cl in self._index.by_kind[vim.ClusterComputeResource]:
+            if cluster and self._name(cl) != cluster:
+                continue
+            if datacenter and self._datacenter_name(cl) != datacenter:
+                continue
+            clusters.append(cl)
+        return clusters
+
+    def _hosts(self, datacenter, cluster):
+        hosts = set()
+        for cl in self._clusters(datacenter, cluster):
+            hosts.update(self._index.objects[cl].get('host') or [])
+        return [host for host in hosts if host in self._index.objects]
+
+    def _by_name(self, objs):
+        objs_by_name = {}
+        for obj in objs:
+            name = self._name(obj)
+            if name is not None:
+                objs_by_name[name] = obj
+        return objs_by_name
+
+    def datacenters(self, datacenter=None):
+        """Returns a dict of datacenters keyed by name, optionally limited to
+        the given datacenter.
+        """
+        with self._lock:
+            return self._by_name(
+                dc for dc in self._index.by_kind[vim.Datacenter]
+                if not datacenter or self._name(dc) == datacenter)
+
+    def clusters(self, datacenter=None, cluster=None):
+        """Returns a dict of clusters keyed by name, optionally only from the
+        given datacenter and limited to the given cluster.
+        """
+        with self._lock:
+            return self._by_name(self._clusters(datacenter, cluster))
+
+    def hosts(self, datacenter=None, cluster=None):
+        """Returns a dict of the hosts in the clusters, keyed by name."""
+        with self._lock:
+            return self._by_name(self._hosts(datacenter, cluster))
+
+    def host_resources(self, prop, datacenter=None, cluster=None):
+        """Returns a dict of the objects in the given host property, e.g.,
+        'datastore', of the hosts in the clusters, keyed by name, or None if
+        there are no hosts.
+        """
+        with self._lock:
+            hosts = self._hosts(datacenter, cluster)
+            if not hosts:
+                return None
+            objs = set()
+            for host in hosts:
+                objs.update(self._index.objects[host].get(prop) or [])
+            return self._by_name(objs)
+
+    def names(self, obj_types):
+        """Returns the names of all objects of the given types."""
+        with self._lock:
+            return [props['name']
+                    for obj, props in self._index.objects.items()
+                    if 'name' in props and isinstance(obj, tuple(obj_types))]
+
+
+_SNAPSHOTS = {}
+_SNAPSHOTS_LOCK = threading.Lock()
+
+
+def _make_room():
+    # Forget stopped snapshots, and stop the least recently used ones so that
+    # one more fits in VCENTER_INVENTORY_MAX. Called with the lock held.
+    for key, snapshot in _SNAPSHOTS.items():
+        if snapshot.stopped:
+            del _SNAPSHOTS[key]
+    by_use = sorted(_SNAPSHOTS.items(), key=lambda item: item[1].last_used)
+    excess = len(by_use) - max(1, _setting('VCENTER_INVENTORY_MAX')) + 1
+    for key, snapshot in by_use[:max(0, excess)]:
+        LOG.debug('Dropping inventory of %s to make room' % snapshot.host)
+        snapshot.stopped = True
+        del _SNAPSHOTS[key]
+
+
+def get_inventory(host, user, password, port=None, verify=True):
+    """Returns the current inventory snapshot of the vCenter, loading it the
+    first time, or None if there's no current snapshot, e.g., because it
+    couldn't be loaded in time.
+    """
+    if not _setting('VCENTER_INVENTORY') or not all([host, user, password]):
+        return None
+    if port is None:
+        port = settings.VCENTER_PORT
+
+    if isinstance(password, unicode):
+        digest = hashlib.sha1(password.encode('utf-8')).hexdigest()
+    else:
+        digest = hashlib.sha1(password).hexdigest()
+    key = (host, user, port, verify, digest)
+    with _SNAPSHOTS_LOCK:
+        snapshot = _SNAPSHOTS.get(key)
+        if snapshot is None or snapshot.stopped:
+            _make_room()
+            snapshot = Inventory(host, user, password, port, verify)
+            _SNAPSHOTS[key] = snapshot
+            snapshot.start()
+    snapshot.last_used = time.time()
+    if not snapshot.wait_loaded(_setting('VCENTER_INVENTORY_LOAD_TIMEOUT')):
+        return None
+    return snapshot
+
+
+def status():
+    """Returns the version and age in seconds of the inventory snapshots,
+    keyed by vCenter host.
+    """
+    with _SNAPSHOTS_LOCK:
+        snapshots = [s for s in _SNAPSHOTS.values() if not s.stopped]
+    return dict((s.host, { 'version': s.version, 'age': s.age(),
+                           'current': s.current, 'error': s.error })
+                for s in snapshots)
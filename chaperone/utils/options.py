@@ -0,0 +1,184 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#
+# Persistent cache of dynamically obtained options, see getters. Each field's
+# options are kept for a time to live, after which the stale options are still
+# used while they are obtained again in the background. Options are kept
+# along with the vCenter settings they were obtained with, and only used with
+# the same settings. Invalidated fields are marked with the time, so that
+# options obtained before then aren't stored.
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from chaperone.utils import getters
+from chaperone.utils import yaml
+
+LOG = logging.getLogger(__name__)
+
+# Seconds that options are considered current, unless set for the field in
+# OPTIONS_CACHE_TTL.
+DEFAULT_TTL = 300
+
+# Fields being obtained again in the background.
+_REFRESHING = set()
+# Guards _REFRESHING.
+_LOCK = threading.Lock()
+
+
+def _get_filename():
+    return getattr(settings, 'OPTIONS_CACHE',
+                   os.path.join(settings.ANSWER_FILE_DIR, 'options_cache.yml'))
+
+
+def _get_ttl(field_name):
+    ttls = getattr(settings, 'OPTIONS_CACHE_TTL', {})
+    return ttls.get(field_name, ttls.get('default', DEFAULT_TTL))
+
+
+def get_source():
+    """Returns a fingerprint of the current vCenter settings, which options
+    are obtained with.
+    """
+    vcenter = yaml.load(settings.VCENTER_SETTINGS, shared=True)
+    return hashlib.md5(json.dumps(vcenter, sort_keys=True, default=str)).hexdigest()
+
+
+def fetch_options(field_name):
+    """Returns sorted names of the options for the field, obtained from
+    getters.get_<field_name>().
+    """
+    fn_name = 'get_%s' % field_name
+    LOG.debug('Calling on %s to obtain options.' % fn_name)
+    fn = getattr(getters, fn_name)
+    options = fn()
+    opt_names = []
+    if options:
+        opt_names = options.keys()
+        opt_names.sort()
+    return opt_names
+
+
+def get_cached(field_names):
+    """Returns cached options for the given fields, keyed by field name.
+    Fields whose options are past their time to live are included, and their
+    options are obtained again in the background.
+    """
+    cache = yaml.load(_get_filename())
+    source = get_source()
+    now = time.time()
+    cached = {}
+    for field_name in field_names:
+        entry = cache.get(field_name)
+        if (not entry or 'options' not in entry or
+                entry.get('source') != source):
+            continue
+        cached[field_name] = entry.get('options', [])
+        if now - entry.get('updated', 0) > _get_ttl(field_name):
+            refresh(field_name)
+    return cached
+
+
+def peek(field_names):
+    """Returns cached options for the given fields, keyed by field name, as
+    get_cached() does, but without obtaining any again.
+    """
+    cache = yaml.load(_get_filename(), shared=True)
+    source = get_source()
+    return dict((field_name, list(cache[field_name].get('options', [])))
+                for field_name in field_names
+                if 'options' in cache.get(field_name, {}) and
+                cache[field_name].get('source') == source)
+
+
+def store(options_by_field, source=None, started=None):
+    """Saves the given options, keyed by field name, in the cache. The
+    options are dropped if they were obtained with other vCenter settings,
+    given by the get_source() from before they were obtained, than the
+    current ones, and a field's options are dropped if it was invalidated
+    since they started to be obtained, at time started.
+    """
+    if not options_by_field:
+        return
+    filename = _get_filename()
+    now = time.time()
+    with yaml.locked(filename):
+        current = get_source()
+        if source is not None and source != current:
+            LOG.debug('Options for %s obtained with previous vCenter '
+                      'settings not stored' % ', '.join(options_by_field))
+            return
+        cache = yaml.load(filename)
+        for field_name, opt_names in options_by_field.items():
+            invalidated = cache.get(field_name, {}).get('invalidated')
+            if (started is not None and invalidated is not None and
+                    invalidated >= started):
+                LOG.debug('Options for %s obtained before invalidation '
+                          'not stored' % field_name)
+                continue
+            cache[field_name] = { 'options': opt_names, 'updated': now,
+                                  'source': current }
+        yaml.dump(filename, cache)
+
+
+def _refresh(field_name):
+    try:
+        # Note the settings first, in case they're saved while obtaining.
+        source = get_source()
+        started = time.time()
+        store({ field_name: fetch_options(field_name) }, source=source,
+              started=started)
+        LOG.debug('Options for %s refreshed' % field_name)
+    except Exception as e:
+        LOG.error('Unable to refresh options for %s: %s' % (field_name, e))
+    finally:
+        with _LOCK:
+            _REFRESHING.discard(field_name)
+
+
+def refresh(field_name):
+    """Obtains options for the field again in the background, unless that's
+    already under way.
+    """
+    with _LOCK:
+        if field_name in _REFRESHING:
+            return
+        _REFRESHING.add(field_name)
+    thread = threading.Thread(target=_refresh, args=(field_name,),
+                              name='options-%s' % field_name)
+    thread.daemon = True
+    thread.start()
+
+
+def invalidate(field_names=None):
+    """Drops cached options for the given fields, or for all fields, and
+    options for them still being obtained.
+    """
+    filename = _get_filename()
+    now = time.time()
+    with yaml.locked(filename):
+        cache = yaml.load(filename)
+        for field_name in (field_names if field_names is not None
+                           else list(cache)):
+            cache[field_name] = { 'invalidated': now }
+        yaml.dump(filename, cache)
+    LOG.info('Cached options for %s invalidated' % (
+        ', '.join(field_names) if field_names is not None else 'all fields'))
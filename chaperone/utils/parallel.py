@@ -0,0 +1,99 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#
+# Run independent, mostly I/O bound calls, e.g. to vCenter or ESXi hosts, at the
+# same time on a bounded number of threads.
+import logging
+import multiprocessing
+import time
+from multiprocessing.pool import ThreadPool
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+
+
+def _timed(fn, key, started):
+    # Run the call, noting when it started.
+    started[key] = time.time()
+    return fn()
+
+
+def run_all(calls, workers=DEFAULT_WORKERS, timeout=None, call_timeout=None):
+    """Runs the callables in calls, a dict keyed by any name, at the same time
+    on at most the given number of threads.
+
+    Returns (results, errors), dicts keyed by the same names. errors has the
+    exception raised by each call that failed, or a multiprocessing
+    TimeoutError for calls that didn't finish within timeout seconds of all
+    of them, or within call_timeout seconds of their own start. Calls still
+    waiting for a thread when every thread is held by a call that timed out
+    time out as well. Calls that time out are left to finish in the
+    background.
+    """
+    results = {}
+    errors = {}
+    if not calls:
+        return results, errors
+
+    size = max(1, min(workers, len(calls)))
+    pool = ThreadPool(size)
+    try:
+        # { key: time the call started }
+        started = {}
+        pending = {}
+        for key, fn in calls.items():
+            pending[key] = pool.apply_async(_timed, (fn, key, started))
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        # Calls that timed out but still hold a thread.
+        abandoned = []
+        for key, async_result in pending.items():
+            while True:
+                now = time.time()
+                waits = []
+                if deadline is not None:
+                    waits.append(deadline - now)
+                if call_timeout is not None:
+                    start = started.get(key, now)
+                    waits.append(start + call_timeout - now)
+                    if key not in started and len(
+                            [a for a in abandoned if not a.ready()]) >= size:
+                        waits = [0]
+                wait = min(waits) if waits else None
+                if wait is not None and wait <= 0:
+                    if async_result.ready():
+                        break
+                    LOG.warn('%s did not finish in time' % key)
+                    errors[key] = multiprocessing.TimeoutError()
+                    abandoned.append(async_result)
+                    break
+                async_result.wait(wait)
+                if async_result.ready():
+                    break
+            if key in errors:
+                continue
+            try:
+                results[key] = async_result.get(0)
+            except Exception as e:
+                LOG.warn('%s failed: %s' % (key, e))
+                errors[key] = e
+    finally:
+        # Don't wait for calls that timed out.
+        pool.close()
+    return results, errors
@@ -0,0 +1,203 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#
+# Compiled form of ANSWER_FILE_BASE. The menus are walked once when the file
+# changes, and indexed so that a single group, attribute or action can be
+# looked up directly. See chaperone/local_settings.py.example for the schema.
+import copy
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from django.conf import settings
+
+from chaperone.utils import yaml
+
+LOG = logging.getLogger(__name__)
+
+_SCHEMA = None
+_SCHEMA_LOCK = threading.Lock()
+
+
+class Schema(object):
+    """Indexed model of the Prepare and action menus."""
+
+    def __init__(self, menus, generation=None):
+        self.menus = menus
+        self.generation = generation
+        # [(container_name, [group_name, ...])], in display order.
+        self.containers = []
+        # { (container_name, group_name): [{ 'Section': [...] }] }
+        self._sections = {}
+        # { (container_name, group_name): digest of its sections }
+        self._digests = {}
+        # { attr_id: (attr, container_name, group_name) }
+        self._attributes = {}
+        # { (container_name, group_name): [attr_id, ...] }
+        self._group_attributes = {}
+        # { (menu_name, group_name): [{ 'id': ... }] }
+        self._actions = {}
+        # { options_field: [attr_id, ...] }
+        self._options = {}
+        # { (container_name, group_name): set([options_field, ...]) }
+        self._group_options = {}
+        self._compile()
+
+    def _compile(self):
+        prepare_found = False
+        # [{ ... }]
+        for menu in self.menus:
+            # { 'Menu': [...] }
+            for menu_name, groups in menu.items():
+                if menu_name == settings.PREPARE_MENU:
+                    # Only the first Prepare menu is used.
+                    if not prepare_found:
+                        prepare_found = True
+                        self._compile_prepare(groups or [])
+                    continue
+                # [{ ... }]
+                for group in groups or []:
+                    # { 'Group': [...] }
+                    for gname, actions in group.items():
+                        self._actions.setdefault((menu_name, gname),
+                                                 actions or [])
+
+    def _compile_prepare(self, containers):
+        # [{ ... }]
+        for container in containers:
+            # { 'Container': [...] }
+            for cname, groups in container.items():
+                group_names = []
+                self.containers.append((cname, group_names))
+                # [{ ... }]
+                for group in groups or []:
+                    # { 'Group': [...] }
+                    for gname, sections in group.items():
+                        group_names.append(gname)
+                        sections = sections or []
+                        self._sections[(cname, gname)] = sections
+                        self._digests[(cname, gname)] = hashlib.md5(
+                            json.dumps(sections, sort_keys=True,
+                                       default=str)).hexdigest()
+                        for attr in self._iter_attributes(sections):
+                            self._add_attribute(attr, cname, gname)
+
+    def _iter_attributes(self, sections):
+        # [{ ... }]
+        for section in sections:
+            # { 'Section': [...] }
+            for attributes in section.values():
+                # [{ ... }]
+                for attr in attributes or []:
+                    yield attr
+
+    def _add_attribute(self, attr, cname, gname):
+        input_type = attr.get('input')
+        if input_type and input_type.lower() == 'multiform':
+            # Items are expanded with a numeric suffix, one per form.
+            for n in range(int(attr.get('min_items', 0))):
+                for item in attr.get('items', []):
+                    item_id = '%s_%d' % (item['id'], n)
+                    self._index_attribute(item_id, item, cname, gname)
+        self._index_attribute(attr['id'], attr, cname, gname)
+
+    def _index_attribute(self, attr_id, attr, cname, gname):
+        if attr_id in self._attributes:
+            LOG.warn('Attribute %s defined more than once in %s' %
+                     (attr_id, settings.ANSWER_FILE_BASE))
+        self._attributes[attr_id] = (attr, cname, gname)
+        self._group_attributes.setdefault((cname, gname), []).append(attr_id)
+        field_name = attr.get('options')
+        if field_name and not isinstance(field_name, list):
+            self._options.setdefault(field_name, []).append(attr_id)
+            self._group_options.setdefault((cname, gname), set()).add(
+                field_name)
+
+    def find_container(self, group_name):
+        """Returns name of the first container that has the given group."""
+        for cname, group_names in self.containers:
+            if group_name in group_names:
+                return cname
+        return None
+
+    def sections(self, container_name, group_name):
+        """Returns a copy of the sections in the given group, which is safe to
+        modify, or None if there is no such group.
+        """
+        sections = self._sections.get((container_name, group_name))
+        if sections is None:
+            return None
+        return copy.deepcopy(sections)
+
+    def group_digest(self, container_name, group_name):
+        """Returns a digest that changes whenever the definition of the group
+        changes.
+        """
+        return self._digests.get((container_name, group_name))
+
+    def has_attribute(self, attr_id):
+        return attr_id in self._attributes
+
+    def attribute(self, attr_id):
+        """Returns (attribute, container name, group name) for the attribute,
+        or None. The attribute metadata must not be modified.
+        """
+        return self._attributes.get(attr_id)
+
+    def group_of(self, attr_id):
+        """Returns (container name, group name) for the group that has the
+        attribute, or None.
+        """
+        found = self._attributes.get(attr_id)
+        if found is None:
+            return None
+        return found[1:]
+
+    def attribute_ids(self):
+        return self._attributes.keys()
+
+    def group_attribute_ids(self, container_name, group_name):
+        """Returns ids of the attributes in the group."""
+        return list(self._group_attributes.get((container_name, group_name),
+                                               []))
+
+    def option_attribute_ids(self, field_name):
+        """Returns ids of the attributes with "options: <field_name>"."""
+        return list(self._options.get(field_name, []))
+
+    def option_fields(self, container_name, group_name):
+        """Returns the options fields used by attributes in the group."""
+        return set(self._group_options.get((container_name, group_name), []))
+
+    def actions(self, menu_name, group_name):
+        """Returns a copy of the actions in the given non-Prepare group."""
+        return copy.deepcopy(self._actions.get((menu_name, group_name), []))
+
+
+def get_schema():
+    """Returns the compiled ANSWER_FILE_BASE, compiling it again only when
+    the file, or any file it includes, has changed.
+    """
+    global _SCHEMA
+    base = os.path.join(settings.ANSWER_FILE_DIR, settings.ANSWER_FILE_BASE)
+    generation = yaml.generation(base)
+    with _SCHEMA_LOCK:
+        if _SCHEMA is None or _SCHEMA.generation != generation:
+            LOG.debug('Compiling %s' % base)
+            _SCHEMA = Schema(yaml.load(base) or [], generation=generation)
+        return _SCHEMA
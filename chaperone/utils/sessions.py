@@ -0,0 +1,244 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#
+# Pool of logged in vCenter sessions, shared by the getters instead of logging
+# in for every call. Sessions are borrowed by one thread at a time, checked
+# before reuse when they have been idle for a while, logged out after being
+# idle for too long, and logged out when the process exits.
+import atexit
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from pyVim import connect
+
+LOG = logging.getLogger(__name__)
+
+# Defaults for settings of the same names.
+VCENTER_MAX_SESSIONS = 8
+# Seconds a session may be idle before it's logged out.
+VCENTER_SESSION_IDLE_TIMEOUT = 600
+# Seconds a session may be idle before it's checked, or kept alive.
+VCENTER_SESSION_KEEPALIVE = 120
+# Seconds to wait for a session when all are in use.
+VCENTER_SESSION_WAIT = 60
+
+
+class PoolExhausted(Exception):
+    """No vCenter session became available in time."""
+    pass
+
+
+class _Session(object):
+    def __init__(self, key, service_instance):
+        self.key = key
+        self.service_instance = service_instance
+        self.last_used = time.time()
+
+
+class SessionPool(object):
+    """Thread-safe pool of vCenter sessions, keyed on (host, user, port).
+    Sessions logged in with a different password are never shared.
+    """
+
+    def __init__(self, max_sessions, idle_timeout, keepalive, wait):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.wait = wait
+        # { key: [_Session, ...] }, sessions not in use.
+        self._idle = {}
+        # Number of sessions, in use or not, plus those being opened.
+        self._count = 0
+        self._cond = threading.Condition()
+        self._keepalive_thread = None
+        self._closed = False
+
+    def _key(self, host, user, password, port, verify):
+        password = password or ''
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        digest = hashlib.sha1(password).hexdigest()
+        return (host, user, port, verify, digest)
+
+    def acquire(self, host, user, password, port=443, verify=True):
+        """Returns a session, which must be given back with release()."""
+        key = self._key(host, user, password, port, verify)
+        deadline = time.time() + self.wait
+        session = None
+        with self._cond:
+            self._start_keepalive()
+            while True:
+                idle = self._idle.get(key)
+                if idle:
+                    session = idle.pop()
+                    break
+                if self._count < self.max_sessions:
+                    # Reserve a slot for a new session.
+                    self._count += 1
+                    break
+                if self._close_oldest_idle():
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolExhausted('All %d vCenter sessions in use' %
+                                        self.max_sessions)
+                self._cond.wait(remaining)
+
+        if session is not None:
+            if (time.time() - session.last_used < self.keepalive or
+                    self._is_alive(session)):
+                return session
+            LOG.debug('vCenter session to %s expired' % host)
+            self._logout(session)
+
+        try:
+            LOG.debug('Opening vCenter session to %s as %s' % (host, user))
+            if verify:
+                service_instance = connect.SmartConnect(
+                    host=host, user=user, pwd=password, port=port)
+            else:
+                service_instance = connect.SmartConnectNoSSL(
+                    host=host, user=user, pwd=password, port=port)
+        except:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+        return _Session(key, service_instance)
+
+    def release(self, session):
+        """Gives back a session obtained with acquire()."""
+        session.last_used = time.time()
+        with self._cond:
+            if self._closed:
+                self._count -= 1
+                self._logout(session)
+            else:
+                self._idle.setdefault(session.key, []).append(session)
+            self._cond.notify()
+
+    def discard(self, session):
+        """Logs out a session obtained with acquire(), instead of giving it
+        back, e.g., after it failed.
+        """
+        with self._cond:
+            self._count -= 1
+            self._cond.notify()
+        self._logout(session)
+
+    def _is_alive(self, session):
+        try:
+            session.service_instance.CurrentTime()
+            return True
+        except Exception as e:
+            LOG.debug('vCenter session failed health check: %s' % e)
+            return False
+
+    def _logout(self, session):
+        try:
+            connect.Disconnect(session.service_instance)
+        except Exception as e:
+            LOG.debug('Unable to log out of vCenter session: %s' % e)
+
+    def _close_oldest_idle(self):
+        # Log out the idle session unused for the longest time, to make room
+        # for another. Called with the lock held.
+        oldest = None
+        for sessions in self._idle.values():
+            for session in sessions:
+                if oldest is None or session.last_used < oldest.last_used:
+                    oldest = session
+        if oldest is None:
+            return False
+        self._idle[oldest.key].remove(oldest)
+        self._count -= 1
+        self._logout(oldest)
+        return True
+
+    def _start_keepalive(self):
+        # Called with the lock held.
+        if self._keepalive_thread is None:
+            self._keepalive_thread = threading.Thread(
+                target=self._keep_alive, name='vcenter-keepalive')
+            self._keepalive_thread.daemon = True
+            self._keepalive_thread.start()
+
+    def _keep_alive(self):
+        # Log out sessions idle for too long, and keep the others alive.
+        while not self._closed:
+            time.sleep(self.keepalive)
+            now = time.time()
+            expired = []
+            check = []
+            with self._cond:
+                for sessions in self._idle.values():
+                    for session in list(sessions):
+                        if now - session.last_used > self.idle_timeout:
+                            sessions.remove(session)
+                            self._count -= 1
+                            expired.append(session)
+                        elif now - session.last_used > self.keepalive:
+                            sessions.remove(session)
+                            check.append(session)
+                self._cond.notify_all()
+
+            for session in expired:
+                LOG.debug('Closing idle vCenter session %s' % (session.key,))
+                self._logout(session)
+            for session in check:
+                if self._is_alive(session):
+                    self.release(session)
+                else:
+                    self.discard(session)
+
+    def close_all(self):
+        """Logs out all idle sessions. Sessions in use are logged out when
+        they are given back.
+        """
+        with self._cond:
+            self._closed = True
+            sessions = [s for idle in self._idle.values() for s in idle]
+            self._idle = {}
+            self._count -= len(sessions)
+            self._cond.notify_all()
+        for session in sessions:
+            self._logout(session)
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    """Returns the process wide vCenter session pool."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = SessionPool(
+                getattr(settings, 'VCENTER_MAX_SESSIONS',
+                        VCENTER_MAX_SESSIONS),
+                getattr(settings, 'VCENTER_SESSION_IDLE_TIMEOUT',
+                        VCENTER_SESSION_IDLE_TIMEOUT),
+                getattr(settings, 'VCENTER_SESSION_KEEPALIVE',
+                        VCENTER_SESSION_KEEPALIVE),
+                getattr(settings, 'VCENTER_SESSION_WAIT',
+                        VCENTER_SESSION_WAIT))
+            atexit.register(_POOL.close_all)
+        return _POOL
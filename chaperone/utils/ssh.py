@@ -0,0 +1,237 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#
+# Pool of authenticated SSH connections to ESXi hosts, so that commands don't
+# each pay for a key exchange and login. A connection is shared by any number
+# of threads, each command running on its own exec channel. Connections idle
+# for too long are closed, and all are closed when the process exits.
+import atexit
+import hashlib
+import logging
+import select
+import socket
+import threading
+import time
+
+import paramiko
+from django.conf import settings
+
+LOG = logging.getLogger(__name__)
+
+# Defaults for settings of the same names.
+# Seconds a connection may be idle before it's closed.
+SSH_IDLE_TIMEOUT = 300
+
+DEFAULT_PORT = 22
+
+# Most bytes read from a channel at once.
+CHUNK_SIZE = 32768
+
+
+class _Connection(object):
+    def __init__(self, key):
+        self.key = key
+        self.client = None
+        # Serializes connecting, so concurrent callers share one login.
+        self.lock = threading.Lock()
+        # Number of commands running on the connection.
+        self.channels = 0
+        # Counts logins, so threads that found the connection lost at the
+        # same time connect again only once.
+        self.generation = 0
+        self.last_used = time.time()
+
+    def is_active(self):
+        transport = self.client and self.client.get_transport()
+        return bool(transport and transport.is_active())
+
+
+class SSHPool(object):
+    """Thread-safe pool of SSH connections, one per (host, port, user).
+    Connections logged in with a different password are never shared.
+    """
+
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        # { key: _Connection }
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._reaper_thread = None
+
+    def _key(self, host, user, password, port):
+        password = password or ''
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        digest = hashlib.sha1(password).hexdigest()
+        return (host, port, user, digest)
+
+    def _acquire(self, host, user, password, port, timeout):
+        # Return a connected _Connection, counting one more channel on it.
+        key = self._key(host, user, password, port)
+        with self._lock:
+            self._start_reaper()
+            connection = self._connections.get(key)
+            if connection is None:
+                connection = _Connection(key)
+                self._connections[key] = connection
+            connection.channels += 1
+
+        try:
+            with connection.lock:
+                if not connection.is_active():
+                    self._close(connection)
+                    self._connect(connection, host, user, password, port,
+                                  timeout)
+        except:
+            self._release(connection)
+            raise
+        return connection
+
+    def _connect(self, connection, host, user, password, port, timeout):
+        # Called with the connection's lock held.
+        LOG.debug('Opening SSH connection to %s as %s' % (host, user))
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(host, port, user, password, timeout=timeout)
+        connection.client = client
+        connection.generation += 1
+
+    def _release(self, connection):
+        with self._lock:
+            connection.channels -= 1
+            connection.last_used = time.time()
+
+    def _close(self, connection):
+        if connection.client is not None:
+            try:
+                connection.client.close()
+            except Exception as e:
+                LOG.debug('Unable to close SSH connection: %s' % e)
+            connection.client = None
+
+    def exec_command(self, host, user, password, command, port=DEFAULT_PORT,
+                     timeout=None):
+        """Runs the command on the host on a pooled connection. Returns
+        (exit status, stdout, stderr).
+        """
+        connection = self._acquire(host, user, password, port, timeout)
+        try:
+            channel = self._open_channel(connection, host, user, password,
+                                         port, timeout)
+            try:
+                channel.settimeout(timeout)
+                LOG.debug('Executing %s on host %s' % (command, host))
+                channel.exec_command(command)
+                stdout, stderr = _read_all(channel, timeout)
+                status = channel.recv_exit_status()
+            finally:
+                channel.close()
+        finally:
+            self._release(connection)
+        return status, stdout, stderr
+
+    def _open_channel(self, connection, host, user, password, port, timeout):
+        generation = connection.generation
+        try:
+            return connection.client.get_transport().open_session()
+        except (paramiko.SSHException, AttributeError) as e:
+            LOG.debug('Unable to open SSH channel to %s: %s' % (host, e))
+        with connection.lock:
+            # Connect again once if the connection went away, unless another
+            # thread already has since.
+            if (connection.generation == generation and
+                    not connection.is_active()):
+                self._close(connection)
+                self._connect(connection, host, user, password, port,
+                              timeout)
+            return connection.client.get_transport().open_session()
+
+    def _start_reaper(self):
+        # Called with the lock held.
+        if self._reaper_thread is None:
+            self._reaper_thread = threading.Thread(target=self._reap,
+                                                   name='ssh-reaper')
+            self._reaper_thread.daemon = True
+            self._reaper_thread.start()
+
+    def _reap(self):
+        # Close connections with no commands running that have been idle for
+        # too long.
+        while True:
+            time.sleep(max(1, self.idle_timeout / 2))
+            now = time.time()
+            expired = []
+            with self._lock:
+                for key, connection in self._connections.items():
+                    if (connection.channels == 0 and
+                            now - connection.last_used > self.idle_timeout):
+                        del self._connections[key]
+                        expired.append(connection)
+            for connection in expired:
+                LOG.debug('Closing idle SSH connection %s' % (
+                    connection.key[:3],))
+                with connection.lock:
+                    self._close(connection)
+
+    def close_all(self):
+        """Closes all connections."""
+        with self._lock:
+            connections = self._connections.values()
+            self._connections = {}
+        for connection in connections:
+            with connection.lock:
+                self._close(connection)
+
+
+def _read_all(channel, timeout):
+    # Return the stdout and stderr of the command on the channel. Both are
+    # read as they arrive, since a command blocks once the one not being read
+    # fills its window. Raises socket.timeout if nothing arrives for timeout
+    # seconds.
+    stdout = []
+    stderr = []
+    while True:
+        # Output arrives before EOF, so all of it is buffered once EOF is.
+        eof = channel.eof_received or channel.closed
+        received = False
+        while channel.recv_ready():
+            stdout.append(channel.recv(CHUNK_SIZE))
+            received = True
+        while channel.recv_stderr_ready():
+            stderr.append(channel.recv_stderr(CHUNK_SIZE))
+            received = True
+        if eof:
+            return ''.join(stdout), ''.join(stderr)
+        if not received:
+            readable, _, _ = select.select([channel], [], [], timeout)
+            if not readable:
+                raise socket.timeout('No output for %s seconds' % timeout)
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    """Returns the process wide SSH connection pool."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = SSHPool(getattr(settings, 'SSH_IDLE_TIMEOUT',
+                                    SSH_IDLE_TIMEOUT))
+            atexit.register(_POOL.close_all)
+        return _POOL
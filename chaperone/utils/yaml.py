@@ -15,51 +15,232 @@
 #
 from __future__ import absolute_import
 
+import contextlib
+import copy
 import fcntl
 import logging
 import os
+import stat
 import sys
+import tempfile
+import threading
 import yaml
 
 from django.conf import settings
 
 LOG = logging.getLogger(__name__)
 
-def include_constructor(loader, node):
-    """Loads a yaml include file."""
-    LOG.debug("Loading YAML(include) content from %s." % node.value)
-    content = {}
+# Use the libyaml bindings when PyYAML was built with them, they are many times
+# faster on large answer files.
+try:
+    from yaml import CSafeLoader as Loader, CSafeDumper as Dumper
+except ImportError:
+    from yaml import SafeLoader as Loader, SafeDumper as Dumper
+
+# Permissions for new files written by dump().
+DEFAULT_MODE = 0644
+
+# Parsed files, keyed by absolute path. Each entry holds the parsed content
+# and the stat stamps of the file and of every file it pulled in through
+# !include, so an entry is dropped as soon as any of them change.
+_CACHE = {}
+_CACHE_LOCK = threading.RLock()
+_GENERATION = [0]
+
+# Per-thread stack of dependency stamps collected while parsing, so includes
+# found by include_constructor are credited to the file being loaded.
+_LOADING = threading.local()
+
+
+class _CacheEntry(object):
+    def __init__(self, content, stamps, generation):
+        self.content = content
+        # { path: stamp }, for the file itself and all of its includes.
+        self.stamps = stamps
+        # Changes every time the file is parsed again.
+        self.generation = generation
+
+
+def _stamp(fname):
+    # Return (inode, size, mtime) for the file, or None if it doesn't exist.
     try:
-        content = load(node.value)
-    except IOError, err:
-        LOG.debug("Cannot load YAML(include) content from %s because: %s." % (node.value, os.strerror(err.errno)))
-    return content
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
 
-def load(fname, inhibit_constructor=False):
-    """Loads a yaml file, though with Chaperone extensions, like include files."""
-    content = None
+def _is_current(entry):
+    # Return True if none of the files the entry was built from changed.
+    for path, stamp in entry.stamps.items():
+        if _stamp(path) != stamp:
+            return False
+    return True
+
+
+def _dependencies():
+    stack = getattr(_LOADING, 'stack', None)
+    if stack is None:
+        stack = _LOADING.stack = []
+    return stack
+
+
+def _load_entry(fname):
+    # Return the cache entry for the file, parsing it again if it, or any file
+    # it includes, changed since it was cached.
+    path = os.path.abspath(fname)
+    with _CACHE_LOCK:
+        entry = _CACHE.get(path)
+        if entry is not None and _is_current(entry):
+            LOG.debug("Using cached YAML content for %s." % path)
+        else:
+            stamps = {path: _stamp(path)}
+            stack = _dependencies()
+            stack.append(stamps)
+            try:
+                content = _parse(path)
+            finally:
+                stack.pop()
+            _GENERATION[0] += 1
+            entry = _CacheEntry(content, stamps, _GENERATION[0])
+            if content is not None:
+                _CACHE[path] = entry
+            else:
+                _CACHE.pop(path, None)
+
+    # Credit this file and its includes to the file including it, if any.
+    stack = _dependencies()
+    if stack:
+        stack[-1].update(entry.stamps)
+    return entry
+
+
+def _parse(fname):
+    # Return parsed content of the file, or None if it can't be read.
+    LOG.debug("Loading YAML content from %s." % fname)
+    # No locking needed, dump() replaces files in one step.
     try:
-        yaml.add_constructor("!include", include_constructor)
-        LOG.debug("Loading YAML content from %s." % fname)
         with open(fname, 'r') as fp:
-            fcntl.flock(fp, fcntl.LOCK_SH)
             file_contents = fp.read()
-            fcntl.flock(fp, fcntl.LOCK_UN)
-        content = yaml.load(file_contents)
-        LOG.debug(" ==> YAML content from %s.\n\t%s" % (fname, str(content)))
     except IOError, err:
         LOG.debug("Cannot load YAML content from %s because: %s." % (fname, os.strerror(err.errno)))
+        return None
+    try:
+        content = yaml.load(file_contents, Loader=Loader)
+    except yaml.YAMLError, err:
+        LOG.error("Cannot parse YAML content from %s: %s" % (fname, err))
+        return None
+    LOG.debug(" ==> YAML content from %s.\n\t%s" % (fname, str(content)))
+    return content
 
-    if content == None:
-        content = {}
 
+def include_constructor(loader, node):
+    """Loads a yaml include file."""
+    LOG.debug("Loading YAML(include) content from %s." % node.value)
+    content = _load_entry(node.value).content
+    if content is None:
+        LOG.debug("Cannot load YAML(include) content from %s." % node.value)
+        content = {}
     return content
 
+yaml.add_constructor("!include", include_constructor, Loader=Loader)
+
+
+def _python_string_constructor(loader, node):
+    # Files written before the safe dumper was used, such as vcenter.yml from
+    # save_vcenter, tag unicode strings with !!python/unicode.
+    return loader.construct_scalar(node)
+
+yaml.add_constructor(u'tag:yaml.org,2002:python/unicode',
+                     _python_string_constructor, Loader=Loader)
+yaml.add_constructor(u'tag:yaml.org,2002:python/str',
+                     _python_string_constructor, Loader=Loader)
+
+
+def load(fname, inhibit_constructor=False, shared=False):
+    """Loads a yaml file, though with Chaperone extensions, like include files.
+
+    Parsed content is cached until the file, or any file it includes, changes.
+    Callers get their own copy, so they are free to modify it, unless shared
+    is set: then they get the cached content itself, which must not be
+    modified.
+    """
+    content = _load_entry(fname).content
+    if content is None:
+        return {}
+    if shared:
+        return content
+    return copy.deepcopy(content)
+
+
+def generation(fname):
+    """Returns a number that changes whenever the content of the file, or of
+    any file it includes, changes. Useful for validating data derived from it.
+    """
+    return _load_entry(fname).generation
+
+
+def invalidate(fname=None):
+    """Drop the cached content for the file, or for all files."""
+    with _CACHE_LOCK:
+        if fname is None:
+            _CACHE.clear()
+        else:
+            _CACHE.pop(os.path.abspath(fname), None)
+
+
 def dump(fname, content):
-    """ save object as yaml to a file."""
+    """ save object as yaml to a file.
+
+    The content is written to a temporary file in the same directory, which
+    then replaces the file, so readers always see a complete version of it.
+    """
     LOG.debug("YAML dumping content: %s\n" % str(content))
-    with open(fname, 'w+') as fp:
-        fcntl.flock(fp, fcntl.LOCK_EX)
-        fp.write(yaml.dump(content, default_flow_style=False))
-        fcntl.flock(fp, fcntl.LOCK_UN)
-        LOG.debug('YAML content file %s written' % fname)
+    file_contents = yaml.dump(content, Dumper=Dumper, default_flow_style=False)
+
+    dirname = os.path.dirname(os.path.abspath(fname))
+    try:
+        mode = stat.S_IMODE(os.stat(fname).st_mode)
+    except OSError:
+        mode = DEFAULT_MODE
+    fd, tmpname = tempfile.mkstemp(
+        prefix='.%s.' % os.path.basename(fname), dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(file_contents)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.chmod(tmpname, mode)
+        os.rename(tmpname, fname)
+    except:
+        os.unlink(tmpname)
+        raise
+    _fsync_directory(dirname)
+    LOG.debug('YAML content file %s written' % fname)
+    invalidate(fname)
+
+
+@contextlib.contextmanager
+def locked(fname):
+    """Holds the file for an update, e.g., load, change and dump, so that
+    updates by other threads and processes aren't lost. Uses a lock file next
+    to it; readers need no lock, since dump() replaces files in one step.
+    """
+    with open('%s.lock' % fname, 'a') as lock:
+        # A lock per open file, so threads exclude each other too.
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _fsync_directory(dirname):
+    # Make the rename durable.
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -14,28 +14,33 @@
 #  limitations under the License.
 #
 import fcntl
+import functools
+import inspect
 import json
 import logging
-import os
+import multiprocessing
 
 from django.conf import settings
 from django.contrib import auth
 from django.http import HttpResponse
 from django.shortcuts import render, redirect
 
-from prepare.views import write_answer_file
+from prepare.answers import get_answer_store
+from prepare.views import invalidate_group_status, write_answer_file
 from chaperone.forms import VCenterForm
-from chaperone.utils import getters, yaml
+from chaperone.utils import getters, inventory, options, parallel, yaml
+from chaperone.utils.schema import get_schema
 
 LOG = logging.getLogger(__name__)
 
 MIN_MGMT_NETWORKS = 1
+# Default seconds to wait for each step of looking up a vCenter's inventory.
+VCENTER_DISCOVERY_TIMEOUT = 60
 
 
 def index(request):
     """Main page, where the magic happens."""
-    filename = os.path.join(settings.ANSWER_FILE_DIR, settings.ANSWER_FILE_BASE)
-    menus = yaml.load(filename)
+    menus = get_schema().menus
 
     return render(request, 'chaperone/index.html', {
         'menus': menus,
@@ -57,7 +62,7 @@ def login(request):
             LOG.info('User %s logged in' % username)
             filename = '%s/%s' % (settings.ANSWER_FILE_DIR,
                                   settings.ANSWER_FILE_DEFAULT)
-            if not os.path.exists(filename):
+            if not get_answer_store(filename).exists():
                 # Initialize answer file with default values.
                 write_answer_file(request, filename)
             return redirect(request.REQUEST.get('next'))
@@ -84,12 +89,8 @@ def logout(request):
     return login(request)
 
 
-def list_options(request):
-    """Get options for a given field."""
-    field_id = request.REQUEST.get('fid')
-    fn_name = 'get_%s' % field_id
-    fn = getattr(getters, fn_name)
-
+def _options_kwargs(request):
+    # Return the vCenter login and location parameters of an options request.
     kwargs = {
         'vcenter': request.REQUEST.get('vcenter'),
         'username': request.REQUEST.get('username'),
@@ -101,7 +102,15 @@ def list_options(request):
     cluster = request.REQUEST.get('cluster')
     if cluster is not None:
         kwargs['cluster'] = cluster
-    options = fn(**kwargs)
+    return kwargs
+
+
+def list_options(request):
+    """Get options for a given field."""
+    field_id = request.REQUEST.get('fid')
+    fn_name = 'get_%s' % field_id
+    fn = getattr(getters, fn_name)
+    options = fn(**_options_kwargs(request))
 
     data = {}
     if options is not None:
@@ -110,13 +119,65 @@ def list_options(request):
         data['options'] = opt_names
     else:
         data['errors'] = ['Invalid username or password.']
+    # How fresh the inventory snapshots answering the getters are.
+    data['inventory'] = inventory.status()
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+def list_options_batch(request):
+    """Get options for several fields at once, given as a list of fid
+    parameters sharing the other parameters of list_options. Options and
+    errors are keyed by field.
+    """
+    kwargs = _options_kwargs(request)
+    data = { 'options': {}, 'errors': {} }
+    calls = {}
+    for field_id in request.REQUEST.getlist('fid'):
+        fn = getattr(getters, 'get_%s' % field_id, None)
+        if fn is None:
+            data['errors'][field_id] = ['Unknown field.']
+            continue
+        # Getters don't all take the location parameters.
+        args = inspect.getargspec(fn).args
+        calls[field_id] = functools.partial(
+            fn, **dict((k, v) for k, v in kwargs.items() if k in args))
+
+    # The getters answer from the inventory snapshot in memory when it's
+    # loaded. Otherwise each borrows a pooled vCenter session, so they take
+    # turns, reusing one session rather than logging in for each field.
+    results, failures = parallel.run_all(
+        calls, workers=1,
+        timeout=getattr(settings, 'VCENTER_DISCOVERY_TIMEOUT',
+                        VCENTER_DISCOVERY_TIMEOUT))
+    for field_id in calls:
+        options = results.get(field_id)
+        if field_id in failures:
+            if isinstance(failures[field_id], multiprocessing.TimeoutError):
+                data['errors'][field_id] = ['Timed out.']
+            else:
+                data['errors'][field_id] = [str(failures[field_id])]
+        elif options is None:
+            data['errors'][field_id] = ['Invalid username or password.']
+        else:
+            data['options'][field_id] = sorted(options.keys())
+    data['inventory'] = inventory.status()
     return HttpResponse(json.dumps(data), content_type='application/json')
 
 
+def invalidate_options(request):
+    """Drop cached options for the given fields, or for all fields, e.g.,
+    when the inventory is known to have changed.
+    """
+    field_ids = request.REQUEST.getlist('fid') or None
+    options.invalidate(field_ids)
+    # Groups may no longer be complete with the new options.
+    invalidate_group_status()
+    return HttpResponse(json.dumps({}), content_type='application/json')
+
+
 def vcenter_settings(request):
     """Main page, where the magic happens."""
-    filename = os.path.join(settings.ANSWER_FILE_DIR, settings.ANSWER_FILE_BASE)
-    menus = yaml.load(filename)
+    menus = get_schema().menus
 
     try:
         vcenter_form = VCenterForm()
@@ -138,6 +199,67 @@ def vcenter_settings(request):
     })
 
 
+def _discovery_error(label, noun, failure):
+    # Return the error message for a vCenter lookup that found nothing, or
+    # failed with the given exception.
+    if failure is None:
+        return 'No %s vCenter %s found.' % (label, noun)
+    if isinstance(failure, multiprocessing.TimeoutError):
+        return 'Timed out looking up %s vCenter %s.' % (label, noun)
+    return 'Unable to look up %s vCenter %s: %s' % (label, noun, failure)
+
+
+def _discover_vcenter(prefix, label, vcenter, username, password, datacenter,
+                      cluster):
+    # Look up the datacenters, clusters, hosts, datastores and networks of
+    # the management ('mgmt') or compute ('comp') vCenter. Returns (options,
+    # errors), options keyed by field name. Datacenters and clusters are
+    # looked up first, the rest at the same time, each with a timeout.
+    timeout = getattr(settings, 'VCENTER_DISCOVERY_TIMEOUT',
+                      VCENTER_DISCOVERY_TIMEOUT)
+    login = { 'vcenter': vcenter, 'username': username, 'password': password }
+    options = {}
+    errors = []
+
+    def lookup(kind, **kwargs):
+        fn = getattr(getters, 'get_%s_vc_%s' % (prefix, kind))
+        kwargs.update(login)
+        return functools.partial(fn, **kwargs)
+
+    for kind, noun, kwargs in (
+            ('datacenter', 'datacenters', { 'datacenter': '' }),
+            ('cluster', 'clusters', { 'datacenter': datacenter,
+                                      'cluster': '' })):
+        results, failures = parallel.run_all({ kind: lookup(kind, **kwargs) },
+                                             timeout=timeout)
+        if not results.get(kind):
+            errors.append(_discovery_error(label, noun, failures.get(kind)))
+            return options, errors
+        options['%s_vc_%s' % (prefix, kind)] = results[kind].keys()
+
+    # Hosts, datastores and networks in the cluster.
+    kinds = ['hosts', 'datastores', 'networks']
+    results, failures = parallel.run_all(
+        dict((kind, lookup(kind, datacenter=datacenter, cluster=cluster))
+             for kind in kinds),
+        workers=len(kinds), timeout=timeout)
+    for kind in kinds:
+        found = results.get(kind)
+        if kind in failures:
+            errors.append(_discovery_error(label, kind, failures[kind]))
+        elif kind == 'networks' and prefix == 'mgmt' and (
+                len(found or {}) < MIN_MGMT_NETWORKS):
+            errors.append(
+                'At least %s management vCenter network%s must be '
+                'available.' % (MIN_MGMT_NETWORKS,
+                                '' if MIN_MGMT_NETWORKS == 1 else 's'))
+        elif not found and kind != 'networks':
+            errors.append(_discovery_error(label, kind, None))
+        else:
+            options['%s_vc_%s' % (prefix, kind)] = (found or {}).keys()
+    return options, errors
+
+
 def save_vcenter(request):
     """Save entered vCenter settings."""
     try:
@@ -176,6 +298,8 @@ def save_vcenter(request):
 
         # Save vCenter settings to file.
         yaml.dump(settings.VCENTER_SETTINGS, vcenter_data)
+        # Options obtained from the previous vCenters no longer apply.
+        options.invalidate()
 
         options_data = {
             getters.COMP_VC: [comp_vc],
@@ -186,112 +310,25 @@ def save_vcenter(request):
             getters.MGMT_VC_PASSWORD: [mgmt_vc_password],
         }
 
-        # Get management datacenters.
-        mgmt_vc_datacenters = getters.get_mgmt_vc_datacenter(
-            vcenter=mgmt_vc, username=mgmt_vc_username,
-            password=mgmt_vc_password, datacenter='')
-        if not mgmt_vc_datacenters:
-            errors.append('No management vCenter datacenters found.')
-        else:
-            options_data[getters.MGMT_VC_DATACENTER] = (
-                mgmt_vc_datacenters.keys())
-
-        # Get clusters in the management datacenters.
-        mgmt_vc_clusters = None
-        if mgmt_vc_datacenters:
-            mgmt_vc_clusters = getters.get_mgmt_vc_cluster(
-                vcenter=mgmt_vc, username=mgmt_vc_username,
-                password=mgmt_vc_password, datacenter=mgmt_vc_datacenter,
-                cluster='')
-            if not mgmt_vc_clusters:
-                errors.append('No management vCenter clusters found.')
-            else:
-                options_data[getters.MGMT_VC_CLUSTER] = mgmt_vc_clusters.keys()
-
-        if mgmt_vc_clusters:
-            # Get hosts in these clusters.
-            mgmt_vc_hosts = getters.get_mgmt_vc_hosts(
-                vcenter=mgmt_vc, username=mgmt_vc_username,
-                password=mgmt_vc_password, datacenter=mgmt_vc_datacenter,
-                cluster=mgmt_vc_cluster)
-            if not mgmt_vc_hosts:
-                errors.append('No management vCenter hosts found.')
-            else:
-                options_data[getters.MGMT_VC_HOSTS] = mgmt_vc_hosts.keys()
-
-            # Get datastores in these clusters.
-            mgmt_vc_datastores = getters.get_mgmt_vc_datastores(
-                vcenter=mgmt_vc, username=mgmt_vc_username,
-                password=mgmt_vc_password, datacenter=mgmt_vc_datacenter,
-                cluster=mgmt_vc_cluster)
-            if not mgmt_vc_datastores:
-                errors.append('No management vCenter datastores found.')
-            else:
-                options_data[getters.MGMT_VC_DATASTORES] = mgmt_vc_datastores.keys()
-
-            # Get networks in these clusters.
-            mgmt_vc_networks = getters.get_mgmt_vc_networks(
-                vcenter=mgmt_vc, username=mgmt_vc_username,
-                password=mgmt_vc_password, datacenter=mgmt_vc_datacenter,
-                cluster=mgmt_vc_cluster)
-            if (not mgmt_vc_networks or
-                    len(mgmt_vc_networks) < MIN_MGMT_NETWORKS):
-                errors.append(
-                    'At least %s management vCenter network%s must be '
-                    'available.' % (MIN_MGMT_NETWORKS,
-                                    '' if MIN_MGMT_NETWORKS == 1 else 's'))
-            else:
-                options_data[getters.MGMT_VC_NETWORKS] = mgmt_vc_networks.keys()
-
-        # Get compute datacenters.
-        comp_vc_datacenters = getters.get_comp_vc_datacenter(
-            vcenter=comp_vc, username=comp_vc_username,
-            password=comp_vc_password, datacenter='')
-        if not comp_vc_datacenters:
-            errors.append('No compute vCenter datacenters found.')
-        else:
-            options_data[getters.COMP_VC_DATACENTER] = (
-                comp_vc_datacenters.keys())
-
-        # Get clusters in the compute datacenters.
-        comp_vc_clusters = None
-        if comp_vc_datacenters:
-            comp_vc_clusters = getters.get_comp_vc_cluster(
-                vcenter=comp_vc, username=comp_vc_username,
-                password=comp_vc_password, datacenter=comp_vc_datacenter,
-                cluster='')
-            if not comp_vc_clusters:
-                errors.append('No compute vCenter clusters found.')
-            else:
-                options_data[getters.COMP_VC_CLUSTER] = comp_vc_clusters.keys()
-
-        if comp_vc_clusters:
-            # Get hosts in these clusters.
-            comp_vc_hosts = getters.get_comp_vc_hosts(
-                vcenter=comp_vc, username=comp_vc_username,
-                password=comp_vc_password, datacenter=comp_vc_datacenter,
-                cluster=comp_vc_cluster)
-            if not comp_vc_hosts:
-                errors.append('No compute vCenter hosts found.')
-            else:
-                options_data[getters.COMP_VC_HOSTS] = comp_vc_hosts.keys()
-
-            # Get datastores in these clusters.
-            comp_vc_datastores = getters.get_comp_vc_datastores(
-                vcenter=comp_vc, username=comp_vc_username,
-                password=comp_vc_password, datacenter=comp_vc_datacenter,
-                cluster=comp_vc_cluster)
-            if not comp_vc_datastores:
-                errors.append('No compute vCenter datastores found.')
-            else:
-                options_data[getters.COMP_VC_DATASTORES] = comp_vc_datastores.keys()
-
-            # Get networks in these clusters.
-            comp_vc_networks = getters.get_comp_vc_networks(
-                vcenter=comp_vc, username=comp_vc_username,
-                password=comp_vc_password, datacenter=comp_vc_datacenter,
-                cluster=comp_vc_cluster)
-            options_data[getters.COMP_VC_NETWORKS] = comp_vc_networks.keys()
+        # Look up both vCenters at the same time.
+        results, failures = parallel.run_all({
+            'mgmt': functools.partial(
+                _discover_vcenter, 'mgmt', 'management', mgmt_vc,
+                mgmt_vc_username, mgmt_vc_password, mgmt_vc_datacenter,
+                mgmt_vc_cluster),
+            'comp': functools.partial(
+                _discover_vcenter, 'comp', 'compute', comp_vc,
+                comp_vc_username, comp_vc_password, comp_vc_datacenter,
+                comp_vc_cluster),
+        }, workers=2)
+        for prefix, label in (('mgmt', 'management'), ('comp', 'compute')):
+            if prefix in failures:
+                errors.append('Unable to look up %s vCenter: %s' % (
+                    label, failures[prefix]))
+                continue
+            vc_options, vc_errors = results[prefix]
+            options_data.update(vc_options)
+            errors.extend(vc_errors)
 
         if errors:
             LOG.error('Unable to save vCenter settings: %s' % errors)
@@ -300,50 +337,23 @@ def save_vcenter(request):
             # Save vCenter field options to file.
             options_filename = settings.INPUT_OPTIONS
             yaml.dump(options_filename, options_data)
+            # Dropdown options changed, so any group may now be complete or not.
+            invalidate_group_status()
 
             # Rewrite the answer file, to update with new vCenter values and
             # check if previously saved values for dynamically populated fields
             # are no longer valid.
-            base_filename = os.path.join(settings.ANSWER_FILE_DIR, settings.ANSWER_FILE_BASE)
-            menus = yaml.load(base_filename)
-
-            containers = []
-            for menu in menus:
-                for menu_name, menu_containers in menu.items():
-                    if menu_name == settings.PREPARE_MENU:
-                        containers = menu_containers
-                        break
-
+            schema = get_schema()
             new_answers = {}
-            values_cache = {}
-            # [{ ... }]
-            for container in containers:
-                # { 'Container': { ... } }
-                for groups in container.values():
-                    # [{ ... }]
-                    for group in groups:
-                        # { 'Group': [...] }
-                        for sections in group.values():
-                            # [{ ... }]
-                            for section in sections:
-                                # { 'Section': [...] }
-                                for attributes in section.values():
-                                    # [{ ... }]
-                                    for attr in attributes:
-                                        attr_id = attr['id']
-                                        opts = attr.get('options', [])
-                                        if not isinstance(opts, list):
-                                            if opts not in vcenter_data:
-                                                break
-                                            if opts in values_cache:
-                                                new_answers[attr_id] = (
-                                                    values_cache[attr_id])
-                                            else:
-                                                fn_name = 'get_%s_value' % opts
-                                                fn = getattr(getters, fn_name)
-                                                value = fn()
-                                                new_answers[attr_id] = value
-                                                values_cache[attr_id] = value
+            for field_name in vcenter_data:
+                attr_ids = schema.option_attribute_ids(field_name)
+                if not attr_ids:
+                    continue
+                fn_name = 'get_%s_value' % field_name
+                fn = getattr(getters, fn_name)
+                value = fn()
+                for attr_id in attr_ids:
+                    new_answers[attr_id] = value
 
             LOG.debug('New vCenter settings answers: %s' % new_answers)
             answers_filename = '%s/%s' % (settings.ANSWER_FILE_DIR,
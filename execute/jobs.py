@@ -0,0 +1,483 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#
+# Jobs running the commands of execute actions. Web workers queue jobs as
+# files in a spool directory, and a supervisor process, started on demand,
+# runs them and records their state. Runs don't hold up web workers, and
+# carry on when those are recycled.
+import datetime
+import fcntl
+import io
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.template.defaultfilters import slugify
+
+from chaperone.utils import yaml
+from execute import runs
+
+LOG = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+# Defaults for settings of the same names.
+# Number of jobs the supervisor runs at a time.
+EXECUTE_MAX_JOBS = 4
+# Number of commands of a job run at a time.
+EXECUTE_MAX_PARALLEL = 4
+# Seconds the supervisor waits for new jobs before exiting.
+EXECUTE_SUPERVISOR_IDLE = 300
+# Seconds finished jobs are kept.
+EXECUTE_JOB_RETENTION = 604800
+
+# Seconds between scans of the spool directory.
+POLL_INTERVAL = 1
+# Seconds between checks on the commands of a running job.
+RUN_INTERVAL = 0.2
+# Seconds between deletions of jobs past EXECUTE_JOB_RETENTION.
+PRUNE_INTERVAL = 3600
+# State of job nodes not run since a node they depend on failed.
+SKIPPED = 'skipped'
+
+# Job ids are <menu>_<group>.<timestamp in microseconds>-<random>, so they
+# sort by group and then by time.
+_JOB_ID_RE = re.compile(r'^[\w-]+\.\d{20}-[0-9a-f]{8}$')
+
+# Supervisor processes started by this process, reaped when they exit.
+_SPAWNED = []
+
+
+def _setting(name):
+    return getattr(settings, name, globals()[name])
+
+
+def _get_job_dir():
+    job_dir = getattr(settings, 'EXECUTE_JOB_DIR',
+                      os.path.join(settings.CHAPERONE_LOG_DIR, 'jobs'))
+    if not os.path.isdir(job_dir):
+        try:
+            os.makedirs(job_dir)
+        except OSError:
+            # Made by another process in the meantime.
+            if not os.path.isdir(job_dir):
+                raise
+    return job_dir
+
+
+def _job_filename(job_id):
+    return os.path.join(_get_job_dir(), '%s.yml' % job_id)
+
+
+def _segment_filename(job_id, index):
+    # Name of the file the job's node at the index writes its output to.
+    return os.path.join(_get_job_dir(), '%s.%d.log' % (job_id, index))
+
+
+def _group_key(menu_name, group_name):
+    return '%s_%s' % (slugify(menu_name), slugify(group_name))
+
+
+def _save(job):
+    yaml.dump(_job_filename(job['id']), job)
+
+
+def _job_ids(group_key=None):
+    # Return ids of the jobs, optionally only of the group, oldest first.
+    job_ids = []
+    for filename in os.listdir(_get_job_dir()):
+        job_id, ext = os.path.splitext(filename)
+        if ext != '.yml' or not _JOB_ID_RE.match(job_id):
+            continue
+        if group_key and job_id.split('.')[0] != group_key:
+            continue
+        job_ids.append(job_id)
+    job_ids.sort(key=lambda job_id: job_id.split('.')[1])
+    return job_ids
+
+
+def get_job(job_id):
+    """Returns the job with the given id, or None if there's no such job."""
+    if not job_id or not _JOB_ID_RE.match(job_id):
+        return None
+    filename = _job_filename(job_id)
+    if not os.path.exists(filename):
+        return None
+    return yaml.load(filename)
+
+
+def latest_job(menu_name, group_name):
+    """Returns the group's most recently submitted job, or None."""
+    job_ids = _job_ids(_group_key(menu_name, group_name))
+    if not job_ids:
+        return None
+    return get_job(job_ids[-1])
+
+
+def submit(menu_name, group_name, action_id, nodes, logname):
+    """Queues a job running the nodes of a plan (see execute.plan), writing
+    their output to the log file, and makes sure the supervisor is running.
+    Returns the job.
+    """
+    stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+    job_id = '%s.%s-%s' % (_group_key(menu_name, group_name), stamp,
+                           uuid.uuid4().hex[:8])
+    job = {
+        'id': job_id,
+        'menu': menu_name,
+        'group': group_name,
+        'action': action_id,
+        'nodes': [dict(node, state=None, started=None, finished=None,
+                       returncode=None) for node in nodes],
+        'logname': logname,
+        'cwd': os.getcwd(),
+        'state': QUEUED,
+        'created': time.time(),
+        'started': None,
+        'finished': None,
+        'returncode': None,
+        'error': None,
+    }
+    _save(job)
+    LOG.info('Queued job %s' % job_id)
+    ensure_supervisor()
+    return job
+
+
+def prune(retention):
+    """Deletes jobs finished more than retention seconds ago, except the
+    latest of each group, which tells whether the group's run succeeded.
+    """
+    job_ids = _job_ids()
+    latest = dict((job_id.split('.')[0], job_id) for job_id in job_ids)
+    now = time.time()
+    for job_id in set(job_ids) - set(latest.values()):
+        job = get_job(job_id)
+        if not job or job['state'] in ACTIVE_STATES:
+            continue
+        if now - (job['finished'] or job['created']) > retention:
+            filename = _job_filename(job_id)
+            os.unlink(filename)
+            yaml.invalidate(filename)
+            LOG.debug('Deleted job %s' % job_id)
+
+
+def _lock_supervisor():
+    # Return the supervisor lock file, locked, or None if another process
+    # holds the lock.
+    lock = open(os.path.join(_get_job_dir(), 'supervisor.lock'), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock.close()
+        return None
+    return lock
+
+
+def _python():
+    # Return the Python interpreter to run manage.py with. Under uWSGI or
+    # mod_wsgi, sys.executable is the web server, so look for the Python in
+    # the environment the application runs in.
+    if os.path.basename(sys.executable or '').startswith('python'):
+        return sys.executable
+    python = os.path.join(sys.exec_prefix, 'bin', 'python')
+    if os.path.exists(python):
+        return python
+    return 'python'
+
+
+def ensure_supervisor():
+    """Starts the supervisor process, unless one is running."""
+    # Reap supervisors started earlier that have exited since.
+    _SPAWNED[:] = [proc for proc in _SPAWNED if proc.poll() is None]
+
+    lock = _lock_supervisor()
+    if lock is None:
+        return
+    lock.close()
+
+    command = getattr(settings, 'EXECUTE_SUPERVISOR_COMMAND', None) or [
+        _python(), os.path.join(settings.BASE_DIR, 'manage.py'),
+        'job_supervisor']
+    LOG.info('Starting job supervisor: %s' % ' '.join(command))
+    logname = os.path.join(settings.CHAPERONE_LOG_DIR, 'job_supervisor.log')
+    with open(os.devnull, 'r') as devnull:
+        with open(logname, 'a') as log:
+            # In a session of its own, so that it outlives this process.
+            _SPAWNED.append(subprocess.Popen(
+                command, stdin=devnull, stdout=log, stderr=log,
+                close_fds=True, preexec_fn=os.setsid, cwd=os.getcwd()))
+
+
+class Supervisor(object):
+    """Runs queued jobs, at most max_jobs at a time and one at a time per
+    group, until no job has been queued for idle_timeout seconds. Only one
+    supervisor runs at a time.
+    """
+
+    def __init__(self, max_jobs, idle_timeout):
+        self.max_jobs = max_jobs
+        self.idle_timeout = idle_timeout
+        # { group key: thread running the group's job }
+        self._running = {}
+        # Time finished jobs were last pruned.
+        self._pruned = 0
+
+    def run(self):
+        while True:
+            lock = _lock_supervisor()
+            if lock is None:
+                LOG.info('Job supervisor already running')
+                return
+            try:
+                self._recover()
+                self._prune()
+                self._supervise()
+            finally:
+                lock.close()
+            # A job may have been queued after the last scan by a web worker
+            # that found the lock still held.
+            if not self._queued():
+                return
+
+    def _prune(self):
+        prune(_setting('EXECUTE_JOB_RETENTION'))
+        self._pruned = time.time()
+
+    def _recover(self):
+        # Jobs left running by a supervisor that exited can't be followed.
+        for job_id in _job_ids():
+            job = get_job(job_id)
+            if job and job['state'] == RUNNING:
+                LOG.warn('Job %s was left running' % job_id)
+                job['state'] = FAILED
+                job['error'] = 'Supervisor exited while the job was running.'
+                job['finished'] = time.time()
+                _save(job)
+                runs.finish(job)
+                for index in range(len(job.get('nodes', []))):
+                    if os.path.exists(_segment_filename(job_id, index)):
+                        os.unlink(_segment_filename(job_id, index))
+
+    def _queued(self):
+        jobs = [get_job(job_id) for job_id in _job_ids()]
+        return [job for job in jobs if job and job['state'] == QUEUED]
+
+    def _supervise(self):
+        idle_since = time.time()
+        while True:
+            for key, thread in self._running.items():
+                if not thread.is_alive():
+                    del self._running[key]
+
+            for job in self._queued():
+                key = job['id'].split('.')[0]
+                if key in self._running:
+                    continue
+                if len(self._running) >= self.max_jobs:
+                    break
+                job['state'] = RUNNING
+                job['started'] = time.time()
+                _save(job)
+                thread = threading.Thread(target=self._run_job, args=(job,),
+                                          name='job-%s' % job['id'])
+                thread.daemon = True
+                self._running[key] = thread
+                thread.start()
+
+            if time.time() - self._pruned > PRUNE_INTERVAL:
+                self._prune()
+            if self._running:
+                idle_since = time.time()
+            elif time.time() - idle_since > self.idle_timeout:
+                LOG.info('No jobs for %s seconds, exiting' %
+                         self.idle_timeout)
+                return
+            time.sleep(POLL_INTERVAL)
+
+    def _run_job(self, job):
+        LOG.info('Running job %s' % job['id'])
+        try:
+            with runs.start(job) as lp:
+                _Run(job, lp, _setting('EXECUTE_MAX_PARALLEL')).run()
+        except Exception as e:
+            LOG.error('Job %s failed: %s' % (job['id'], e))
+            job['error'] = str(e)
+        failed = [node for node in job['nodes'] if node['state'] != SUCCEEDED]
+        returncodes = [node['returncode'] for node in failed
+                       if node['returncode'] is not None]
+        job['returncode'] = returncodes[0] if returncodes else (
+            None if failed else 0)
+        job['state'] = FAILED if failed or job['error'] else SUCCEEDED
+        job['finished'] = time.time()
+        _save(job)
+        runs.finish(job)
+        LOG.info('Job %s %s' % (job['id'], job['state']))
+
+
+def _requires(node):
+    # Return the ids of the nodes that must succeed for the node to run.
+    # Jobs queued before nodes had requires needed all they depend on.
+    return node.get('requires', node['depends_on'])
+
+
+class _Run(object):
+    # Runs the nodes of a job, each once the nodes it depends on have
+    # finished, up to max_parallel at a time. Nodes that require one that
+    # failed are skipped. Each node writes to a segment file of its own, and
+    # the segments are copied to the log one at a time, in the order the
+    # nodes started, so output of nodes running together doesn't interleave.
+    # The segment being copied is followed as it's written.
+
+    def __init__(self, job, log, max_parallel):
+        self.job = job
+        self.log = log
+        self.max_parallel = max(max_parallel, 1)
+        # Mark the segments in the log unless there's only one.
+        self.marked = len(job['nodes']) > 1
+        # { node id: process }
+        self._procs = {}
+        # Indexes of started nodes whose segments haven't been fully copied,
+        # in the order they started.
+        self._copying = []
+        self._segment = None
+
+    def run(self):
+        # Set Python output to be unbuffered so any output is logged
+        # immediately.
+        env = dict(os.environ)
+        env['PYTHONUNBUFFERED'] = '1'
+        try:
+            while True:
+                self._reap()
+                self._skip()
+                self._start(env)
+                self._copy()
+                if not self._procs and not self._copying and not any(
+                        self._ready(node) for node in self.job['nodes']):
+                    break
+                time.sleep(RUN_INTERVAL)
+        finally:
+            for proc in self._procs.values():
+                proc.kill()
+            if self._segment:
+                self._segment.close()
+        for node in self.job['nodes']:
+            if node['state'] == SKIPPED:
+                self.log.write('=== %s: skipped, as a command it requires '
+                               'failed ===\n' % node['id'])
+
+    def _states(self):
+        return dict((node['id'], node['state']) for node in self.job['nodes'])
+
+    def _ready(self, node):
+        states = self._states()
+        return node['state'] is None and all(
+            states[dep_id] in (SUCCEEDED, FAILED, SKIPPED)
+            for dep_id in node['depends_on']) and all(
+            states[dep_id] == SUCCEEDED for dep_id in _requires(node))
+
+    def _skip(self):
+        changed = True
+        while changed:
+            changed = False
+            states = self._states()
+            for node in self.job['nodes']:
+                if node['state'] is None and any(
+                        states[dep_id] in (FAILED, SKIPPED)
+                        for dep_id in _requires(node)):
+                    node['state'] = SKIPPED
+                    changed = True
+
+    def _start(self, env):
+        for index, node in enumerate(self.job['nodes']):
+            if len(self._procs) >= self.max_parallel:
+                return
+            if not self._ready(node):
+                continue
+            LOG.debug('Running "%s"' % node['command'])
+            segname = _segment_filename(self.job['id'], index)
+            node['state'] = RUNNING
+            node['started'] = time.time()
+            try:
+                with open(segname, 'w') as sp:
+                    proc = subprocess.Popen(
+                        node['command'].split(), stdout=sp, stderr=sp,
+                        env=env, cwd=self.job['cwd'], close_fds=True)
+            except OSError as e:
+                with open(segname, 'a') as sp:
+                    sp.write('%s\n' % e)
+                node['state'] = FAILED
+                node['finished'] = time.time()
+            else:
+                self._procs[node['id']] = proc
+            self._copying.append(index)
+            _save(self.job)
+
+    def _reap(self):
+        for node in self.job['nodes']:
+            if node['id'] not in self._procs:
+                continue
+            proc = self._procs[node['id']]
+            returncode = proc.poll()
+            if returncode is None:
+                continue
+            del self._procs[node['id']]
+            node['returncode'] = returncode
+            node['state'] = SUCCEEDED if returncode == 0 else FAILED
+            node['finished'] = time.time()
+            _save(self.job)
+
+    def _copy(self):
+        while self._copying:
+            node = self.job['nodes'][self._copying[0]]
+            segname = _segment_filename(self.job['id'], self._copying[0])
+            if self._segment is None:
+                # Not a stdio file, where reading on after reaching the end
+                # may find nothing.
+                self._segment = io.open(segname, 'rb')
+                if self.marked:
+                    self.log.write('=== %s: %s ===\n' %
+                                   (node['id'], node['command']))
+            # Nodes are reaped before copying, so a finished node's output
+            # has all been written by now.
+            data = self._segment.read()
+            if data:
+                self.log.write(data)
+                self.log.flush()
+            if node['state'] == RUNNING:
+                return
+
+            self._segment.close()
+            self._segment = None
+            os.unlink(segname)
+            if self.marked and node['returncode'] is None:
+                self.log.write('=== %s: failed to start ===\n' % node['id'])
+            elif self.marked:
+                self.log.write('=== %s: exited with status %d ===\n' %
+                               (node['id'], node['returncode']))
+            self.log.flush()
+            self._copying.pop(0)
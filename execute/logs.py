@@ -0,0 +1,316 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#
+# Reading group logs incrementally, and following them as they're written.
+# A cursor names a place in a log: the file's inode and an offset into it.
+# Each run writes a new file (see jobs.Supervisor), so a cursor on another
+# inode is from an earlier run.
+import collections
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+# Use inotify to learn of writes to logs when it's available, rather than
+# checking the files every EXECUTE_STREAM_POLL seconds.
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+LOG = logging.getLogger(__name__)
+
+# Default for the setting of the same name: seconds between checks of a log
+# followed without inotify.
+EXECUTE_STREAM_POLL = 0.5
+
+# Most bytes read from a log at once by a watcher.
+CHUNK_SIZE = 64 * 1024
+# Reads kept by a watcher for subscribers to share.
+WATCHER_HISTORY = 64
+# Seconds a watcher without subscribers carries on, in case a client
+# reconnects.
+WATCHER_IDLE = 30
+
+# Running watchers, keyed by log file name.
+_WATCHERS = {}
+_WATCHERS_LOCK = threading.Lock()
+
+
+def parse_cursor(cursor):
+    """Returns the (inode, offset) of a cursor returned by read_log, or
+    (None, 0) if it's missing or malformed.
+    """
+    try:
+        inode, offset = [int(part) for part in cursor.split(':')]
+    except (AttributeError, ValueError):
+        return None, 0
+    return inode, max(offset, 0)
+
+
+def partial_char_length(data):
+    """Returns the number of bytes at the end of data that begin, but don't
+    complete, a UTF-8 character, to be left for the next read.
+    """
+    for back in range(1, min(len(data), 4) + 1):
+        byte = ord(data[-back])
+        if byte & 0xC0 == 0x80:
+            # Continuation byte; keep looking for the lead byte.
+            continue
+        if byte & 0xE0 == 0xC0:
+            length = 2
+        elif byte & 0xF0 == 0xE0:
+            length = 3
+        elif byte & 0xF8 == 0xF0:
+            length = 4
+        else:
+            length = 1
+        return back if length > back else 0
+    return 0
+
+
+def read_log(logname, cursor, max_bytes=None):
+    """Returns the output written to the log file after the given cursor,
+    reading no more than max_bytes, as a dict with:
+        data: the output
+        cursor: cursor to read the output written after it
+        reset: whether the output replaces what was read before
+        more: whether more output has been written than was read
+    """
+    inode, offset = parse_cursor(cursor)
+    if not os.path.exists(logname):
+        return {'data': '', 'cursor': cursor or '', 'reset': False,
+                'more': False}
+
+    with open(logname, 'r') as lp:
+        fcntl.flock(lp, fcntl.LOCK_SH)
+        try:
+            stat = os.fstat(lp.fileno())
+            reset = inode != stat.st_ino or offset > stat.st_size
+            if reset:
+                offset = 0
+            lp.seek(offset)
+            data = lp.read(max_bytes) if max_bytes else lp.read()
+        finally:
+            fcntl.flock(lp, fcntl.LOCK_UN)
+
+    partial = partial_char_length(data)
+    if partial:
+        data = data[:-partial]
+    offset += len(data)
+    return {
+        'data': data.decode('utf-8', 'replace'),
+        'cursor': '%d:%d' % (stat.st_ino, offset),
+        'reset': reset,
+        'more': offset < stat.st_size,
+    }
+
+
+def read_tail(logname, max_bytes):
+    """Returns about the last max_bytes of output written to the log file,
+    starting at a line, as a dict like read_log returns, with truncated set
+    if earlier output was left out.
+    """
+    if not os.path.exists(logname):
+        return {'data': '', 'cursor': '', 'reset': False, 'more': False,
+                'truncated': False}
+
+    with open(logname, 'r') as lp:
+        fcntl.flock(lp, fcntl.LOCK_SH)
+        try:
+            stat = os.fstat(lp.fileno())
+            offset = max(stat.st_size - max_bytes, 0)
+            lp.seek(offset)
+            data = lp.read(stat.st_size - offset)
+        finally:
+            fcntl.flock(lp, fcntl.LOCK_UN)
+
+    truncated = offset > 0
+    if truncated and '\n' in data:
+        skip = data.index('\n') + 1
+        data = data[skip:]
+        offset += skip
+    partial = partial_char_length(data)
+    if partial:
+        data = data[:-partial]
+    offset += len(data)
+    return {
+        'data': data.decode('utf-8', 'replace'),
+        'cursor': '%d:%d' % (stat.st_ino, offset),
+        'reset': True,
+        'more': offset < stat.st_size,
+        'truncated': truncated,
+    }
+
+
+class LogWatcher(object):
+    """Follows a log file in a thread of its own, reading what's written to
+    it once for all of its subscribers. Get one with subscribe().
+    """
+
+    def __init__(self, logname):
+        self.logname = logname
+        # Where the last read ended; starts at the end of the file.
+        self.cursor = ''
+        self._stat = None
+        if os.path.exists(logname):
+            stat = os.stat(logname)
+            self._stat = (stat.st_ino, stat.st_size)
+            self.cursor = '%d:%d' % self._stat
+        # Recent reads, keyed by the cursor each one started from.
+        self._reads = collections.OrderedDict()
+        self._version = 0
+        self._condition = threading.Condition()
+        self._subscribers = 0
+        self._idle_since = time.time()
+        self._thread = threading.Thread(target=self._run,
+                                        name='logwatch-%s' % logname)
+        self._thread.daemon = True
+
+    def wait(self, cursor, timeout):
+        """Returns the reads of output written after the cursor, each a dict
+        like read_log returns, waiting up to timeout seconds for some to be
+        written if there's none yet.
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self._condition:
+                reads = self._reads_after(cursor)
+                known = reads or cursor == self.cursor
+                version = self._version
+            if reads:
+                return reads
+            if not known:
+                # Behind the reads still kept, or before the watcher started.
+                read = read_log(self.logname, cursor, CHUNK_SIZE)
+                if read['data'] or read['reset']:
+                    return [read]
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return []
+            with self._condition:
+                if self._version == version:
+                    self._condition.wait(remaining)
+
+    def _reads_after(self, cursor):
+        # Return the kept reads following on from the cursor. Called with
+        # the condition held.
+        reads = []
+        while cursor in self._reads and len(reads) < len(self._reads):
+            read = self._reads[cursor]
+            reads.append(read)
+            cursor = read['cursor']
+        return reads
+
+    def _update(self):
+        # Read what was written since the last read, if anything.
+        try:
+            stat = os.stat(self.logname)
+        except OSError:
+            return
+        if (stat.st_ino, stat.st_size) == self._stat:
+            return
+        self._stat = (stat.st_ino, stat.st_size)
+
+        while True:
+            read = read_log(self.logname, self.cursor, CHUNK_SIZE)
+            if not read['data'] and not read['reset']:
+                return
+            with self._condition:
+                self._reads[self.cursor] = read
+                while len(self._reads) > WATCHER_HISTORY:
+                    self._reads.popitem(last=False)
+                self.cursor = read['cursor']
+                self._version += 1
+                self._condition.notify_all()
+            if not read['more']:
+                return
+
+    def _stopped(self):
+        # Return whether the watcher has been idle long enough to stop, and
+        # if so, remove it so the next subscriber starts a new one.
+        with _WATCHERS_LOCK:
+            if (self._subscribers or
+                    time.time() - self._idle_since < WATCHER_IDLE):
+                return False
+            if _WATCHERS.get(self.logname) is self:
+                del _WATCHERS[self.logname]
+            return True
+
+    def _run(self):
+        interval = getattr(settings, 'EXECUTE_STREAM_POLL',
+                           EXECUTE_STREAM_POLL)
+        notifier = None
+        if pyinotify:
+            # Watch directories rather than the file, since each run
+            # replaces it. The log may be a link to the run's file, which is
+            # written in another directory.
+            manager = pyinotify.WatchManager()
+            notifier = pyinotify.Notifier(manager, lambda event: None,
+                                          timeout=1000)
+            watched = set()
+        LOG.debug('Following %s with %s' %
+                  (self.logname, 'inotify' if notifier else 'stat'))
+        try:
+            while not self._stopped():
+                if notifier:
+                    for path in (self.logname,
+                                 os.path.realpath(self.logname)):
+                        dirname = os.path.dirname(path) or '.'
+                        if dirname not in watched and os.path.isdir(dirname):
+                            manager.add_watch(dirname, pyinotify.IN_MODIFY |
+                                              pyinotify.IN_CREATE |
+                                              pyinotify.IN_MOVED_TO)
+                            watched.add(dirname)
+                self._update()
+                if notifier:
+                    if notifier.check_events():
+                        notifier.read_events()
+                        notifier.process_events()
+                else:
+                    time.sleep(interval)
+        except Exception as e:
+            LOG.error('Failed to follow %s: %s' % (self.logname, e))
+            with _WATCHERS_LOCK:
+                if _WATCHERS.get(self.logname) is self:
+                    del _WATCHERS[self.logname]
+        finally:
+            if notifier:
+                notifier.stop()
+
+
+def subscribe(logname):
+    """Returns the watcher following the log file, starting one if need be.
+    Call unsubscribe() with it when done.
+    """
+    with _WATCHERS_LOCK:
+        watcher = _WATCHERS.get(logname)
+        if watcher is None:
+            watcher = _WATCHERS[logname] = LogWatcher(logname)
+            watcher._thread.start()
+        watcher._subscribers += 1
+    return watcher
+
+
+def unsubscribe(watcher):
+    """Drops a subscription made with subscribe()."""
+    with _WATCHERS_LOCK:
+        watcher._subscribers -= 1
+        watcher._idle_since = time.time()
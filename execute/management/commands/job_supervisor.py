@@ -0,0 +1,44 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from execute import jobs
+
+
+class Command(BaseCommand):
+    help = ('Runs queued execute jobs until none have been queued for a '
+            'while. Started on demand when a job is queued.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--max-jobs', type='int', default=None,
+                    help='Number of jobs to run at a time.'),
+        make_option('--idle-timeout', type='int', default=None,
+                    help='Seconds to wait for new jobs before exiting.'),
+    )
+
+    def handle(self, *args, **options):
+        max_jobs = options['max_jobs']
+        if max_jobs is None:
+            max_jobs = getattr(settings, 'EXECUTE_MAX_JOBS',
+                               jobs.EXECUTE_MAX_JOBS)
+        idle_timeout = options['idle_timeout']
+        if idle_timeout is None:
+            idle_timeout = getattr(settings, 'EXECUTE_SUPERVISOR_IDLE',
+                                   jobs.EXECUTE_SUPERVISOR_IDLE)
+        jobs.Supervisor(max_jobs, idle_timeout).run()
@@ -0,0 +1,167 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#
+# Plans of the commands run for an action, as a graph of nodes that each run
+# one command once the nodes it depends on have finished, and are skipped if
+# any node they require failed. See the actions in
+# chaperone/local_settings.py.example for the keys that shape the graph.
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+class PlanError(ValueError):
+    """Raised for actions whose dependencies can't be met."""
+
+
+def _split(value):
+    # Return the ids in a depends_on value, given as a list or as a comma
+    # separated string.
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        value = str(value).split(',')
+    return [str(item).strip() for item in value if str(item).strip()]
+
+
+def _is_set(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def _action_order(actions, action_id):
+    # Return the ids of the action and of the actions it depends on,
+    # directly or not, with each after those it depends on.
+    by_id = dict((act['id'], act) for act in actions)
+    order = []
+    visiting = []
+
+    def visit(act_id):
+        if act_id in order:
+            return
+        if act_id in visiting:
+            raise PlanError('Actions %s depend on each other.' %
+                            ', '.join(visiting[visiting.index(act_id):]))
+        if act_id not in by_id:
+            raise PlanError('No action %s.' % act_id)
+        visiting.append(act_id)
+        for dep_id in _split(by_id[act_id].get('depends_on')):
+            visit(dep_id)
+        visiting.pop()
+        order.append(act_id)
+
+    visit(action_id)
+    return [by_id[act_id] for act_id in order]
+
+
+def _action_nodes(act, arguments):
+    # Return the nodes for the commands of the action, depending on each
+    # other but not yet on other actions. Commands only require those named
+    # in their depends_on; otherwise they just run after the ones before.
+    nodes = []
+    # Commands run in stages, each after all commands of the one before.
+    stage_deps = []
+    stage = []
+    for index, cmd in enumerate(act.get('commands') or []):
+        if not isinstance(cmd, dict):
+            cmd = {'command': cmd}
+        if not cmd.get('command'):
+            raise PlanError('Command %d of action %s has no command.' %
+                            (index + 1, act['id']))
+        node_id = '%s.%s' % (act['id'], cmd.get('id', index + 1))
+
+        requires = []
+        if 'depends_on' in cmd:
+            # Runs apart from the stages, after the commands it names.
+            deps = requires = ['%s.%s' % (act['id'], dep_id)
+                               for dep_id in _split(cmd['depends_on'])]
+        elif _is_set(act.get('parallel')):
+            deps = []
+        elif _is_set(cmd.get('parallel')) and stage:
+            # Runs alongside the command before it.
+            deps = list(stage_deps)
+            stage.append(node_id)
+        else:
+            stage_deps, stage = stage, [node_id]
+            deps = list(stage_deps)
+
+        command = cmd['command']
+        if arguments:
+            command = '%s %s' % (command, ' '.join(arguments))
+        nodes.append({
+            'id': node_id,
+            'action': act['id'],
+            'command': command,
+            'depends_on': deps,
+            'requires': list(requires),
+        })
+    return nodes
+
+
+def _sort(nodes):
+    # Return the nodes with each after those it depends on.
+    by_id = dict((node['id'], node) for node in nodes)
+    if len(by_id) != len(nodes):
+        raise PlanError('Command ids must be unique within an action.')
+    for node in nodes:
+        for dep_id in node['depends_on']:
+            if dep_id not in by_id:
+                raise PlanError('Command %s depends on unknown command %s.' %
+                                (node['id'], dep_id))
+
+    ordered = []
+    done = set()
+    pending = list(nodes)
+    while pending:
+        ready = [node for node in pending
+                 if all(dep_id in done for dep_id in node['depends_on'])]
+        if not ready:
+            raise PlanError('Commands %s depend on each other.' %
+                            ', '.join(node['id'] for node in pending))
+        for node in ready:
+            ordered.append(node)
+            done.add(node['id'])
+            pending.remove(node)
+    return ordered
+
+
+def build(actions, action_id, arguments=None):
+    """Returns the nodes to run for the action, after the actions it depends
+    on, with each node after those it depends on. Each node is a dict with
+    id, action, command, depends_on, the ids of the nodes it runs after, and
+    requires, those of them that must succeed for it to run. The arguments
+    are added to every command. Raises PlanError if the dependencies can't
+    be met.
+    """
+    nodes = []
+    # { action_id: ids of its nodes }
+    action_nodes = {}
+    for act in _action_order(actions, action_id):
+        act_nodes = _action_nodes(act, arguments)
+        after = []
+        for dep_id in _split(act.get('depends_on')):
+            after.extend(action_nodes[dep_id])
+        # Actions without commands pass on what they depend on.
+        action_nodes[act['id']] = ([node['id'] for node in act_nodes] or
+                                   after)
+        # All the action's commands require the actions it depends on.
+        for node in act_nodes:
+            for dep_id in after:
+                if dep_id not in node['depends_on']:
+                    node['depends_on'].append(dep_id)
+                if dep_id not in node['requires']:
+                    node['requires'].append(dep_id)
+        nodes.extend(act_nodes)
+    return _sort(nodes)
@@ -0,0 +1,208 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#
+# History of the runs of each group's actions. Each run writes its output to
+# a file of its own in EXECUTE_RUN_DIR/<menu>_<group>/, and the group's log
+# is a symbolic link to the latest one's, so that it can be followed as it's
+# written. Earlier runs are compressed when a new one starts, and only the
+# latest EXECUTE_LOG_RUNS are kept. An index per group lists the runs, so
+# that they can be shown without opening their files.
+import gzip
+import logging
+import os
+import shutil
+import threading
+
+from django.conf import settings
+from django.template.defaultfilters import slugify
+
+from chaperone.utils import yaml
+from execute import logs
+
+LOG = logging.getLogger(__name__)
+
+# Default for the setting of the same name: number of runs kept per group.
+EXECUTE_LOG_RUNS = 50
+
+# Most bytes of output returned by read_run() at once.
+PAGE_SIZE = 64 * 1024
+
+_INDEX_NAME = 'index.yml'
+# Index changes are made by the job supervisor, one group at a time, but
+# kept apart anyway.
+_INDEX_LOCK = threading.Lock()
+
+
+def _run_dir(menu_name, group_name):
+    run_dir = os.path.join(
+        getattr(settings, 'EXECUTE_RUN_DIR',
+                os.path.join(settings.CHAPERONE_LOG_DIR, 'runs')),
+        '%s_%s' % (slugify(menu_name), slugify(group_name)))
+    if not os.path.isdir(run_dir):
+        try:
+            os.makedirs(run_dir)
+        except OSError:
+            # Made by another process in the meantime.
+            if not os.path.isdir(run_dir):
+                raise
+    return run_dir
+
+
+def _load_index(run_dir):
+    filename = os.path.join(run_dir, _INDEX_NAME)
+    if not os.path.exists(filename):
+        return []
+    return yaml.load(filename) or []
+
+
+def _update_index(run_dir, run_id, add, **values):
+    # Set values of the run in the index, adding it if need be and add is
+    # set, or else leaving the index as it is.
+    with _INDEX_LOCK:
+        runs = _load_index(run_dir)
+        for run in runs:
+            if run['id'] == run_id:
+                break
+        else:
+            if not add:
+                return
+            run = {'id': run_id}
+            runs.append(run)
+        run.update(values)
+        yaml.dump(os.path.join(run_dir, _INDEX_NAME), runs)
+
+
+def get_runs(menu_name, group_name):
+    """Returns the index of the group's runs, oldest first. Each run is a
+    dict with id, action, state, started, finished, returncode, size (bytes
+    of output) and file.
+    """
+    return _load_index(_run_dir(menu_name, group_name))
+
+
+def _compress(run_dir, run):
+    # Replace the run's file with a compressed copy.
+    filename = os.path.join(run_dir, run['file'])
+    gzname = '%s.gz' % filename
+    tmpname = '%s.tmp' % gzname
+    with open(filename, 'rb') as fp:
+        gz = gzip.open(tmpname, 'wb')
+        try:
+            shutil.copyfileobj(fp, gz)
+        finally:
+            gz.close()
+    os.rename(tmpname, gzname)
+    os.unlink(filename)
+    run['file'] = os.path.basename(gzname)
+
+
+def _tidy(run_dir, current_id):
+    # Compress the runs before the current one, and drop the oldest.
+    keep = getattr(settings, 'EXECUTE_LOG_RUNS', EXECUTE_LOG_RUNS)
+    with _INDEX_LOCK:
+        runs = _load_index(run_dir)
+        dropped = runs[:-keep] if keep > 0 else []
+        runs = runs[len(dropped):]
+        for run in dropped:
+            filename = os.path.join(run_dir, run['file'])
+            if os.path.exists(filename):
+                os.unlink(filename)
+        for run in runs:
+            if run['id'] == current_id or run['file'].endswith('.gz'):
+                continue
+            try:
+                _compress(run_dir, run)
+            except (IOError, OSError) as e:
+                LOG.error('Failed to compress %s: %s' % (run['file'], e))
+        yaml.dump(os.path.join(run_dir, _INDEX_NAME), runs)
+
+
+def start(job):
+    """Makes the file the job writes its output to, which the group's log
+    then links to, and adds it to the index. Returns the file, open.
+    """
+    run_dir = _run_dir(job['menu'], job['group'])
+    filename = os.path.join(run_dir, '%s.log' % job['id'])
+    fp = open(filename, 'w')
+    _update_index(run_dir, job['id'], True, action=job['action'],
+                  state=job['state'], started=job['started'], finished=None,
+                  returncode=None, size=0, file=os.path.basename(filename))
+
+    # Replace the group's log in one step, so readers always find one. The
+    # new file is made while the last run's is still there, so it can't
+    # reuse its inode, and readers following the log by inode and offset
+    # can tell the runs apart.
+    linkname = '%s.%s' % (job['logname'], job['id'])
+    if os.path.lexists(linkname):
+        os.unlink(linkname)
+    os.symlink(filename, linkname)
+    os.rename(linkname, job['logname'])
+    _tidy(run_dir, job['id'])
+    return fp
+
+
+def finish(job):
+    """Records the end of the job's run in the index, if it started."""
+    run_dir = _run_dir(job['menu'], job['group'])
+    filename = os.path.join(run_dir, '%s.log' % job['id'])
+    size = os.path.getsize(filename) if os.path.exists(filename) else 0
+    _update_index(run_dir, job['id'], False, state=job['state'],
+                  finished=job['finished'], returncode=job['returncode'],
+                  size=size)
+
+
+def read_run(menu_name, group_name, run_id, offset=0, limit=PAGE_SIZE):
+    """Returns a page of the run's output, starting at the offset, as a dict
+    with data, offset (of the next page), size (of all of the output) and
+    eof (whether the page is the last). Returns None if there's no such run.
+    Compressed output has no index to seek with, so it's read up to the
+    offset first.
+    """
+    run_dir = _run_dir(menu_name, group_name)
+    for run in _load_index(run_dir):
+        if run['id'] == run_id:
+            break
+    else:
+        return None
+
+    filename = os.path.join(run_dir, run['file'])
+    if not os.path.exists(filename) and os.path.exists('%s.gz' % filename):
+        # Compressed since the index was read.
+        filename = '%s.gz' % filename
+    if filename.endswith('.gz'):
+        fp = gzip.open(filename, 'rb')
+        size = run['size']
+    else:
+        # May still be written to.
+        fp = open(filename, 'rb')
+        size = os.fstat(fp.fileno()).st_size
+    try:
+        fp.seek(max(offset, 0))
+        data = fp.read(min(limit, PAGE_SIZE))
+        extra = fp.read(1)
+    finally:
+        fp.close()
+
+    partial = logs.partial_char_length(data)
+    if partial:
+        data = data[:-partial]
+    offset = max(offset, 0) + len(data)
+    return {
+        'data': data.decode('utf-8', 'replace'),
+        'offset': offset,
+        'size': size,
+        'eof': not partial and not extra,
+    }
@@ -13,6 +13,282 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import json
+import os
+import shutil
+import tempfile
+import time
+
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from chaperone.utils import yaml
+from execute import jobs, logs, plan, runs, views
+
+
+class ExecuteTestCase(TestCase):
+    """Runs with scratch job, run and log directories."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.override = override_settings(
+            CHAPERONE_LOG_DIR=self.dir,
+            EXECUTE_JOB_DIR=os.path.join(self.dir, 'jobs'),
+            EXECUTE_RUN_DIR=os.path.join(self.dir, 'runs'))
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        yaml.invalidate()
+        shutil.rmtree(self.dir)
+
+
+class SupervisorTest(ExecuteTestCase):
+    def test_runs_queued_job(self):
+        actions = [{'id': 'a', 'commands': ['echo one', 'echo two']}]
+        job_id = 'deploy_management.%020d-00000000' % 1
+        logname = os.path.join(self.dir, 'deploy_management.log')
+        jobs._save({
+            'id': job_id, 'menu': 'Deploy', 'group': 'Management',
+            'action': 'a', 'logname': logname, 'cwd': self.dir,
+            'nodes': [dict(node, state=None, started=None, finished=None,
+                           returncode=None)
+                      for node in plan.build(actions, 'a')],
+            'state': jobs.QUEUED, 'created': time.time(), 'started': None,
+            'finished': None, 'returncode': None, 'error': None})
+        jobs.Supervisor(max_jobs=1, idle_timeout=0).run()
+
+        job = jobs.latest_job('Deploy', 'Management')
+        self.assertEqual((job['id'], job['state'], job['returncode']),
+                         (job_id, jobs.SUCCEEDED, 0))
+        with open(logname) as lp:
+            output = lp.read()
+        self.assertIn('one\n', output)
+        self.assertLess(output.index('one'), output.index('two'))
+        self.assertEqual(runs.get_runs('Deploy', 'Management')[0]['state'],
+                         jobs.SUCCEEDED)
+
+
+class JobPruneTest(ExecuteTestCase):
+    def save_job(self, group, stamp, state, finished):
+        job_id = '%s.%020d-0000000%d' % (group, stamp, stamp)
+        jobs._save({ 'id': job_id, 'state': state, 'created': finished,
+                     'finished': finished })
+        return job_id
+
+    def test_prune_keeps_recent_active_and_latest_jobs(self):
+        old = time.time() - 7200
+        pruned = self.save_job('m_a', 1, jobs.SUCCEEDED, old)
+        queued = self.save_job('m_a', 2, jobs.QUEUED, old)
+        recent = self.save_job('m_a', 3, jobs.FAILED, time.time())
+        latest = self.save_job('m_b', 4, jobs.FAILED, old)
+        jobs.prune(3600)
+        self.assertIsNone(jobs.get_job(pruned))
+        for job_id in (queued, recent, latest):
+            self.assertEqual(jobs.get_job(job_id)['id'], job_id)
+
+
+class PlanTest(TestCase):
+    def nodes(self, actions, action_id='a'):
+        return dict((node['id'], (node['depends_on'], node['requires']))
+                    for node in plan.build(actions, action_id))
+
+    def test_commands_run_one_after_another(self):
+        self.assertEqual(self.nodes([{'id': 'a', 'commands': ['x', 'y']}]), {
+            'a.1': ([], []),
+            'a.2': (['a.1'], []),
+        })
+
+    def test_parallel_commands(self):
+        actions = [{'id': 'a', 'commands': [
+            'x', {'command': 'y', 'parallel': 1}, 'z']}]
+        self.assertEqual(self.nodes(actions)['a.3'], (['a.1', 'a.2'], []))
+        actions[0]['parallel'] = 1
+        self.assertEqual(self.nodes(actions)['a.3'], ([], []))
+
+    def test_command_depends_on(self):
+        actions = [{'id': 'a', 'commands': [
+            {'id': 'x', 'command': 'x', 'depends_on': 'y'},
+            {'id': 'y', 'command': 'y'}]}]
+        self.assertEqual([node['id'] for node in plan.build(actions, 'a')],
+                         ['a.y', 'a.x'])
+        self.assertEqual(self.nodes(actions)['a.x'], (['a.y'], ['a.y']))
+
+    def test_action_depends_on(self):
+        actions = [{'id': 'a', 'commands': ['x', 'y'], 'depends_on': 'b'},
+                   {'id': 'b', 'commands': ['z']}]
+        self.assertEqual(self.nodes(actions), {
+            'b.1': ([], []),
+            'a.1': (['b.1'], ['b.1']),
+            'a.2': (['a.1', 'b.1'], ['b.1']),
+        })
+
+    def test_errors(self):
+        actions = [{'id': 'a', 'commands': ['x'], 'depends_on': 'b'},
+                   {'id': 'b', 'commands': ['y'], 'depends_on': 'a'}]
+        self.assertRaises(plan.PlanError, plan.build, actions, 'a')
+        self.assertRaises(plan.PlanError, plan.build, actions, 'c')
+        actions = [{'id': 'a', 'commands': [
+            {'command': 'x', 'depends_on': 'y'}]}]
+        self.assertRaises(plan.PlanError, plan.build, actions, 'a')
+
+
+class RunTest(ExecuteTestCase):
+    def run_nodes(self, actions, action_id='a'):
+        nodes = plan.build(actions, action_id)
+        job = {
+            'id': 'm_g.%020d-00000000' % 1, 'cwd': self.dir,
+            'nodes': [dict(node, state=None, started=None, finished=None,
+                           returncode=None) for node in nodes]}
+        with open(os.path.join(self.dir, 'log'), 'w') as log:
+            jobs._Run(job, log, 2).run()
+        return dict((node['id'], node['state']) for node in job['nodes'])
+
+    def test_commands_run_after_one_fails(self):
+        self.assertEqual(
+            self.run_nodes([{'id': 'a', 'commands': ['false', 'true']}]),
+            {'a.1': jobs.FAILED, 'a.2': jobs.SUCCEEDED})
+
+    def test_required_failure_skips(self):
+        actions = [{'id': 'a', 'commands': ['true', 'true'],
+                    'depends_on': 'b'},
+                   {'id': 'b', 'commands': ['false']}]
+        self.assertEqual(self.run_nodes(actions), {
+            'b.1': jobs.FAILED, 'a.1': jobs.SKIPPED, 'a.2': jobs.SKIPPED})
+
+
+class LogsTest(ExecuteTestCase):
+    def setUp(self):
+        super(LogsTest, self).setUp()
+        self.logname = os.path.join(self.dir, 'group.log')
+
+    def write(self, data, mode='a'):
+        with open(self.logname, mode) as lp:
+            lp.write(data)
+
+    def test_parse_cursor(self):
+        self.assertEqual(logs.parse_cursor('12:34'), (12, 34))
+        self.assertEqual(logs.parse_cursor('12:-1'), (12, 0))
+        for cursor in (None, '', '12', 'a:b'):
+            self.assertEqual(logs.parse_cursor(cursor), (None, 0))
+
+    def test_partial_char_length(self):
+        snowman = u'\u2603'.encode('utf-8')
+        self.assertEqual(logs.partial_char_length('abc'), 0)
+        self.assertEqual(logs.partial_char_length('a' + snowman), 0)
+        self.assertEqual(logs.partial_char_length('a' + snowman[:2]), 2)
+        self.assertEqual(logs.partial_char_length(snowman[:1]), 1)
+
+    def test_read_log_follows_on(self):
+        self.write('one\n', 'w')
+        read = logs.read_log(self.logname, '')
+        self.assertEqual((read['data'], read['reset']), (u'one\n', True))
+        self.write('two\n')
+        read = logs.read_log(self.logname, read['cursor'])
+        self.assertEqual((read['data'], read['reset']), (u'two\n', False))
+
+    def test_read_log_holds_back_partial_char(self):
+        snowman = u'\u2603'.encode('utf-8')
+        self.write('a' + snowman[:1], 'w')
+        read = logs.read_log(self.logname, '')
+        self.assertEqual(read['data'], u'a')
+        self.write(snowman[1:])
+        read = logs.read_log(self.logname, read['cursor'])
+        self.assertEqual(read['data'], u'\u2603')
+
+    def test_read_log_limit_and_new_file(self):
+        self.write('0123456789', 'w')
+        read = logs.read_log(self.logname, '', max_bytes=4)
+        self.assertEqual((read['data'], read['more']), (u'0123', True))
+        # Each run replaces the log with a new file.
+        new_logname = self.logname + '.new'
+        with open(new_logname, 'w') as lp:
+            lp.write('next run\n')
+        os.rename(new_logname, self.logname)
+        read = logs.read_log(self.logname, read['cursor'])
+        self.assertEqual((read['data'], read['reset']), (u'next run\n', True))
+
+    def test_read_tail_starts_at_a_line(self):
+        self.write('first line\nsecond\nthird\n', 'w')
+        read = logs.read_tail(self.logname, 12)
+        self.assertEqual(read['data'], u'third\n')
+        self.assertTrue(read['truncated'])
+        self.assertEqual(logs.read_log(self.logname, read['cursor'])['data'],
+                         u'')
+
+    def test_watcher_shares_new_output(self):
+        self.write('before\n', 'w')
+        watcher = logs.subscribe(self.logname)
+        try:
+            cursor = watcher.cursor
+            self.write('after\n')
+            reads = watcher.wait(cursor, 5)
+            self.assertEqual(''.join(read['data'] for read in reads),
+                             u'after\n')
+            self.assertEqual(watcher.wait(reads[-1]['cursor'], 0), [])
+        finally:
+            logs.unsubscribe(watcher)
+
+
+class RunsTest(ExecuteTestCase):
+    def run_job(self, stamp, output):
+        job = {'id': 'm_g.%020d-00000000' % stamp, 'menu': 'M', 'group': 'G',
+               'action': 'a', 'state': jobs.RUNNING, 'started': time.time(),
+               'logname': os.path.join(self.dir, 'm_g.log')}
+        with runs.start(job) as lp:
+            lp.write(output)
+        job.update(state=jobs.SUCCEEDED, finished=time.time(), returncode=0)
+        runs.finish(job)
+        return job['id']
+
+    def test_earlier_runs_compressed_and_paged(self):
+        output = u'caf\xe9 ' * 10
+        first = self.run_job(1, output.encode('utf-8'))
+        self.run_job(2, 'second\n')
+        files = [run['file'] for run in runs.get_runs('M', 'G')]
+        self.assertTrue(files[0].endswith('.gz'))
+        self.assertFalse(files[1].endswith('.gz'))
+        with open(os.path.join(self.dir, 'm_g.log')) as lp:
+            self.assertEqual(lp.read(), 'second\n')
+
+        pages = []
+        offset = 0
+        while True:
+            # Pages end within the two bytes of an e acute.
+            page = runs.read_run('M', 'G', first, offset, limit=4)
+            pages.append(page['data'])
+            offset = page['offset']
+            self.assertEqual(page['size'], len(output.encode('utf-8')))
+            if page['eof']:
+                break
+        self.assertEqual(u''.join(pages), output)
+        self.assertIsNone(runs.read_run('M', 'G', 'm_g.nope'))
+
+    def test_oldest_runs_dropped(self):
+        with override_settings(EXECUTE_LOG_RUNS=2):
+            run_ids = [self.run_job(stamp, 'out\n') for stamp in (1, 2, 3)]
+        self.assertEqual([run['id'] for run in runs.get_runs('M', 'G')],
+                         run_ids[1:])
+        # Their files and the index.
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.dir, 'runs', 'm_g'))), 3)
+
+
+class TailTest(ExecuteTestCase):
+    def tail(self, cursor=''):
+        request = RequestFactory().get('/execute/tail', {
+            'mname': 'Deploy', 'gname': 'Management', 'cursor': cursor})
+        return json.loads(views.tail_log(request).content)
 
-# Create your tests here.
+    def test_sends_only_new_output(self):
+        logname = os.path.join(self.dir, 'deploy_management.log')
+        with open(logname, 'w') as lp:
+            lp.write('0123456789')
+        with override_settings(EXECUTE_TAIL_MAX_BYTES=6):
+            data = self.tail()
+            self.assertEqual((data['data'], data['more'], data['active']),
+                             ('012345', True, False))
+            data = self.tail(data['cursor'])
+            self.assertEqual((data['data'], data['more']), ('6789', False))
+        self.assertEqual(self.tail(data['cursor'])['data'], '')
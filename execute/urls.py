@@ -24,4 +24,8 @@ urlpatterns = patterns('',
     url(r'^$', login_required_ajax(views.index), name='index'),
     url(r'^run$', login_required_ajax(views.run_commands), name='run'),
     url(r'^tail$', login_required_ajax(views.tail_log), name='tail'),
+    url(r'^stream$', login_required_ajax(views.stream_log), name='stream'),
+    url(r'^status$', login_required_ajax(views.job_status), name='status'),
+    url(r'^history$', login_required_ajax(views.run_history),
+        name='history'),
 )
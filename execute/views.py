@@ -13,46 +13,52 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
-import fcntl
+import datetime
+import json
 import logging
-import os
-import subprocess
 import time
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.template.defaultfilters import slugify
 
-from chaperone.utils import yaml
+from chaperone.utils.schema import get_schema
+from execute import jobs, logs, plan, runs
+from prepare.answers import get_answer_store
 
 LOG = logging.getLogger(__name__)
 
+# Defaults for settings of the same names.
+# Most bytes of log output sent by one call to tail_log.
+EXECUTE_TAIL_MAX_BYTES = 1024 * 1024
+# Bytes of output at the end of the latest run shown when a group is opened.
+EXECUTE_INDEX_TAIL_BYTES = 64 * 1024
+# Seconds a log stream stays open before the browser is left to reconnect.
+EXECUTE_STREAM_TIMEOUT = 120
+
+# Seconds between comments sent on an idle log stream, so that proxies keep
+# it open and a closed connection is noticed.
+STREAM_KEEPALIVE = 15
+# Milliseconds the browser waits before reconnecting to a log stream.
+STREAM_RETRY = 2000
+
 
 def _get_logname(menu_name, group_name):
     return '%s/%s_%s.log' % (settings.CHAPERONE_LOG_DIR, slugify(menu_name),
                              slugify(group_name))
 
 
+def _is_active(menu_name, group_name):
+    # Return whether a job for the group is queued or running.
+    job = jobs.latest_job(menu_name, group_name)
+    return bool(job and job['state'] in jobs.ACTIVE_STATES)
+
+
 def _get_actions(menu_name, group_name):
     # Return action metadata for the given group. See
     # chaperone/local_settings.py.example for schema.
-    filename = "%s/%s" % (settings.ANSWER_FILE_DIR, settings.ANSWER_FILE_BASE)
-    menus = yaml.load(filename)
-
-    # [{ ... }]
-    for menu in menus:
-        # { 'Menu': { ... } }
-        for mname, groups in menu.items():
-            if mname != menu_name or mname == settings.PREPARE_MENU:
-                continue
-            # [{ ... }]
-            for group in groups:
-                # { 'Group' : { ... } }
-                for gname, actions in group.items():
-                    if gname == group_name:
-                        return actions
-    return []
+    return get_schema().actions(menu_name, group_name)
 
 
 def index(request):
@@ -61,19 +67,25 @@ def index(request):
     group_name = request.REQUEST.get('gname')
     actions = _get_actions(menu_name, group_name)
 
+    # Only the end of the latest run; earlier output is paged in on demand.
     logname = _get_logname(menu_name, group_name)
-    file_contents = ''
-    if os.path.exists(logname):
-        with open(logname, 'r') as lp:
-            fcntl.flock(lp, fcntl.LOCK_SH)
-            file_contents = lp.read()
-            fcntl.flock(lp, fcntl.LOCK_UN)
+    log = logs.read_tail(logname, getattr(settings, 'EXECUTE_INDEX_TAIL_BYTES',
+                                          EXECUTE_INDEX_TAIL_BYTES))
+    past_runs = []
+    for run in reversed(runs.get_runs(menu_name, group_name)):
+        run = dict(run)
+        if run.get('started'):
+            run['started'] = datetime.datetime.fromtimestamp(run['started'])
+        past_runs.append(run)
 
     return render(request, 'execute/_group.html', {
         'menu_name': menu_name,
         'group_name': group_name,
         'actions': actions,
-        'log_contents': file_contents,
+        'log_contents': log['data'],
+        'log_cursor': log['cursor'],
+        'log_truncated': log['truncated'],
+        'runs': past_runs,
     })
 
 
@@ -86,57 +98,133 @@ def run_commands(request):
 
     LOG.debug('Preparing to run command from %s/%s/%s' % (menu_name, group_name, action_id))
 
-    commands = []
     arguments = []
     for act in actions:
         act_id = act['id']
-        LOG.debug('... checking act_id (%s) == action_id (%s)' % (act_id, action_id))
-        if act_id == action_id:
-            LOG.debug('... found act_id (%s) == action_id (%s)' % (act_id, action_id))
-            commands = act.get('commands', [])
         arg = act.get('argument')
         if arg and request.REQUEST.get(act_id) == '1':
             LOG.debug('... appending arg: %s' % arg)
             arguments.append(arg)
 
-    logname = _get_logname(menu_name, group_name)
-    with open(logname, 'w+') as lp:
-        num_cmds = len(commands)
-        LOG.debug('... num_cmds = %d' % num_cmds)
-        for i in range(0, num_cmds):
-            cmd = commands[i]
-            if arguments:
-                cmd = '%s %s' % (cmd, ' '.join(arguments))
-
-            LOG.debug('... cmd: %s' % cmd)
-
-            # Set Python output to be unbuffered so any output is returned
-            # immediately.
-            env = os.environ
-            env['PYTHONUNBUFFERED'] = '1'
-            LOG.debug('Running "%s"' % cmd)
-            proc = subprocess.Popen(cmd.split(), stdout=lp, stderr=lp, env=env)
-            # Wait for each process to finish except for the last one, in case
-            # later commands have dependencies on earlier ones.
-            if not i == num_cmds -1:
-                proc.wait()
-    # AJAX polling will check for output.
-    return HttpResponse('')
+    try:
+        nodes = plan.build(actions, action_id, arguments)
+    except plan.PlanError as e:
+        data = { 'errors': [str(e)] }
+        return HttpResponse(json.dumps(data), content_type='application/json')
+    if not nodes:
+        data = { 'errors': ['No commands for action %s.' % action_id] }
+        return HttpResponse(json.dumps(data), content_type='application/json')
+
+    # Make sure the playbooks see all current answers.
+    get_answer_store().export()
+
+    # Run by the job supervisor; AJAX polling will check for output.
+    job = jobs.submit(menu_name, group_name, action_id, nodes,
+                      _get_logname(menu_name, group_name))
+    data = { 'job': job['id'], 'state': job['state'] }
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+def job_status(request):
+    """Return the state of the given job, or of the group's latest job."""
+    job_id = request.REQUEST.get('job')
+    if job_id:
+        job = jobs.get_job(job_id)
+    else:
+        job = jobs.latest_job(request.REQUEST.get('mname'),
+                              request.REQUEST.get('gname'))
+
+    if job is None:
+        data = { 'errors': ['No such job.'] }
+    else:
+        data = dict((key, job.get(key)) for key in (
+            'id', 'action', 'state', 'created', 'started', 'finished',
+            'returncode', 'error', 'nodes'))
+    return HttpResponse(json.dumps(data), content_type='application/json')
 
 
 def tail_log(request):
-    """Return output written to the log file for this group since the last
-    call made to this.
+    """Return output written to the log file for this group after the given
+    cursor, with the cursor to pass next time and whether a job for the
+    group is queued or running.
     """
     menu_name = request.REQUEST.get('mname')
     group_name = request.REQUEST.get('gname')
     logname = _get_logname(menu_name, group_name)
 
-    file_contents = ''
-    if os.path.exists(logname):
-        with open(logname, 'r') as lp:
-            # Read what has been written to the file so far.
-            fcntl.flock(lp, fcntl.LOCK_SH)
-            file_contents = lp.read()
-            fcntl.flock(lp, fcntl.LOCK_UN)
-    return HttpResponse(file_contents, content_type='text/plain')
+    max_bytes = getattr(settings, 'EXECUTE_TAIL_MAX_BYTES',
+                        EXECUTE_TAIL_MAX_BYTES)
+    data = logs.read_log(logname, request.REQUEST.get('cursor'), max_bytes)
+    data['active'] = _is_active(menu_name, group_name)
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+def run_history(request):
+    """Return the group's runs, newest first, or with a run id, a page of its
+    output starting at the given offset.
+    """
+    menu_name = request.REQUEST.get('mname')
+    group_name = request.REQUEST.get('gname')
+    run_id = request.REQUEST.get('run')
+    if not run_id:
+        data = { 'runs': list(reversed(runs.get_runs(menu_name, group_name))) }
+        return HttpResponse(json.dumps(data), content_type='application/json')
+
+    try:
+        offset = int(request.REQUEST.get('offset', 0))
+    except ValueError:
+        offset = 0
+    data = runs.read_run(menu_name, group_name, run_id, offset)
+    if data is None:
+        data = { 'errors': ['No run %s.' % run_id] }
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+def _log_events(menu_name, group_name, cursor):
+    # Yield server-sent events with the output written to the group's log
+    # file after the cursor, as it's written, until EXECUTE_STREAM_TIMEOUT.
+    # Each event's id is the cursor after its output, so a reconnecting
+    # browser resumes from there.
+    watcher = logs.subscribe(_get_logname(menu_name, group_name))
+    try:
+        yield 'retry: %d\n\n' % STREAM_RETRY
+        deadline = time.time() + getattr(settings, 'EXECUTE_STREAM_TIMEOUT',
+                                         EXECUTE_STREAM_TIMEOUT)
+        active = None
+        while time.time() < deadline:
+            reads = watcher.wait(cursor, min(STREAM_KEEPALIVE,
+                                             deadline - time.time()))
+            was_active, active = active, _is_active(menu_name, group_name)
+            if not reads and active == was_active:
+                yield ': keepalive\n\n'
+                continue
+            # Always send an event when the job state changes.
+            reads = reads or [{'data': '', 'cursor': cursor, 'reset': False}]
+            for read in reads:
+                cursor = read['cursor']
+                data = {
+                    'data': read['data'],
+                    'reset': read['reset'],
+                    'active': active,
+                }
+                yield 'id: %s\ndata: %s\n\n' % (cursor, json.dumps(data))
+    finally:
+        logs.unsubscribe(watcher)
+
+
+def stream_log(request):
+    """Stream output written to the log file for this group after the given
+    cursor, or the Last-Event-ID of a reconnecting browser, as server-sent
+    events.
+    """
+    menu_name = request.REQUEST.get('mname')
+    group_name = request.REQUEST.get('gname')
+    cursor = (request.META.get('HTTP_LAST_EVENT_ID') or
+              request.REQUEST.get('cursor'))
+    response = StreamingHttpResponse(
+        _log_events(menu_name, group_name, cursor),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keep nginx from buffering the events.
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,139 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#
+# Answer stores keep the values saved in the Prepare forms. The store in use is
+# set by ANSWER_STORE, and whatever it is, export() produces the answer file
+# that the Ansible playbooks read.
+import logging
+import os
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils.module_loading import import_by_path
+
+from chaperone.utils import yaml
+from chaperone.utils.schema import get_schema
+from prepare import journal
+from prepare.models import Answer
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_ANSWER_STORE = 'prepare.answers.YamlAnswerStore'
+
+# Above this many answers, old values are read with a single full scan
+# instead of a query with one parameter per answer.
+QUERY_BATCH_SIZE = 500
+
+
+def _get_defaults():
+    # Return static default values for all attributes.
+    schema = get_schema()
+    defaults = {}
+    for attr_id in schema.attribute_ids():
+        attr = schema.attribute(attr_id)[0]
+        defaults[attr_id] = str(attr.get('default') or '')
+    return defaults
+
+
+class YamlAnswerStore(object):
+    """Answers kept in the answer file itself. Every update rewrites it."""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def load(self):
+        """Returns all saved answers, keyed by attribute id."""
+        return yaml.load(self.filename)
+
+    def update(self, answers, user=''):
+        """Saves the given answers, keeping all others as they are. Changed
+        values are recorded in the answer journal.
+        """
+        saved_answers = yaml.load(self.filename)
+        journal.record_changes(saved_answers, answers, user=user)
+        saved_answers.update(answers)
+        yaml.dump(self.filename, saved_answers)
+        LOG.info('File %s written' % self.filename)
+
+    def export(self, filename=None):
+        """Writes the answer file, with defaults for unanswered attributes."""
+        answers_data = _get_defaults()
+        answers_data.update(self.load())
+        yaml.dump(filename or self.filename, answers_data)
+        LOG.info('File %s exported' % (filename or self.filename))
+
+
+class DatabaseAnswerStore(YamlAnswerStore):
+    """Answers kept one row per attribute in the Django database. Updates
+    only touch the rows of the attributes given. The answer file is only
+    written by export(), which must be called before anything reads it, such
+    as the commands run by execute.
+    """
+
+    def _import_answer_file(self):
+        # Seed an empty table from an existing answer file.
+        if Answer.objects.exists() or not os.path.exists(self.filename):
+            return
+        saved_answers = yaml.load(self.filename)
+        LOG.info('Importing %d answers from %s' % (len(saved_answers),
+                                                  self.filename))
+        with transaction.atomic():
+            Answer.objects.bulk_create([
+                Answer(attr_id=attr_id, value=str(value))
+                for attr_id, value in saved_answers.items()])
+            journal.record_changes({}, saved_answers, user='import')
+
+    def exists(self):
+        self._import_answer_file()
+        return Answer.objects.exists()
+
+    def load(self):
+        self._import_answer_file()
+        return dict(Answer.objects.values_list('attr_id', 'value'))
+
+    def update(self, answers, user=''):
+        with transaction.atomic():
+            old_answers = Answer.objects.all()
+            if len(answers) <= QUERY_BATCH_SIZE:
+                old_answers = old_answers.filter(attr_id__in=answers.keys())
+            old_answers = dict(old_answers.values_list('attr_id', 'value'))
+            journal.record_changes(old_answers, answers, user=user)
+            for attr_id, value in answers.items():
+                updated = Answer.objects.filter(attr_id=attr_id).update(
+                    value=value)
+                if updated:
+                    continue
+                try:
+                    # In a savepoint, so that losing the race with another
+                    # save creating the row leaves this transaction usable.
+                    with transaction.atomic():
+                        Answer.objects.create(attr_id=attr_id, value=value)
+                except IntegrityError:
+                    Answer.objects.filter(attr_id=attr_id).update(value=value)
+        LOG.info('%d answers saved' % len(answers))
+
+
+def get_answer_store(filename=None):
+    """Returns the configured answer store for the given answer file."""
+    if filename is None:
+        filename = os.path.join(settings.ANSWER_FILE_DIR,
+                                settings.ANSWER_FILE_DEFAULT)
+    store_class = import_by_path(getattr(settings, 'ANSWER_STORE',
+                                         DEFAULT_ANSWER_STORE))
+    return store_class(filename)
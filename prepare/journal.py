@@ -0,0 +1,102 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#
+# Journal of changes made to saved answers, written by the answer stores in
+# place of a full backup copy of the answers on every save.
+import calendar
+import logging
+
+from django.utils import timezone
+
+from prepare.models import AnswerChange
+
+LOG = logging.getLogger(__name__)
+
+COMPACT_BATCH_SIZE = 500
+
+
+def record_changes(old_answers, new_answers, user=''):
+    """Appends a record for every answer in new_answers whose value differs
+    from the one in old_answers.
+    """
+    now = timezone.now()
+    changes = []
+    for attr_id, value in new_answers.items():
+        old_value = old_answers.get(attr_id)
+        if old_value is not None and unicode(old_value) == unicode(value):
+            continue
+        changes.append(AnswerChange(timestamp=now, user=user or '',
+                                    attr_id=attr_id, old_value=old_value,
+                                    new_value=value))
+    if changes:
+        AnswerChange.objects.bulk_create(changes)
+        LOG.debug('%d answer changes recorded' % len(changes))
+    return len(changes)
+
+
+def to_dict(change):
+    """Returns JSON friendly version of the change."""
+    return {
+        'timestamp': calendar.timegm(change.timestamp.utctimetuple()),
+        'user': change.user,
+        'attr_id': change.attr_id,
+        'old': change.old_value,
+        'new': change.new_value,
+    }
+
+
+def get_changes(attr_id=None, limit=None):
+    """Returns the most recent changes, newest first."""
+    changes = AnswerChange.objects.order_by('-id')
+    if attr_id:
+        changes = changes.filter(attr_id=attr_id)
+    if limit:
+        changes = changes[:limit]
+    return list(changes)
+
+
+def answers_at(when):
+    """Returns the answers as they were at the given time, keyed by attribute
+    id. Exact for any time since the last compaction.
+    """
+    answers = {}
+    changes = (AnswerChange.objects.filter(timestamp__lte=when)
+               .order_by('id').values_list('attr_id', 'new_value'))
+    for attr_id, value in changes.iterator():
+        answers[attr_id] = value
+    return answers
+
+
+def compact(before):
+    """Drops all but the latest change to each answer made before the given
+    time. Returns the number of changes dropped.
+    """
+    seen = set()
+    drop_ids = []
+    changes = (AnswerChange.objects.filter(timestamp__lt=before)
+               .order_by('-id').values_list('id', 'attr_id'))
+    for change_id, attr_id in changes.iterator():
+        if attr_id in seen:
+            drop_ids.append(change_id)
+        else:
+            seen.add(attr_id)
+
+    # Keep below the SQLite limit on query parameters.
+    for i in range(0, len(drop_ids), COMPACT_BATCH_SIZE):
+        AnswerChange.objects.filter(
+            id__in=drop_ids[i:i + COMPACT_BATCH_SIZE]).delete()
+    LOG.info('%d answer changes before %s compacted' % (len(drop_ids), before))
+    return len(drop_ids)
@@ -0,0 +1,45 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import datetime
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from prepare import journal
+
+# Default number of days of complete answer history to keep.
+DEFAULT_JOURNAL_DAYS = 30
+
+
+class Command(BaseCommand):
+    help = ('Compacts the answer change journal, keeping only the latest '
+            'change to each answer from before the retention period.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=None,
+                    help='Days of complete history to keep.'),
+    )
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days is None:
+            days = getattr(settings, 'ANSWER_JOURNAL_DAYS',
+                           DEFAULT_JOURNAL_DAYS)
+        before = timezone.now() - datetime.timedelta(days=days)
+        count = journal.compact(before)
+        self.stdout.write('%d answer changes compacted.' % count)
@@ -0,0 +1,32 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from prepare.answers import get_answer_store
+
+
+class Command(BaseCommand):
+    help = 'Writes the saved answers out to the answer file.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', default=None,
+                    help='File to write, instead of the answer file.'),
+    )
+
+    def handle(self, *args, **options):
+        get_answer_store().export(options['output'])
@@ -0,0 +1,61 @@
+#
+#  Copyright 2015 VMware, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+from django.db import models
+
+
+class Answer(models.Model):
+    """A saved answer file value, used by prepare.answers.DatabaseAnswerStore."""
+    attr_id = models.CharField(max_length=255, unique=True)
+    value = models.TextField(blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return self.attr_id
+
+
+class AnswerChange(models.Model):
+    """One change to a saved answer. Rows are only ever appended, except by
+    prepare.journal.compact().
+    """
+    timestamp = models.DateTimeField(db_index=True)
+    user = models.CharField(max_length=255, blank=True)
+    attr_id = models.CharField(max_length=255, db_index=True)
+    old_value = models.TextField(null=True, blank=True)
+    new_value = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __unicode__(self):
+        return '%s %s' % (self.timestamp, self.attr_id)
+
+
+class GroupStatus(models.Model):
+    """Whether a Prepare group has all of its required values set, as of the
+    last time it was evaluated. Rows are deleted when they go stale.
+    """
+    container = models.CharField(max_length=255)
+    group = models.CharField(max_length=255)
+    complete = models.BooleanField(default=False)
+    # Digest of the group's definition, answers and options it was evaluated
+    # against, see prepare.views.EvaluationContext.digest().
+    digest = models.CharField(max_length=32)
+
+    class Meta:
+        unique_together = ('container', 'group')
+
+    def __unicode__(self):
+        return '%s/%s' % (self.container, self.group)
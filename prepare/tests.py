@@ -13,6 +13,194 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from django.contrib.auth.models import AnonymousUser
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from chaperone.utils import yaml
+from prepare import answers, journal, views
+from prepare.models import Answer, AnswerChange, GroupStatus
+
+BASE_YML = """
+- Prepare:
+    - Container:
+        - Group:
+            - Section:
+                - id: name
+                  default: chaperone
+                - id: size
+"""
+
+
+class AnswerStoreTestCase(TestCase):
+    """Runs with a scratch ANSWER_FILE_DIR holding a small base.yml."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, 'base.yml'), 'w') as fp:
+            fp.write(BASE_YML)
+        self.override = override_settings(
+            ANSWER_FILE_DIR=self.dir, ANSWER_FILE_BASE='base.yml',
+            ANSWER_FILE_DEFAULT='answers.yml', PREPARE_MENU='Prepare',
+            INPUT_OPTIONS=os.path.join(self.dir, 'vcenter_options.yml'),
+            OPTIONS_CACHE=os.path.join(self.dir, 'options_cache.yml'),
+            VCENTER_SETTINGS=os.path.join(self.dir, 'vcenter.yml'))
+        self.override.enable()
+        self.filename = os.path.join(self.dir, 'answers.yml')
+
+    def tearDown(self):
+        self.override.disable()
+        yaml.invalidate()
+        shutil.rmtree(self.dir)
+
+
+class YamlAnswerStoreTest(AnswerStoreTestCase):
+    def test_update_keeps_other_answers_and_journals(self):
+        store = answers.YamlAnswerStore(self.filename)
+        store.update({'name': 'a', 'size': '1'}, user='u')
+        store.update({'size': '2'}, user='u')
+        self.assertEqual(store.load(), {'name': 'a', 'size': '2'})
+        self.assertEqual(
+            list(AnswerChange.objects.values_list('attr_id', 'old_value',
+                                                  'new_value')),
+            [('name', None, 'a'), ('size', None, '1'), ('size', '1', '2')])
+
+    def test_export_fills_in_defaults(self):
+        store = answers.YamlAnswerStore(self.filename)
+        store.update({'size': '3'})
+        exported = os.path.join(self.dir, 'exported.yml')
+        store.export(exported)
+        self.assertEqual(yaml.load(exported),
+                         {'name': 'chaperone', 'size': '3'})
+
+
+class DatabaseAnswerStoreTest(AnswerStoreTestCase):
+    def test_update_writes_rows(self):
+        store = answers.DatabaseAnswerStore(self.filename)
+        store.update({'size': '4'})
+        store.update({'size': '5', 'name': 'x'})
+        self.assertEqual(dict(Answer.objects.values_list('attr_id', 'value')),
+                         {'size': '5', 'name': 'x'})
+        self.assertEqual(AnswerChange.objects.count(), 3)
+
+    def test_update_after_row_created_elsewhere(self):
+        store = answers.DatabaseAnswerStore(self.filename)
+        Answer.objects.create(attr_id='size', value='3')
+        # The first update finds no row, as if another save created it just
+        # after.
+        filter_ = Answer.objects.filter
+        calls = []
+        def racing_filter(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                return filter_(pk=None)
+            return filter_(**kwargs)
+        Answer.objects.filter = racing_filter
+        try:
+            store.update({'size': '4'})
+        finally:
+            del Answer.objects.filter
+        self.assertEqual(Answer.objects.get(attr_id='size').value, '4')
+
+    def test_imports_existing_answer_file(self):
+        yaml.dump(self.filename, {'name': 'old'})
+        store = answers.DatabaseAnswerStore(self.filename)
+        self.assertTrue(store.exists())
+        self.assertEqual(store.load(), {'name': 'old'})
+
+
+class GroupStatusTest(AnswerStoreTestCase):
+    def status(self):
+        request = RequestFactory().get('/prepare/status')
+        data = json.loads(views.get_group_status(request).content)
+        return data['Container']['Group']['complete']
+
+    def test_answers_changed_outside_save_group(self):
+        self.assertFalse(self.status())
+        self.assertEqual(GroupStatus.objects.count(), 1)
+        # E.g. edited in the database, or by another process.
+        answers.get_answer_store().update({'size': '5'})
+        self.assertTrue(self.status())
+
+    def test_status_from_before_a_change_is_stale(self):
+        context = views.EvaluationContext()
+        digest = context.digest('Container', 'Group')
+        sections = context.sections('Container', 'Group')
+        answers.get_answer_store().update({'size': '5'})
+        # Recorded after the change, but evaluated before it.
+        views._set_group_status('Container', 'Group',
+                                views._is_group_complete(sections), digest)
+        self.assertTrue(self.status())
+
+
+class SaveGroupTest(AnswerStoreTestCase):
+    def save(self, **answers):
+        params = dict(answers, cname='Container', gname='Group')
+        request = RequestFactory().post('/prepare/save', params)
+        request.user = AnonymousUser()
+        return json.loads(views.save_group(request).content)
+
+    def test_saves_answers_and_status(self):
+        data = self.save(name='chaperone', size='')
+        self.assertFalse(data['complete'])
+        self.assertIn('chaperone', data['group'])
+        data = self.save(size='5')
+        self.assertTrue(data['complete'])
+        self.assertEqual(answers.get_answer_store().load(),
+                         {'name': 'chaperone', 'size': '5'})
+        # The status recorded with the save is current.
+        self.assertEqual(GroupStatus.objects.count(), 1)
+        request = RequestFactory().get('/prepare/status')
+        status = json.loads(views.get_group_status(request).content)
+        self.assertTrue(status['Container']['Group']['complete'])
+
+
+class HistoryTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        journal.record_changes({}, {'a': '1'}, user='u')
+        journal.record_changes({'a': '1'}, {'a': '2', 'b': '3'}, user='u')
+
+    def get(self, **params):
+        response = views.get_history(self.factory.get('/prepare/history',
+                                                      params))
+        return response.status_code, json.loads(response.content)
+
+    def test_changes_newest_first(self):
+        status, data = self.get(attr='a')
+        self.assertEqual(status, 200)
+        self.assertEqual([(c['old'], c['new']) for c in data['changes']],
+                         [('1', '2'), (None, '1')])
+
+    def test_limit_is_clamped(self):
+        self.assertEqual(len(self.get(limit='-5')[1]['changes']), 1)
+        self.assertEqual(len(self.get(limit='100000')[1]['changes']), 3)
+
+    def test_answers_at(self):
+        status, data = self.get(at=str(time.time() + 60))
+        self.assertEqual(data['answers'], {'a': '2', 'b': '3'})
+
+    def test_invalid_time(self):
+        for at in ('soon', '1e300'):
+            status, data = self.get(at=at)
+            self.assertEqual(status, 400)
+            self.assertTrue(data['errors'])
+
+    def test_unchanged_answers_not_recorded(self):
+        self.assertEqual(journal.record_changes({'a': '2'}, {'a': 2}), 0)
 
-# Create your tests here.
+    def test_compact_keeps_latest_change(self):
+        self.assertEqual(journal.compact(timezone.now()), 1)
+        self.assertEqual([(c.attr_id, c.new_value)
+                          for c in journal.get_changes()],
+                         [('b', '3'), ('a', '2')])
+        self.assertEqual(journal.answers_at(timezone.now()),
+                         {'a': '2', 'b': '3'})
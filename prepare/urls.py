@@ -25,6 +25,8 @@ urlpatterns = patterns('',
     url(r'^save$', login_required_ajax(views.save_group), name='save'),
     url(r'^status$', login_required_ajax(views.get_group_status),
         name='status'),
+    url(r'^history$', login_required_ajax(views.get_history),
+        name='history'),
     url(r'^(?P<name>[^/]+)/download$', login_required(views.download_file),
         name='download'),
 )
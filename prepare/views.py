@@ -13,25 +13,47 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import datetime
 import fcntl
+import hashlib
 import json
 import logging
 import mimetypes
 import os
+import time
 
 from django.conf import settings
 from django.core.servers.basehttp import FileWrapper
+from django.db import IntegrityError
 from django.http import HttpResponse
 from django.shortcuts import render
+from django.utils import timezone
 
 from chaperone.utils import getters
+from chaperone.utils import options
+from chaperone.utils import parallel
 from chaperone.utils import yaml
+from chaperone.utils.schema import get_schema
+from prepare import journal
+from prepare.answers import get_answer_store
+from prepare.models import GroupStatus
 
 LOG = logging.getLogger(__name__)
 
 # Input types that are not required to have a value set.
 OPTIONAL_INPUT_TYPES = ('checkbox', 'file')
 
+# Default and most number of answer changes returned by get_history.
+HISTORY_LIMIT = 100
+HISTORY_MAX_LIMIT = 1000
+
+# Defaults for fetching dynamic options of a group in parallel: how many
+# getters run at the same time, how many seconds to wait for all of them, and
+# for each one once it runs.
+OPTIONS_PREFETCH_WORKERS = 8
+OPTIONS_PREFETCH_TIMEOUT = 60
+OPTIONS_PREFETCH_CALL_TIMEOUT = 30
+
 
 def _has_value(attribute):
     # Return True if attribute has its value set.
@@ -43,70 +65,149 @@ def _has_value(attribute):
         return value
 
 
-def _get_sections(container_name=None, group_name=None):
+def _evaluate_sections(sections, saved_answers, opt_cache):
+    # Populate the sections of one group with the calculated metadata for all
+    # of their attributes.
+    hidden_attributes = []
+    shown_opt_attrs = []
+
+    # [{ ... }]
+    for section in sections:
+        # { 'Section': [...] }
+        for attributes in section.values():
+            # [{ ... }]
+            for attr in attributes:
+                input_type = attr.get('input')
+                if input_type and input_type.lower() == 'multiform':
+                    new_hidden_attributes, new_shown_opt_attrs, new_attributes = _get_multiform(attr,saved_answers,opt_cache)
+                    attributes.extend(new_attributes)
+                else:
+                    new_hidden_attributes, new_shown_opt_attrs, new_attr = _get_form(attr,saved_answers,opt_cache)
+                    attr=new_attr
+                hidden_attributes.extend(new_hidden_attributes)
+                shown_opt_attrs.extend(new_shown_opt_attrs)
+
+    # Note which attributes not to display.
+    for section in sections:
+        for attributes in section.values():
+            for attr in attributes:
+                attr_id = attr['id']
+                if (attr_id in hidden_attributes and
+                        attr_id not in shown_opt_attrs):
+                    attr['hide'] = '1'
+    return sections
+
+
+class EvaluationContext(object):
+    """Inputs for evaluating groups, loaded once and shared for the rest of a
+    request. Each group is evaluated at most once.
+    """
+
+    def __init__(self):
+        self.schema = get_schema()
+        self.saved_answers = get_answer_store().load()
+        # Cache option values already retrieved in this request.
+        self.opt_cache = yaml.load(settings.INPUT_OPTIONS)
+        self._sections = {}
+
+    def digest(self, container_name, group_name):
+        """Returns a digest of everything the group's evaluation depends on:
+        its definition, its saved answers and the options of its fields.
+        Status recorded with any other digest is stale. Take it before
+        evaluating the group, so that changes made in the meantime make the
+        recorded status stale rather than go unnoticed.
+        """
+        fields = sorted(self.schema.option_fields(container_name, group_name))
+        cached = options.peek([f for f in fields if f not in self.opt_cache])
+        inputs = [
+            self.schema.group_digest(container_name, group_name),
+            [(attr_id, self.saved_answers.get(attr_id)) for attr_id in
+             sorted(self.schema.group_attribute_ids(container_name,
+                                                    group_name))],
+            [(f, self.opt_cache.get(f, cached.get(f))) for f in fields],
+        ]
+        return hashlib.md5(json.dumps(inputs, default=str)).hexdigest()
+
+    def sections(self, container_name, group_name):
+        """Returns the evaluated sections of the group, or None if there is no
+        such group. The result is shared, and must not be modified.
+        """
+        key = (container_name, group_name)
+        if key not in self._sections:
+            sections = self.schema.sections(container_name, group_name)
+            if sections is not None:
+                _prefetch_options(
+                    self.schema.option_fields(container_name, group_name),
+                    self.opt_cache)
+                sections = _evaluate_sections(sections, self.saved_answers,
+                                              self.opt_cache)
+            self._sections[key] = sections
+        return self._sections[key]
+
+
+def _get_sections(container_name=None, group_name=None, context=None):
     # Return containers with all sections populated with the calculated
     # metadata for all attributes, or only the section for the given group in
     # the given container.
     #
     # See chaperone/local_settings.py.example for schema.
-    base = os.path.join(settings.ANSWER_FILE_DIR, settings.ANSWER_FILE_BASE)
-    menus = yaml.load(base)
-    containers = []
-    for menu in menus:
-        for menu_name, menu_containers in menu.items():
-            if menu_name == settings.PREPARE_MENU:
-                containers = menu_containers
-                break
+    if context is None:
+        context = EvaluationContext()
 
-    filename = os.path.join(settings.ANSWER_FILE_DIR, settings.ANSWER_FILE_DEFAULT)
-    saved_answers = yaml.load(filename)
-    hidden_attributes = []
-    shown_opt_attrs = []
+    if group_name:
+        if not container_name:
+            container_name = context.schema.find_container(group_name)
+        sections = context.sections(container_name, group_name)
+        if sections is None:
+            LOG.error('No group %s/%s' % (container_name, group_name))
+            return []
+        return sections
+
+    # [{ 'Container': [{ 'Group': [...] }] }]
+    containers = []
+    for cname, group_names in context.schema.containers:
+        if container_name and cname != container_name:
+            continue
+        groups = []
+        for gname in group_names:
+            groups.append({ gname: context.sections(cname, gname) })
+        containers.append({ cname: groups })
+    return containers
 
-    # Cache option values already retrieved in this request.
-    opt_cache = yaml.load(settings.INPUT_OPTIONS)
+def _prefetch_options(field_names, opt_cache):
+    # Obtain options for all the given fields that aren't cached yet, from the
+    # persistent options cache, or else all at the same time, so a group takes
+    # as long as its slowest getter.
+    field_names = [f for f in field_names
+                   if f not in opt_cache and hasattr(getters, 'get_%s' % f)]
+    cached = options.get_cached(field_names)
+    opt_cache.update(cached)
+
+    calls = {}
+    for field_name in field_names:
+        if field_name not in cached:
+            calls[field_name] = (
+                lambda f: lambda: options.fetch_options(f))(field_name)
+    if not calls:
+        return
+
+    source = options.get_source()
+    started = time.time()
+    results, errors = parallel.run_all(
+        calls,
+        workers=getattr(settings, 'OPTIONS_PREFETCH_WORKERS',
+                        OPTIONS_PREFETCH_WORKERS),
+        timeout=getattr(settings, 'OPTIONS_PREFETCH_TIMEOUT',
+                        OPTIONS_PREFETCH_TIMEOUT),
+        call_timeout=getattr(settings, 'OPTIONS_PREFETCH_CALL_TIMEOUT',
+                             OPTIONS_PREFETCH_CALL_TIMEOUT))
+    opt_cache.update(results)
+    options.store(results, source=source, started=started)
+    for field_name, error in errors.items():
+        # Show the field without options, rather than trying it again.
+        LOG.error('Unable to obtain options for %s: %s' % (field_name, error))
+        opt_cache[field_name] = []
 
-    # [{ ... }]
-    for container in containers:
-        # { 'Container': { ... } }
-        for cname, groups in container.items():
-            if container_name and cname != container_name:
-                continue
-            # [{ ... }]
-            for group in groups:
-                # { 'Group': [...] }
-                for gname, sections in group.items():
-                    if group_name and gname != group_name:
-                        continue
-                    # [{ ... }]
-                    for section in sections:
-                        # { 'Section': [...] }
-                        for attributes in section.values():
-                            # [{ ... }]
-                            for attr in attributes:
-                                subsection = None
-                                input_type = attr.get('input')
-                                if input_type and input_type.lower() == 'multiform':
-                                    new_hidden_attributes, new_shown_opt_attrs, new_attributes = _get_multiform(attr,saved_answers,opt_cache)
-                                    attributes.extend(new_attributes)
-                                else:
-                                    new_hidden_attributes, new_shown_opt_attrs, new_attr = _get_form(attr,saved_answers,opt_cache)
-                                    attr=new_attr
-                                hidden_attributes.extend(new_hidden_attributes)
-                                shown_opt_attrs.extend(new_shown_opt_attrs)
-
-                    # Note which attributes not to display.
-                    for section in sections:
-                        for attributes in section.values():
-                            for attr in attributes:
-                                attr_id = attr['id']
-                                if (attr_id in hidden_attributes and
-                                        attr_id not in shown_opt_attrs):
-                                    attr['hide'] = '1'
-                    if group_name:
-                        return sections
-
-    return containers
 
 def _get_form(attr, saved_answers, opt_cache, attr_id=None):
     hidden_attributes = []
@@ -153,18 +254,11 @@ def _get_form(attr, saved_answers, opt_cache, attr_id=None):
         if field_name in opt_cache:
             opt_names = opt_cache[field_name]
         else:
-            try: 
-                # Get options dynamically.
-                fn_name = 'get_%s' % field_name
-                LOG.debug('Calling on %s to obtain options.' % fn_name)
-                fn = getattr(getters, fn_name)
-                options = fn()
-                if options:
-                    opt_names = options.keys()
-                    opt_names.sort()
+            try:
+                opt_names = options.fetch_options(field_name)
                 opt_cache[field_name] = opt_names
             except (KeyError, AttributeError) as e:
-                pass               
+                pass
 
         # Options for dropdown menu.
         for name in opt_names:
@@ -265,20 +359,40 @@ def _get_attributes_by_id(container_name=None, group_name=None):
     return attributes_by_id
 
 
+def _save_file(request, attr_id, errors):
+    # Save newly uploaded file for the attribute, if there is one. Return False
+    # if there isn't any version of the file available.
+    src = request.FILES.get('file-%s' % attr_id)
+    dst_filename = os.path.join(settings.PREPARE_FILES_DIR, attr_id)
+    if src:
+        with open(dst_filename, 'wb+') as dp:
+            for chunk in src.chunks():
+                dp.write(chunk)
+    elif not os.path.exists(dst_filename):
+        # Should have a previously uploaded file available.
+        errors.append('File missing for %s.' % attr_id)
+        return False
+    return True
+
+
 def write_answer_file(request, filename, new_answers=None):
     """Write out answer file, replacing old values with new ones, if given."""
     errors = []
-    saved_answers = yaml.load(filename)
-    if os.path.exists(filename):
-        # Make a backup copy.
-        backup_filename = '%s.bak' % filename
-        yaml.dump(backup_filename, saved_answers)
-        LOG.debug('Backup file %s written' % backup_filename)
-
-    attributes_by_id = _get_attributes_by_id()
+    store = get_answer_store(filename)
     if not new_answers:
         new_answers = request.REQUEST
 
+    if not store.exists():
+        # Initialize answers with the values of all attributes.
+        attributes_by_id = _get_attributes_by_id()
+    else:
+        # Only the given answers need to be saved.
+        schema = get_schema()
+        attributes_by_id = {}
+        for attr_id in new_answers:
+            if schema.has_attribute(attr_id):
+                attributes_by_id[attr_id] = schema.attribute(attr_id)[0]
+
     answers_data = {}
     for attr_id, attr in attributes_by_id.items():
         if new_answers and attr_id in new_answers:
@@ -288,15 +402,7 @@ def write_answer_file(request, filename, new_answers=None):
 
             # Check if there is a new file to save.
             if attr.get('input') == 'file' and value == '1':
-                src = request.FILES.get('file-%s' % attr_id)
-                dst_filename = os.path.join(settings.PREPARE_FILES_DIR, attr_id)
-                if src:
-                    with open(dst_filename, 'wb+') as dp:
-                        for chunk in src.chunks():
-                            dp.write(chunk)
-                elif not os.path.exists(dst_filename):
-                    # Should have a previously uploaded file available.
-                    errors.append('File missing for %s.' % attr_id)
+                if not _save_file(request, attr_id, errors):
                     return errors
         else:
             # Use currently saved value.
@@ -304,19 +410,14 @@ def write_answer_file(request, filename, new_answers=None):
             LOG.debug('Saving old value %s: %s' % (attr_id, value))
         answers_data[attr_id] = str(value)
 
-    LOG.debug('Dumping values: %s' % str(answers_data))
-    yaml.dump(filename, answers_data)
-    LOG.info('File %s written' % filename)
+    LOG.debug('Saving values: %s' % str(answers_data))
+    store.update(answers_data, user=request.user.username)
+    invalidate_group_status(answers_data.keys())
     return errors
 
 
-def get_group(request):
-    """Display form to set answers for the sections in this group."""
-    container_name = request.REQUEST.get('cname')
-    group_name = request.REQUEST.get('gname')
-    sections = _get_sections(container_name=container_name,
-                             group_name=group_name)
-
+def _render_group(request, container_name, group_name, sections):
+    # Return form to set answers for the sections in this group.
     return render(request, 'prepare/_group.html', {
         'menu_name': settings.PREPARE_MENU,
         'container_name': container_name,
@@ -325,6 +426,15 @@ def get_group(request):
     })
 
 
+def get_group(request):
+    """Display form to set answers for the sections in this group."""
+    container_name = request.REQUEST.get('cname')
+    group_name = request.REQUEST.get('gname')
+    sections = _get_sections(container_name=container_name,
+                             group_name=group_name)
+    return _render_group(request, container_name, group_name, sections)
+
+
 def _is_group_complete(sections):
     # Return True if group has all required values set in its sections.
     for section in sections:
@@ -340,30 +450,76 @@ def _is_group_complete(sections):
     return True
 
 
+def _set_group_status(container_name, group_name, is_complete, digest):
+    # Record the completeness of the group in the status index.
+    updated = GroupStatus.objects.filter(
+        container=container_name, group=group_name).update(
+            complete=is_complete, digest=digest)
+    if not updated:
+        try:
+            GroupStatus.objects.create(container=container_name,
+                                       group=group_name, complete=is_complete,
+                                       digest=digest)
+        except IntegrityError:
+            # Recorded by another request in the meantime.
+            pass
+
+
+def invalidate_group_status(attr_ids=None):
+    """Drop recorded status of the groups that have the given attributes, or
+    of all groups, so they are evaluated again when next asked for.
+    """
+    if attr_ids is None:
+        GroupStatus.objects.all().delete()
+        return
+
+    schema = get_schema()
+    groups = set()
+    for attr_id in attr_ids:
+        group = schema.group_of(attr_id)
+        if group:
+            groups.add(group)
+    for container_name, group_name in groups:
+        GroupStatus.objects.filter(container=container_name,
+                                   group=group_name).delete()
+
+
 def get_group_status(request):
     """Get current state of group, or all groups, if group name not given."""
     container_name = request.REQUEST.get('cname')
     group_name = request.REQUEST.get('gname')
-    containers_or_sections = _get_sections(container_name=container_name,
-                                           group_name=group_name)
-    data = {}
+    schema = get_schema()
 
     if group_name:
         # Only dealing with one group.
-        is_complete = _is_group_complete(containers_or_sections)
-        data[container_name][group_name] = { 'complete': is_complete }
+        if not container_name:
+            container_name = schema.find_container(group_name)
+        groups = [(container_name, group_name)]
     else:
-        # [{ ... }]
-        for container in containers_or_sections:
-            # { 'Container': { ... } }
-            for cname, groups in container.items():
-                data[cname] = {}
-                # [{ ... }]
-                for group in groups:
-                    # { 'Group': [...] }
-                    for gname, sections in group.items():
-                        is_complete = _is_group_complete(sections)
-                        data[cname][gname] = { 'complete': is_complete }
+        groups = [(cname, gname) for cname, group_names in schema.containers
+                  if not container_name or cname == container_name
+                  for gname in group_names]
+
+    # Use the recorded status of groups, when it's still current, and only
+    # evaluate the others.
+    recorded = {}
+    for group_status in GroupStatus.objects.all():
+        recorded[(group_status.container, group_status.group)] = group_status
+    context = EvaluationContext()
+
+    data = {}
+    for cname, gname in groups:
+        digest = context.digest(cname, gname)
+        group_status = recorded.get((cname, gname))
+        if group_status is not None and group_status.digest == digest:
+            is_complete = group_status.complete
+        else:
+            sections = context.sections(cname, gname)
+            if sections is None:
+                continue
+            is_complete = _is_group_complete(sections)
+            _set_group_status(cname, gname, is_complete, digest)
+        data.setdefault(cname, {})[gname] = { 'complete': is_complete }
     # Return status for all groups.
     return HttpResponse(json.dumps(data), content_type='application/json')
 
@@ -372,19 +528,60 @@ def save_group(request):
     """Save new answers for the group."""
     filename = os.path.join(settings.ANSWER_FILE_DIR, settings.ANSWER_FILE_DEFAULT)
     errors = write_answer_file(request, filename)
-    # Get updated values, e.g., current versions of files.
-    group = get_group(request).content
+
+    # Evaluate the group once with the updated values, e.g., current versions
+    # of files, and use it for both the form and its status.
+    container_name = request.REQUEST.get('cname')
+    group_name = request.REQUEST.get('gname')
+    context = EvaluationContext()
+    if not container_name:
+        container_name = context.schema.find_container(group_name)
+    digest = context.digest(container_name, group_name)
+    sections = _get_sections(container_name=container_name,
+                             group_name=group_name, context=context)
+    group = _render_group(request, container_name, group_name,
+                          sections).content
     data = {
         'errors': errors,
         'group': group,
     }
 
     if not errors:
-        container_name = request.REQUEST.get('cname')
-        group_name = request.REQUEST.get('gname')
-        sections = _get_sections(container_name=container_name,
-                                 group_name=group_name)
         data['complete'] = _is_group_complete(sections)
+        _set_group_status(container_name, group_name, data['complete'],
+                          digest)
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+def get_history(request):
+    """Get recent changes to saved answers, optionally only for one attribute,
+    or all answers as they were at a given time.
+    """
+    attr_id = request.REQUEST.get('attr')
+    at = request.REQUEST.get('at')
+    data = {}
+
+    if at:
+        # Seconds since the epoch.
+        try:
+            when = datetime.datetime.fromtimestamp(float(at), timezone.utc)
+        except (ValueError, OverflowError, OSError):
+            data['errors'] = ['Invalid time %s.' % at]
+            return HttpResponse(json.dumps(data), status=400,
+                                content_type='application/json')
+        else:
+            answers = journal.answers_at(when)
+            if attr_id:
+                answers = { attr_id: answers.get(attr_id) }
+            data['answers'] = answers
+    else:
+        try:
+            limit = int(request.REQUEST.get('limit', HISTORY_LIMIT))
+        except ValueError:
+            limit = HISTORY_LIMIT
+        limit = min(max(limit, 1), HISTORY_MAX_LIMIT)
+        changes = journal.get_changes(attr_id=attr_id, limit=limit)
+        data['changes'] = [journal.to_dict(c) for c in changes]
     return HttpResponse(json.dumps(data), content_type='application/json')
 
 